@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""F-SpotFS benchmarks. Filesystem handlers are called directly, no kernel
+mount is needed. Run them as modules from source tree root, like:
+
+    $ python -m benchmarks.concurrency --help
+
+Synthetic databases are written by benchmarks.generate, handlers latencies
+and SQL statements per call are reported by benchmarks.operations for
+several database sizes.
+"""
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Concurrency benchmark, runs parallel getattr/readdir clients against
+FSpotFS instance for every FUSE threads count given, reports throughput
+and latencies per operation. Calls are served by at most that many
+threads at once (1 is the single threaded FUSE loop, calls are queued
+behind the one being served), latencies include the time spent queued:
+
+    $ python -m benchmarks.concurrency -d photos.db -t 1,2,4,8 -n 8
+"""
+import sys, time, random, threading
+from optparse import OptionParser
+
+from .util import build_fs, tree_paths, print_summary
+
+
+def client(fs, dispatch, dirs, files, ratio, deadline, results, seed):
+    """Benchmark client, calls getattr on random files and readdir on
+    random directories (@ratio readdir calls) until @deadline. Calls
+    are served while holding @dispatch semaphore."""
+    rand = random.Random(seed)
+    getattrs, readdirs = [], []
+    while time.time() < deadline:
+        if rand.random() < ratio:
+            path = rand.choice(dirs)
+            start = time.time()
+            with dispatch:
+                for entry in fs.readdir(path, 0):
+                    pass
+            readdirs.append(time.time() - start)
+        else:
+            path = rand.choice(files)
+            start = time.time()
+            with dispatch:
+                fs.getattr(path)
+            getattrs.append(time.time() - start)
+    results.append((getattrs, readdirs))
+
+
+def run_clients(fs, threads, clients, dirs, files, ratio, duration):
+    """Run @clients clients for @duration seconds, served by @threads
+    FUSE threads, return collected (getattr latencies, readdir
+    latencies)."""
+    results = []
+    deadline = time.time() + duration
+    dispatch = threading.Semaphore(threads)
+    workers = [threading.Thread(target=client,
+                                args=(fs, dispatch, dirs, files, ratio,
+                                      deadline, results, seed))
+                    for seed in range(clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    getattrs = [value for result in results for value in result[0]]
+    readdirs = [value for result in results for value in result[1]]
+    return getattrs, readdirs
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--fsdb', dest='fsdb',
+                      help='F-Spot database to benchmark')
+    parser.add_option('-t', '--threads', dest='threads', default='1,2,4,8',
+                      help='Comma separated FUSE threads counts' \
+                           ' (default 1,2,4,8)')
+    parser.add_option('-n', '--clients', dest='clients', type='int',
+                      default=8, help='Concurrent clients (default 8)')
+    parser.add_option('-s', '--seconds', dest='seconds', type='float',
+                      default=5.0, help='Seconds per run (default 5)')
+    parser.add_option('-r', '--ratio', dest='ratio', type='float',
+                      default=0.1, help='Ratio of readdir calls (default 0.1)')
+    parser.add_option('-c', '--cache-size', dest='cache_size', type='int',
+                      default=0, help='Directory listings cache size' \
+                                      ' (default 0, always query)')
+    parser.add_option('--postings', action='store_true', dest='postings',
+                      help='Use in-memory postings engine')
+    opts, args = parser.parse_args()
+    if not opts.fsdb:
+        parser.error('F-Spot database is needed')
+
+    counts = [int(value) for value in opts.threads.split(',')]
+    fs = build_fs(opts.fsdb, pool_size=max(counts), refresh=0,
+                  cache_size=opts.cache_size, postings=opts.postings)
+    dirs, files = tree_paths(fs, max_files=10000)
+    print 'directories: %d, files: %d' % (len(dirs), len(files))
+
+    for threads in counts:
+        getattrs, readdirs = run_clients(fs, threads, opts.clients, dirs,
+                                         files, opts.ratio, opts.seconds)
+        print '%d threads: %.1f ops/s' % (threads, (len(getattrs) +
+                                                    len(readdirs)) /
+                                                   opts.seconds)
+        print_summary('  getattr', getattrs, sys.stdout)
+        print_summary('  readdir', readdirs, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Synthetic F-Spot database generator, writes a schema v17 photos.db with
+random photos, versions and tags hierarchy, and optionally stub image
+files in a collection directory:
+
+    $ python -m benchmarks.generate -d photos.db -n 10000 -c /tmp/photos
+"""
+import os, time, random, sqlite3, hashlib
+from struct import pack
+from optparse import OptionParser
+from os.path import join, isdir, exists
+
+DB_VERSION = '17'
+FSPOT_VERSION = '0.6.1.5'
+EPOCH = time.mktime((2000, 1, 1, 0, 0, 0, 0, 0, -1)) # photos taken since
+PERIOD = 10 * 365 * 24 * 3600 # photos taken over a decade
+BATCH = 10000 # rows inserted per executemany
+
+SCHEMA = (
+    'CREATE TABLE photos (id INTEGER PRIMARY KEY NOT NULL,'
+    ' time INTEGER NOT NULL, base_uri STRING NOT NULL,'
+    ' filename STRING NOT NULL, description TEXT NOT NULL,'
+    ' roll_id INTEGER NOT NULL, default_version_id INTEGER NOT NULL,'
+    ' rating INTEGER NULL, md5_sum TEXT NULL)',
+    'CREATE TABLE photo_versions (photo_id INTEGER, version_id INTEGER,'
+    ' name STRING, base_uri STRING NOT NULL, filename STRING NOT NULL,'
+    ' md5_sum TEXT NULL, protected BOOLEAN,'
+    ' UNIQUE (photo_id, version_id))',
+    'CREATE TABLE tags (id INTEGER PRIMARY KEY NOT NULL, name TEXT UNIQUE,'
+    ' category_id INTEGER, is_category BOOLEAN, sort_priority INTEGER,'
+    ' icon TEXT)',
+    'CREATE TABLE photo_tags (photo_id INTEGER, tag_id INTEGER,'
+    ' UNIQUE (photo_id, tag_id))',
+    'CREATE TABLE rolls (id INTEGER PRIMARY KEY NOT NULL,'
+    ' time INTEGER NOT NULL)',
+    'CREATE TABLE exports (id INTEGER PRIMARY KEY NOT NULL,'
+    ' image_id INTEGER NOT NULL, image_version_id INTEGER NOT NULL,'
+    ' export_type TEXT NOT NULL, export_token TEXT NOT NULL)',
+    'CREATE TABLE jobs (id INTEGER PRIMARY KEY NOT NULL,'
+    ' job_type TEXT NOT NULL, job_options TEXT NOT NULL,'
+    ' run_at INTEGER, job_priority INTEGER NOT NULL)',
+    'CREATE TABLE meta (id INTEGER PRIMARY KEY NOT NULL,'
+    ' name TEXT UNIQUE NOT NULL, data TEXT)',
+    'CREATE INDEX idx_photo_versions_id ON photo_versions(photo_id)',
+    'CREATE INDEX idx_photos_roll_id ON photos(roll_id)',
+    'CREATE INDEX idx_photo_tags_tag ON photo_tags(tag_id)',
+    'CREATE INDEX idx_photo_tags_photo ON photo_tags(photo_id)',
+)
+
+
+def stub_jpeg(date, serial):
+    """Return a minimal JPEG stream with exif DateTime @date (unix time)
+    and @serial in a comment segment, this way every stub has different
+    contents."""
+    value = time.strftime('%Y:%m:%d %H:%M:%S', time.localtime(date)) + '\0'
+    # little endian TIFF header, one IFD entry pointing to value
+    tiff = 'II*\0' + pack('<I', 8) + pack('<H', 1) + \
+           pack('<HHII', 0x0132, 2, len(value), 26) + pack('<I', 0) + value
+    exif = 'Exif\0\0' + tiff
+    comment = 'fspotfs stub %d' % serial
+    return '\xff\xd8' + \
+           '\xff\xe1' + pack('>H', len(exif) + 2) + exif + \
+           '\xff\xfe' + pack('>H', len(comment) + 2) + comment + \
+           '\xff\xd9'
+
+
+def tag_rows(rand, count, depth):
+    """Return (id, name, parent id) rows for @count tags arranged in
+    @depth levels, every tag has a parent in the previous level (root
+    tag 0 for first level)."""
+    depth = max(depth, 1)
+    per_level = max(count // depth, 1)
+    levels, rows = {}, []
+    for tag_id in xrange(1, count + 1):
+        level = min((tag_id - 1) // per_level, depth - 1)
+        parent = rand.choice(levels[level - 1]) if level else 0
+        levels.setdefault(level, []).append(tag_id)
+        rows.append((tag_id, 'tag%04d' % tag_id, parent))
+    return rows
+
+
+def photo_rows(rand, count, root):
+    """Yield (id, time, base_uri, filename) rows for @count photos,
+    located by date in @root collection directory."""
+    for photo_id in xrange(1, count + 1):
+        value = int(EPOCH + rand.random() * PERIOD)
+        base = time.strftime('%Y/%m/%d', time.localtime(value))
+        yield (photo_id, value, 'file://%s/%s/' % (root, base),
+               'IMG_%07d.jpg' % photo_id)
+
+
+def version_name(filename, version_id):
+    """Return file name of @filename version @version_id."""
+    if version_id == 1:
+        return filename
+    return filename.replace('.jpg', '-v%d.jpg' % version_id)
+
+
+def generate(db_file, photos, versions=1, tags=50, depth=3, per_photo=2,
+             root=None, files=False, seed=0):
+    """Write a synthetic F-Spot database to @db_file with @photos photos
+    having @versions versions each (default version is the last one) and
+    @tags tags in @depth levels, @per_photo random tags on every photo.
+    Photos are located in @root collection directory, stub images are
+    written for every version if @files is set. Returns @root."""
+    rand = random.Random(seed)
+    root = os.path.abspath(root or db_file + '.collection')
+    if exists(db_file):
+        os.remove(db_file)
+    conn = sqlite3.connect(db_file)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.executemany('INSERT INTO meta (name, data) VALUES (?, ?)',
+                     [('F-Spot Version', FSPOT_VERSION),
+                      ('F-Spot Database Version', DB_VERSION)])
+    conn.execute('INSERT INTO rolls (id, time) VALUES (1, ?)',
+                 (int(time.time()),))
+    tag_list = tag_rows(rand, tags, depth)
+    conn.executemany('INSERT INTO tags (id, name, category_id, is_category,'
+                     ' sort_priority, icon) VALUES (?, ?, ?, 1, 0, NULL)',
+                     tag_list)
+    tag_ids = [row[0] for row in tag_list]
+
+    rows, vrows, trows = [], [], []
+    def flush():
+        conn.executemany('INSERT INTO photos VALUES'
+                         ' (?, ?, ?, ?, \'\', 1, ?, 0, ?)', rows)
+        conn.executemany('INSERT INTO photo_versions VALUES'
+                         ' (?, ?, ?, ?, ?, ?, 0)', vrows)
+        conn.executemany('INSERT INTO photo_tags VALUES (?, ?)', trows)
+        del rows[:], vrows[:], trows[:]
+
+    for photo_id, value, base_uri, filename in photo_rows(rand, photos, root):
+        directory = base_uri.replace('file://', '')
+        if files and not isdir(directory):
+            os.makedirs(directory)
+        for version_id in xrange(1, versions + 1):
+            name = version_name(filename, version_id)
+            content = stub_jpeg(value, photo_id * 100 + version_id)
+            md5_sum = hashlib.md5(content).hexdigest()
+            if files:
+                with open(join(directory, name), 'wb') as out:
+                    out.write(content)
+            if version_id == 1:
+                rows.append((photo_id, value, base_uri, filename, versions,
+                             md5_sum))
+            vrows.append((photo_id, version_id,
+                          'Original' if version_id == 1 else
+                          'Modified %d' % (version_id - 1),
+                          base_uri, name, md5_sum))
+        for tag_id in rand.sample(tag_ids, min(per_photo, len(tag_ids))):
+            trows.append((photo_id, tag_id))
+        if len(rows) >= BATCH:
+            flush()
+    flush()
+    conn.commit()
+    conn.close()
+    return root
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--fsdb', dest='fsdb',
+                      help='F-Spot database to write (replaced if exists)')
+    parser.add_option('-n', '--photos', dest='photos', type='int',
+                      default=1000, help='Number of photos (default 1000)')
+    parser.add_option('-v', '--versions', dest='versions', type='int',
+                      default=1, help='Versions per photo (default 1)')
+    parser.add_option('-t', '--tags', dest='tags', type='int', default=50,
+                      help='Number of tags (default 50)')
+    parser.add_option('--depth', dest='depth', type='int', default=3,
+                      help='Tags hierarchy depth (default 3)')
+    parser.add_option('-p', '--per-photo', dest='per_photo', type='int',
+                      default=2, help='Tags per photo (default 2)')
+    parser.add_option('-c', '--collection', dest='root',
+                      help='Collection directory (default database path' \
+                           ' plus .collection)')
+    parser.add_option('-f', '--files', action='store_true', dest='files',
+                      help='Write stub image files (default False)')
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=0,
+                      help='Random seed (default 0)')
+    opts, args = parser.parse_args()
+    if not opts.fsdb:
+        parser.error('F-Spot database is needed')
+    if opts.versions < 1:
+        parser.error('At least one version per photo is needed')
+
+    start = time.time()
+    root = generate(opts.fsdb, opts.photos, opts.versions, opts.tags,
+                    opts.depth, opts.per_photo, opts.root, opts.files,
+                    opts.seed)
+    print 'Generated %d photos, %d tags in %.1fs, collection at %s' % \
+          (opts.photos, opts.tags, time.time() - start, root)
+
+
+if __name__ == '__main__':
+    main()
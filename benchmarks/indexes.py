@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Lookup indexes benchmark, shows query plans and latencies of the hot
+fspotdb queries before and after adding fspotdb.INDEXES to a copy of
+the database (or a generated one):
+
+    $ python -m benchmarks.indexes -n 100000
+    $ python -m benchmarks.indexes -d photos.db
+"""
+import sys, time, shutil, sqlite3, tempfile
+from optparse import OptionParser
+from os.path import join
+
+from fspotfs.fspotdb import INDEXES
+
+from .generate import generate
+from .util import print_summary
+
+VERSION_JOIN = 'JOIN photo_versions' \
+               ' ON photo_versions.version_id = photos.default_version_id' \
+               ' AND photo_versions.photo_id = photos.id'
+
+# (title, SQL, parameters builder) same statements fspotdb builds
+QUERIES = (
+    ('photo by filename',
+     'SELECT photos.id FROM photos WHERE photos.filename = ?',
+     lambda row: (row['filename'],)),
+    ('Photo.by_tag',
+     'SELECT photos.id, photo_versions.filename FROM photos ' +
+     VERSION_JOIN + ' JOIN photo_tags ON photo_tags.tag_id = ?' \
+     ' AND photo_tags.photo_id = photos.id',
+     lambda row: (row['tag_id'],)),
+    ('Photo.index_rows(names)',
+     'SELECT photos.id, photos.base_uri, photos.filename,' \
+     ' photo_versions.base_uri, photo_versions.filename FROM photos ' +
+     VERSION_JOIN + ' WHERE photo_versions.filename IN (?)',
+     lambda row: (row['filename'],)),
+    ('PhotoTag.tag_photos',
+     'SELECT photo_tags.photo_id FROM photo_tags' \
+     ' WHERE photo_tags.tag_id = ? AND photo_tags.photo_id IN (?)',
+     lambda row: (row['tag_id'], row['photo_id'])),
+)
+
+
+def samples(conn, count):
+    """Return @count random (filename, tag_id, photo_id) dicts."""
+    rows = conn.execute('SELECT photos.filename, photo_tags.tag_id,'
+                        ' photos.id FROM photos JOIN photo_tags'
+                        ' ON photo_tags.photo_id = photos.id'
+                        ' ORDER BY RANDOM() LIMIT ?', (count,)).fetchall()
+    return [{'filename': filename, 'tag_id': tag_id, 'photo_id': photo_id}
+                for filename, tag_id, photo_id in rows]
+
+
+def run_queries(conn, rows, out):
+    """Print plan and latencies of every query for sample @rows."""
+    for title, sql, params in QUERIES:
+        plan = conn.execute('EXPLAIN QUERY PLAN ' + sql,
+                            params(rows[0])).fetchall()
+        latencies = []
+        for row in rows:
+            start = time.time()
+            conn.execute(sql, params(row)).fetchall()
+            latencies.append(time.time() - start)
+        print_summary('  ' + title, latencies, out)
+        for detail in plan:
+            print >>out, '      %s' % detail[-1]
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--fsdb', dest='fsdb',
+                      help='F-Spot database to benchmark, a copy is used' \
+                           ' (default generate a synthetic database)')
+    parser.add_option('-n', '--photos', dest='photos', type='int',
+                      default=100000, help='Photos in generated database' \
+                                           ' (default 100000)')
+    parser.add_option('-c', '--calls', dest='calls', type='int',
+                      default=100, help='Calls per query (default 100)')
+    opts, args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='fspotfs-bench-')
+    try:
+        db_file = join(workdir, 'photos.db')
+        if opts.fsdb:
+            shutil.copy(opts.fsdb, db_file)
+        else:
+            generate(db_file, opts.photos)
+        conn = sqlite3.connect(db_file)
+        rows = samples(conn, opts.calls)
+        if not rows:
+            parser.error('No tagged photos in database')
+
+        print 'before:'
+        run_queries(conn, rows, sys.stdout)
+        for name, table, columns in INDEXES:
+            conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' %
+                         (name, table, columns))
+        conn.commit()
+        print 'after:'
+        run_queries(conn, rows, sys.stdout)
+        conn.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Kernel cache benchmark, mounts a synthetic database (or a copy of an
+existing one) with kernel caching disabled and with the given timeouts,
+and reports system calls latencies (stat, lstat of missing names and
+listdir) through the mountpoint. Needs FUSE and fusermount:
+
+    $ python -m benchmarks.kernel -n 100000
+    $ python -m benchmarks.kernel -d photos.db --timeouts 10,10,2
+"""
+import os, sys, time, errno, random, shutil, tempfile, subprocess
+from optparse import OptionParser
+from os.path import join, ismount
+
+from .generate import generate
+from .util import print_summary
+
+PROBES = ('.hidden', '.directory', 'desktop.ini', 'Thumbs.db', '.git',
+          'autorun.inf')
+MOUNT_WAIT = 30 # seconds to wait for mount
+
+
+def mount(db_file, mountpoint, timeouts):
+    """Mount @db_file in @mountpoint with kernel (entry, attr, negative)
+    @timeouts, the server goes to background once mounted."""
+    entry, attr, negative = timeouts
+    subprocess.check_call([sys.executable, '-c',
+                           'from fspotfs.fspotfs import run; run()',
+                           '-d', db_file, '-m', mountpoint,
+                           '--entry-timeout', str(entry),
+                           '--attr-timeout', str(attr),
+                           '--negative-timeout', str(negative)])
+    deadline = time.time() + MOUNT_WAIT
+    while not ismount(mountpoint):
+        if time.time() > deadline:
+            raise RuntimeError('%s not mounted' % mountpoint)
+        time.sleep(0.1)
+
+
+def umount(mountpoint):
+    """Unmount @mountpoint."""
+    subprocess.call(['fusermount', '-u', mountpoint])
+
+
+def walk(mountpoint, max_files):
+    """Return (directories, files) paths under @mountpoint."""
+    dirs, files = [], []
+    for path, names, filenames in os.walk(mountpoint):
+        names[:] = [name for name in names if not name.startswith(('.', '+'))
+                                                and name != 'by-date']
+        dirs.append(path)
+        files.extend(join(path, name) for name in filenames[:max_files])
+    return dirs, files
+
+
+def timed_calls(func, args):
+    """Return latencies of @func called with every value in @args,
+    missing paths errors are ignored."""
+    latencies = []
+    for arg in args:
+        start = time.time()
+        try:
+            func(arg)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run_calls(mountpoint, calls, rand, out):
+    """Print system calls latencies through @mountpoint."""
+    dirs, files = walk(mountpoint, 1000)
+    print >>out, '  directories: %d, files: %d' % (len(dirs), len(files))
+    if files:
+        print_summary('  stat (file)', timed_calls(os.lstat,
+                          [rand.choice(files) for i in xrange(calls)]), out)
+    print_summary('  stat (dir)', timed_calls(os.lstat,
+                      [rand.choice(dirs) for i in xrange(calls)]), out)
+    print_summary('  stat (missing)', timed_calls(os.lstat,
+                      [join(rand.choice(dirs), rand.choice(PROBES))
+                            for i in xrange(calls)]), out)
+    print_summary('  listdir', timed_calls(os.listdir,
+                      [rand.choice(dirs) for i in xrange(calls)]), out)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--fsdb', dest='fsdb',
+                      help='F-Spot database to benchmark, a copy is used' \
+                           ' (default generate a synthetic database)')
+    parser.add_option('-n', '--photos', dest='photos', type='int',
+                      default=100000, help='Photos in generated database' \
+                                           ' (default 100000)')
+    parser.add_option('-c', '--calls', dest='calls', type='int',
+                      default=2000, help='Calls per system call' \
+                                         ' (default 2000)')
+    parser.add_option('--timeouts', dest='timeouts', default='5,5,1',
+                      help='Comma separated entry, attr and negative' \
+                           ' timeouts compared with 0,0,0 (default 5,5,1)')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='Random seed (default 0)')
+    opts, args = parser.parse_args()
+    timeouts = tuple(float(value) for value in opts.timeouts.split(','))
+    if len(timeouts) != 3:
+        parser.error('Three timeouts are needed')
+
+    workdir = tempfile.mkdtemp(prefix='fspotfs-bench-')
+    mountpoint = join(workdir, 'mount')
+    os.mkdir(mountpoint)
+    try:
+        db_file = join(workdir, 'photos.db')
+        if opts.fsdb:
+            shutil.copy(opts.fsdb, db_file)
+        else:
+            generate(db_file, opts.photos, root=join(workdir, 'collection'))
+        for values in ((0, 0, 0), timeouts):
+            print 'entry_timeout=%g attr_timeout=%g negative_timeout=%g:' % \
+                  values
+            mount(db_file, mountpoint, values)
+            try:
+                run_calls(mountpoint, opts.calls, random.Random(opts.seed),
+                          sys.stdout)
+            finally:
+                umount(mountpoint)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
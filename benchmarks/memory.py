@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Listing memory benchmark, compares peak memory and time of the ORM
+photos queries (mapped Photo and PhotoVersion instances) against the
+column records path used by directory listings. Every case runs in a
+forked process, this way peaks are not hidden by previous cases:
+
+    $ python -m benchmarks.memory -n 200000
+    $ python -m benchmarks.memory -d photos.db
+"""
+import os, time, shutil, sqlite3, marshal, resource, tempfile
+from optparse import OptionParser
+from os.path import join
+
+from fspotfs.fspotdb import init_session, Photo, Tag, update_with_version
+
+from .generate import generate
+
+
+def busiest_tag(db_file):
+    """Return (tag id, sub-tags ids) of tag with most photos or None."""
+    conn = sqlite3.connect(db_file)
+    try:
+        row = conn.execute('SELECT tag_id FROM photo_tags GROUP BY tag_id'
+                           ' ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+        if row is None:
+            return None
+        subtag_ids = [subtag_id for subtag_id, in
+                        conn.execute('SELECT id FROM tags'
+                                     ' WHERE category_id = ?', row)]
+        return row[0], subtag_ids
+    finally:
+        conn.close()
+
+
+def cases(tag):
+    """Return (title, ORM call, records call) for listing paths, tag
+    paths use @tag (tag id, sub-tags ids)."""
+    result = [('all photos', Photo.all_photos, Photo.all_records),
+              ('untagged', Tag.untagged_photos, Tag.untagged_records)]
+    if tag is not None:
+        tag_id, subtag_ids = tag
+        result += [('own photos', lambda: Tag.get(tag_id).own_photos(),
+                    lambda: Tag.own_records(tag_id, subtag_ids)),
+                   ('tag photos',
+                    lambda: update_with_version(Photo.by_tag(tag_id)),
+                    lambda: Photo.tag_records(tag_id))]
+    return result
+
+
+def measure(db_file, func):
+    """Run @func in a forked process the way listings consume it, return
+    (peak memory growth in KiB, seconds, photos). Database is opened by
+    the child, no connection is shared across fork."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        init_session('sqlite:///' + db_file)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        names = tuple(photo.filename for photo in func())
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, marshal.dumps((peak - before, elapsed,
+                                          len(names))))
+        os._exit(0)
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return marshal.loads(data)
+
+
+def benchmark(db_file):
+    """Print ORM and records figures for every listing path."""
+    for title, orm, records in cases(busiest_tag(db_file)):
+        print '%s:' % title
+        for name, func in (('orm', orm), ('records', records)):
+            growth, elapsed, count = measure(db_file, func)
+            print '  %-8s photos=%-8d peak=+%8.1fMiB time=%8.3fs' % \
+                  (name, count, growth / 1024.0, elapsed)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--fsdb', dest='fsdb',
+                      help='F-Spot database to benchmark, a copy is used' \
+                           ' (default generate a synthetic database)')
+    parser.add_option('-n', '--photos', dest='photos', type='int',
+                      default=200000, help='Photos in generated database' \
+                                           ' (default 200000)')
+    parser.add_option('-v', '--versions', dest='versions', type='int',
+                      default=1, help='Versions per photo (default 1)')
+    parser.add_option('-t', '--tags', dest='tags', type='int', default=10,
+                      help='Number of tags (default 10)')
+    opts, args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='fspotfs-bench-')
+    try:
+        db_file = join(workdir, 'photos.db')
+        if opts.fsdb:
+            shutil.copy(opts.fsdb, db_file)
+        else:
+            generate(db_file, opts.photos, opts.versions, opts.tags,
+                     root=join(workdir, 'collection'))
+        benchmark(db_file)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Filesystem operations benchmark, calls getattr, readdir, readlink,
+mkdir, symlink and release handlers of a FSpotFSWrite instance over
+synthetic databases of every size given (or a copy of an existing
+database), reports latencies and SQL statements per call:
+
+    $ python -m benchmarks.operations -s 1000,10000,100000,1000000
+    $ python -m benchmarks.operations -d photos.db
+"""
+import os, sys, time, random, shutil, tempfile
+from optparse import OptionParser
+from os.path import join, basename
+
+from fspotfs.fspotfs import FSpotFSWrite
+from fspotfs.fspotdb import close_sessions
+
+from .util import build_fs, tree_paths, print_summary, timed, QueryCounter
+from .generate import generate, stub_jpeg
+
+SIZES = '1000,10000,100000,1000000'
+
+
+def measure(counter, func, calls):
+    """Call @func with every arguments tuple in @calls, return
+    (latencies, SQL statements executed or None) using @counter (a
+    QueryCounter)."""
+    before = counter.count
+    latencies = []
+    for args in calls:
+        start = time.time()
+        func(*args)
+        latencies.append(time.time() - start)
+        close_sessions()
+    return latencies, (counter.count - before if before is not None else None)
+
+
+def list_dir(fs, path):
+    """Consume @path directory listing."""
+    for entry in fs.readdir(path, 0):
+        pass
+
+
+def run_operations(fs, counter, calls, rand, out):
+    """Benchmark every handler with @calls calls each, results are
+    printed to @out."""
+    dirs, files = tree_paths(fs, max_files=10000)
+    tag_dirs = [path for path in dirs if path != '/'] or ['/']
+    print >>out, 'directories: %d, files: %d' % (len(dirs), len(files))
+
+    def report(title, func, args):
+        latencies, queries = measure(counter, func, args)
+        print_summary('  ' + title, latencies, out, queries)
+
+    report('getattr (file)', fs.getattr,
+           [(rand.choice(files),) for i in xrange(calls)] if files else [])
+    report('getattr (dir)', fs.getattr,
+           [(rand.choice(dirs),) for i in xrange(calls)])
+    report('readdir', lambda path: list_dir(fs, path),
+           [(rand.choice(dirs),) for i in xrange(calls)])
+    report('readlink', fs.readlink,
+           [(rand.choice(files),) for i in xrange(calls)] if files else [])
+
+    stamp = int(time.time())
+    report('mkdir', fs.mkdir,
+           [(join(rand.choice(dirs), 'bench-%d-%d' % (stamp, i)), 0755)
+                for i in xrange(calls)])
+
+    links = []
+    for i in xrange(calls if files else 0):
+        source = fs.readlink(rand.choice(files))
+        links.append((source, join(rand.choice(tag_dirs), basename(source))))
+    report('symlink', fs.symlink, links)
+
+    # files are created and written before timing release
+    releases = []
+    for i in xrange(calls):
+        path = join(rand.choice(tag_dirs), 'bench-%d-%d.jpg' % (stamp, i))
+        handle = fs.create(path, os.O_WRONLY | os.O_CREAT, 0644)
+        content = stub_jpeg(stamp, stamp * calls + i)
+        fs.write(path, content, 0, handle)
+        releases.append((path, os.O_WRONLY, handle))
+    close_sessions()
+    report('release', fs.release, releases)
+
+
+def benchmark(db_file, root, opts, out):
+    """Benchmark filesystem for @db_file with @root collection."""
+    elapsed, fs = timed(build_fs, db_file, FSpotFSWrite, 4, refresh=0,
+                        cache_size=opts.cache_size, postings=opts.postings,
+                        collection_root=root)
+    print >>out, 'startup: %.3fs' % elapsed
+    try:
+        run_operations(fs, QueryCounter(), opts.calls,
+                       random.Random(opts.seed), out)
+    finally:
+        fs.fsdestroy()
+        close_sessions()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--fsdb', dest='fsdb',
+                      help='F-Spot database to benchmark, a copy is used' \
+                           ' (default generate synthetic databases)')
+    parser.add_option('-s', '--sizes', dest='sizes', default=SIZES,
+                      help='Comma separated photos counts of generated' \
+                           ' databases (default %s)' % SIZES)
+    parser.add_option('-n', '--calls', dest='calls', type='int',
+                      default=200, help='Calls per operation (default 200)')
+    parser.add_option('-v', '--versions', dest='versions', type='int',
+                      default=1, help='Versions per photo (default 1)')
+    parser.add_option('-t', '--tags', dest='tags', type='int', default=50,
+                      help='Number of tags (default 50)')
+    parser.add_option('--depth', dest='depth', type='int', default=3,
+                      help='Tags hierarchy depth (default 3)')
+    parser.add_option('-p', '--per-photo', dest='per_photo', type='int',
+                      default=2, help='Tags per photo (default 2)')
+    parser.add_option('-c', '--cache-size', dest='cache_size', type='int',
+                      default=0, help='Directory listings cache size' \
+                                      ' (default 0, always query)')
+    parser.add_option('--postings', action='store_true', dest='postings',
+                      help='Use in-memory postings engine')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='Random seed (default 0)')
+    opts, args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='fspotfs-bench-')
+    try:
+        root = join(workdir, 'collection')
+        db_file = join(workdir, 'photos.db')
+        if opts.fsdb:
+            shutil.copy(opts.fsdb, db_file)
+            print '%s:' % opts.fsdb
+            benchmark(db_file, root, opts, sys.stdout)
+            return
+        for size in [int(value) for value in opts.sizes.split(',')]:
+            elapsed, root = timed(generate, db_file, size, opts.versions,
+                                  opts.tags, opts.depth, opts.per_photo,
+                                  root, False, opts.seed)
+            print '%d photos (generated in %.1fs):' % (size, elapsed)
+            benchmark(db_file, root, opts, sys.stdout)
+            shutil.rmtree(root, ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
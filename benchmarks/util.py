@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import time
+from os.path import join
+
+from fspotfs.fspotfs import FSpotFS, fuse
+from fspotfs import fspotdb
+from fspotfs.fspotdb import init_session
+
+try:
+    from sqlalchemy import event
+except ImportError: # SQLAlchemy < 0.7, no queries counting
+    event = None
+
+
+def percentile(values, pct):
+    """Return @pct percentile of sorted @values."""
+    if not values:
+        return 0.0
+    pos = int(round((len(values) - 1) * pct / 100.0))
+    return values[pos]
+
+
+def summary(latencies):
+    """Return (count, p50, p90, p99, max) for @latencies in milliseconds."""
+    values = sorted(latencies)
+    return (len(values), percentile(values, 50) * 1000,
+            percentile(values, 90) * 1000, percentile(values, 99) * 1000,
+            (values[-1] if values else 0.0) * 1000)
+
+
+def print_summary(title, latencies, out, queries=None):
+    """Print latencies summary line, followed by SQL statements per call
+    if @queries (total statements executed) is given."""
+    line = '%-24s n=%-8d p50=%8.3fms p90=%8.3fms p99=%8.3fms' \
+           ' max=%8.3fms' % ((title,) + summary(latencies))
+    if queries is not None:
+        line += ' sql/op=%.2f' % (float(queries) / max(len(latencies), 1))
+    print >>out, line
+
+
+def timed(func, *args, **kwargs):
+    """Call @func with @args and @kwargs, return (elapsed seconds,
+    result)."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def build_fs(db_file, klass=FSpotFS, pool_size=4, **kwargs):
+    """Initializes database sessions and returns a @klass filesystem
+    instance for @db_file."""
+    fuse.fuse_python_api = (0, 2)
+    init_session('sqlite:///' + db_file, pool_size=pool_size)
+    return klass(db_file, kwargs.pop('repeated', False), **kwargs)
+
+
+def tree_paths(fs, max_files=None):
+    """Return (directories, files) paths in @fs hierarchy."""
+    dirs, files = ['/'], []
+    pending = ['/']
+    while pending:
+        path = pending.pop()
+        for entry in fs.readdir(path, 0):
+            if entry.name in ('.', '..'):
+                continue
+            child = join(path, entry.name)
+            if entry.type:
+                if max_files is None or len(files) < max_files:
+                    files.append(child)
+            elif child not in dirs:
+                dirs.append(child)
+                pending.append(child)
+    return dirs, files
+
+
+class QueryCounter(object):
+    """Counts SQL statements executed by fspotdb engines (read and write
+    ones), count is None if SQLAlchemy doesn't support events. Must be
+    attached after init_session()."""
+    def __init__(self):
+        self.count = 0 if event is not None else None
+        if event is not None:
+            for engine in (fspotdb._engine, fspotdb._reader):
+                event.listen(engine, 'after_cursor_execute', self.executed)
+
+    def executed(self, *args):
+        self.count += 1
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""F-SpotFS correctness checks. Filesystem handlers and commands are run
+against databases written by benchmarks.generate, results are compared
+with what the database holds. Each check exits with status 1 if any
+difference is found. Run them as modules from source tree root, like:
+
+    $ python -m checks.postings --help
+"""
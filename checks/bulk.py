@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Bulk tagging check, generates a database with some non-ASCII file names
+(plain and quoted as F-Spot does) and runs `fsfs tag` and `fsfs untag`
+over every photo path, verifies every photo was tagged and then untagged
+in database. Exits with status 1 if any photo was missed:
+
+    $ python -m checks.bulk -n 20000
+"""
+import sys, shutil, sqlite3, tempfile
+from StringIO import StringIO
+from optparse import OptionParser
+from os.path import join
+
+from fspotfs.fspotfs import bulk
+from fspotfs.fspotdb import uri_path, close_sessions
+
+from benchmarks.generate import generate
+from .postings import prepare
+
+TAG_NAME = u'Bulk ñandú'
+
+
+def photo_paths(db_file):
+    """Return photos paths (utf-8 encoded) -> photo id mapping of
+    @db_file, taken from default versions."""
+    conn = sqlite3.connect(db_file)
+    try:
+        return dict((uri_path(base_uri, filename), photo_id)
+                        for photo_id, base_uri, filename in conn.execute(
+                            'SELECT photos.id, photo_versions.base_uri,'
+                            ' photo_versions.filename FROM photos'
+                            ' JOIN photo_versions'
+                            ' ON photo_versions.photo_id = photos.id'
+                            ' AND photo_versions.version_id ='
+                            ' photos.default_version_id'))
+    finally:
+        conn.close()
+
+
+def tagged(db_file, tag_id):
+    """Return ids of photos tagged by @tag_id in @db_file."""
+    conn = sqlite3.connect(db_file)
+    try:
+        return set(photo_id for photo_id, in conn.execute(
+                        'SELECT photo_id FROM photo_tags WHERE tag_id = ?',
+                        (tag_id,)))
+    finally:
+        conn.close()
+
+
+def run_command(command, db_file, paths, out):
+    """Run `fsfs @command` over @paths, its report is printed to @out."""
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin = StringIO(''.join(value + '\n' for value in paths))
+    sys.stdout = out
+    try:
+        bulk(command, ['-d', db_file, TAG_NAME.encode('utf-8')])
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+        close_sessions()
+
+
+def check(db_file, expected, out):
+    """Tag and untag @expected photos paths, returns number of photos
+    missed by any of both commands."""
+    conn = sqlite3.connect(db_file)
+    try:
+        tag_id = conn.execute('INSERT INTO tags (name, category_id,'
+                              ' is_category, sort_priority) VALUES'
+                              ' (?, 0, 1, 0)', (TAG_NAME,)).lastrowid
+        conn.commit()
+    finally:
+        conn.close()
+    photo_ids = set(expected.values())
+
+    run_command('tag', db_file, expected.keys(), out)
+    missed = photo_ids - tagged(db_file, tag_id)
+    print >>out, 'tag: %d photos, %d not tagged' % (len(photo_ids),
+                                                    len(missed))
+
+    run_command('untag', db_file, expected.keys(), out)
+    left = tagged(db_file, tag_id)
+    print >>out, 'untag: %d photos, %d still tagged' % (len(photo_ids),
+                                                        len(left))
+    return len(missed) + len(left)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--photos', dest='photos', type='int',
+                      default=20000, help='Photos in generated database' \
+                                          ' (default 20000)')
+    parser.add_option('-v', '--versions', dest='versions', type='int',
+                      default=2, help='Versions per photo (default 2)')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='Random seed (default 0)')
+    opts, args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='fspotfs-check-')
+    try:
+        db_file = join(workdir, 'photos.db')
+        generate(db_file, opts.photos, opts.versions,
+                 root=join(workdir, 'collection'), seed=opts.seed)
+        non_ascii = prepare(db_file, opts.seed)
+        expected = photo_paths(db_file)
+        print 'photos: %d, non-ASCII file names: %d' % \
+              (len(expected), len([value for value in expected
+                                        if value in non_ascii]))
+        failed = check(db_file, expected, sys.stdout)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Postings check, generates a database and verifies that listings served
+from in-memory postings are the same photos (and file names) returned by
+the SQL queries (Tag.own_photos, Tag.untagged_photos, Photo.by_tag and
+Photo.all_photos) for every tag, with and without repeated mode. Photos
+with non-ASCII file names are looked up by path too (Photo.ids_by_path).
+Exits with status 1 if any difference is found:
+
+    $ python -m checks.postings -n 20000
+"""
+import sys, random, shutil, sqlite3, tempfile
+from optparse import OptionParser
+from os.path import join
+from urllib import quote
+
+from fspotfs.fspotfs import ROOT_ID
+from fspotfs.fspotdb import Photo, Tag, update_with_version, \
+                            close_sessions, encode
+
+from benchmarks.generate import generate
+from benchmarks.util import build_fs
+
+UNTAGGED_EVERY = 10 # every 10th photo loses its tags
+PARENT_EVERY = 7    # every 7th photo is tagged by a tag and its parent
+NON_ASCII = 20      # photos renamed with non-ASCII file names
+
+
+def prepare(db_file, seed=0):
+    """Make generated @db_file cover listings corner cases (untagged
+    photos, photos tagged by a tag and its parent) and rename NON_ASCII
+    photos with non-ASCII file names, half of them quoted as F-Spot does.
+    Returns expected paths (utf-8 encoded) -> photo id mapping."""
+    rand = random.Random(seed)
+    conn = sqlite3.connect(db_file)
+    try:
+        parents = dict(conn.execute('SELECT id, category_id FROM tags'))
+        conn.execute('DELETE FROM photo_tags WHERE photo_id % ? = 0',
+                     (UNTAGGED_EVERY,))
+        rows = conn.execute('SELECT photo_id, tag_id FROM photo_tags'
+                            ' WHERE photo_id % ? = 0',
+                            (PARENT_EVERY,)).fetchall()
+        conn.executemany('INSERT OR IGNORE INTO photo_tags VALUES (?, ?)',
+                         [(photo_id, parents[tag_id]) for photo_id, tag_id
+                            in rows if parents.get(tag_id)])
+
+        expected = {}
+        photos = conn.execute('SELECT id, base_uri, default_version_id'
+                              ' FROM photos').fetchall()
+        for photo_id, base_uri, version_id in rand.sample(photos,
+                                                min(NON_ASCII, len(photos))):
+            name = 'Espa\xc3\xb1a ni\xc3\xb1o %d.jpg' % photo_id
+            value = quote(name) if photo_id % 2 else name.decode('utf-8')
+            conn.execute('UPDATE photos SET filename = ? WHERE id = ?',
+                         (value, photo_id))
+            conn.execute('UPDATE photo_versions SET filename = ?'
+                         ' WHERE photo_id = ? AND version_id = ?',
+                         (value, photo_id, version_id))
+            expected[encode(base_uri).replace('file://', '') + name] = \
+                photo_id
+        conn.commit()
+        return expected
+    finally:
+        conn.close()
+
+
+def sql_names(photos):
+    """Return (id, file name) pairs set of @photos mapped instances."""
+    return set((photo.id, encode(photo.filename)) for photo in photos)
+
+
+def compare(title, postings, sql, out):
+    """Print differences between @postings and @sql pairs, returns True
+    if they're the same."""
+    postings = set(postings)
+    if postings == sql:
+        return True
+    print >>out, '  %s: %d only in postings %s, %d only in SQL %s' % \
+                 (title, len(postings - sql), sorted(postings - sql)[:5],
+                  len(sql - postings), sorted(sql - postings)[:5])
+    return False
+
+
+def check(db_file, repeated, out):
+    """Compare postings and SQL listings of every tag, returns number of
+    listings that differ."""
+    fs = build_fs(db_file, postings=True, repeated=repeated, refresh=0)
+    failed = 0
+    try:
+        listings = [('all photos', None, Photo.all_photos),
+                    ('untagged', ROOT_ID, Tag.untagged_photos)]
+        for tag in Tag.all():
+            if repeated:
+                query = lambda tag_id=tag.id: \
+                            update_with_version(Photo.by_tag(tag_id))
+            else:
+                query = lambda tag_id=tag.id: Tag.get(tag_id).own_photos()
+            listings.append((encode(tag.name), tag.id, query))
+        for title, tag_id, query in listings:
+            if not compare(title, fs._postings_names(tag_id),
+                           sql_names(query()), out):
+                failed += 1
+            close_sessions()
+    finally:
+        close_sessions()
+    print >>out, 'repeated=%s: %d listings checked, %d differ' % \
+                 (repeated, len(listings), failed)
+    return failed
+
+
+def check_paths(expected, out):
+    """Look up @expected paths by Photo.ids_by_path, returns number of
+    paths not resolved to their photo."""
+    found = Photo.ids_by_path(expected.keys())
+    close_sessions()
+    failed = [value for value, photo_id in expected.iteritems()
+                if found.get(value) != photo_id]
+    for value in failed:
+        print >>out, '  %r: expected %s, found %s' % \
+                     (value, expected[value], found.get(value))
+    print >>out, 'non-ASCII paths: %d checked, %d differ' % \
+                 (len(expected), len(failed))
+    return len(failed)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--photos', dest='photos', type='int',
+                      default=20000, help='Photos in generated database' \
+                                          ' (default 20000)')
+    parser.add_option('-v', '--versions', dest='versions', type='int',
+                      default=2, help='Versions per photo (default 2)')
+    parser.add_option('-t', '--tags', dest='tags', type='int', default=50,
+                      help='Number of tags (default 50)')
+    parser.add_option('--depth', dest='depth', type='int', default=3,
+                      help='Tags hierarchy depth (default 3)')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='Random seed (default 0)')
+    opts, args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='fspotfs-check-')
+    try:
+        db_file = join(workdir, 'photos.db')
+        generate(db_file, opts.photos, opts.versions, opts.tags, opts.depth,
+                 root=join(workdir, 'collection'), seed=opts.seed)
+        expected = prepare(db_file, opts.seed)
+        failed = 0
+        for repeated in (False, True):
+            failed += check(db_file, repeated, sys.stdout)
+        failed += check_paths(expected, sys.stdout)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import time, threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded least recently used cache with hit/miss counters. Safe to
+    use from several threads.
+
+    Every invalidation bumps a generation number, values computed while
+    an invalidation happened can be discarded by passing the generation
+    read before computing them to put()."""
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = self.misses = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return value cached for @key or @default, @key is marked as
+        most recently used."""
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        """Cache @value for @key, least recently used entries are
+        discarded when size limit is reached. Nothing is cached if
+        @generation is given and cache was invalidated since then."""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """Discard values cached for @keys."""
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.items.pop(key, None)
+
+    def clear(self):
+        """Discard every cached value."""
+        with self.lock:
+            self.generation += 1
+            self.items.clear()
+
+    def stats(self):
+        """Return cache counters as a dict."""
+        with self.lock:
+            return {'size': len(self.items), 'hits': self.hits,
+                    'misses': self.misses}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class NegativeCache(object):
+    """Bounded cache of failed lookups, remembers keys known to be
+    missing for @ttl seconds. Entries are added along a generation
+    number (like LRUCache.generation of a related cache) and are ignored
+    once it changes, this way they are dropped with that cache
+    invalidations. Hits count lookups answered without being done. Safe
+    to use from several threads."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict() # key -> (expiration time, generation)
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def missing(self, key, generation=None):
+        """Return True if @key is known to be missing."""
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                if entry[0] > time.time() and entry[1] == generation:
+                    self.hits += 1
+                    return True
+                del self.items[key]
+            self.misses += 1
+            return False
+
+    def add(self, key, generation=None):
+        """Remember @key as missing, oldest entries are discarded when
+        size limit is reached."""
+        if self.size <= 0 or self.ttl <= 0:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl, generation)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        """Forget every missing key."""
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        """Return cache counters as a dict."""
+        with self.lock:
+            return {'size': len(self.items), 'hits': self.hits,
+                    'misses': self.misses}
+
+    def __len__(self):
+        return len(self.items)
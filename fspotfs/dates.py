@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from time import mktime, localtime
+from bisect import bisect_left, insort
+
+MIN_YEAR, MAX_YEAR = 1900, 9999
+
+
+def timestamp(year, month=1, day=1):
+    """Return unix time for local midnight of @year, @month and @day,
+    out of range values are normalized (day 32 is next month first)."""
+    return mktime((year, month, day, 0, 0, 0, 0, 0, -1))
+
+
+def year_period(value):
+    """Return (year, next year start) for unix time @value."""
+    date = localtime(value)
+    return date.tm_year, timestamp(date.tm_year + 1)
+
+
+def month_period(value):
+    """Return (month, next month start) for unix time @value."""
+    date = localtime(value)
+    return date.tm_mon, timestamp(date.tm_year, date.tm_mon + 1)
+
+
+def day_period(value):
+    """Return (day, next day start) for unix time @value."""
+    date = localtime(value)
+    return date.tm_mday, timestamp(date.tm_year, date.tm_mon,
+                                   date.tm_mday + 1)
+
+
+def period(year, month=None, day=None):
+    """Return (start, end) unix times of a year, month or day period."""
+    if month is None:
+        return timestamp(year), timestamp(year + 1)
+    elif day is None:
+        return timestamp(year, month), timestamp(year, month + 1)
+    return timestamp(year, month, day), timestamp(year, month, day + 1)
+
+
+def checked_period(*values):
+    """Return period() for (year[, month[, day]]) @values or None if
+    they aren't a valid date."""
+    if not values or not MIN_YEAR <= values[0] <= MAX_YEAR:
+        return None
+    try:
+        start, end = period(*values)
+    except (OverflowError, ValueError):
+        return None
+    if tuple(localtime(start)[:len(values)]) != values:
+        return None
+    return start, end
+
+
+class DateIndex(object):
+    """Photos sorted by time (unix timestamp as in photos.time column).
+    Dates hierarchy and photos taken in a period are found by range
+    scans over the sorted (time, photo id) entries. Dates are local."""
+    def __init__(self):
+        self.entries = [] # sorted (time, photo id)
+        self.times = {}   # photo id -> time
+
+    def load(self, rows):
+        """Load (photo id, time) @rows, photos without time are
+        skipped."""
+        self.times = dict((photo_id, value) for photo_id, value in rows
+                                if value is not None)
+        self.entries = sorted((value, photo_id)
+                                for photo_id, value in self.times.iteritems())
+
+    def state(self):
+        """Return index state, see restore()."""
+        return {'entries': self.entries, 'times': self.times}
+
+    def restore(self, state):
+        """Restore index from @state returned by state()."""
+        self.entries = state['entries']
+        self.times = state['times']
+
+    def add(self, photo_id, value):
+        """Register @photo_id taken at @value time."""
+        self.remove(photo_id)
+        if value is not None:
+            self.times[photo_id] = value
+            insort(self.entries, (value, photo_id))
+
+    def remove(self, photo_id):
+        """Unregister @photo_id."""
+        value = self.times.pop(photo_id, None)
+        if value is not None:
+            pos = bisect_left(self.entries, (value, photo_id))
+            if pos < len(self.entries) and \
+               self.entries[pos] == (value, photo_id):
+                del self.entries[pos]
+
+    def between(self, start, end):
+        """Return ids of photos taken from @start until @end (excluded)
+        sorted by time."""
+        entries = self.entries
+        low = bisect_left(entries, (start,))
+        high = bisect_left(entries, (end,), low)
+        return [photo_id for value, photo_id in entries[low:high]]
+
+    def exists(self, start, end):
+        """Return True if a photo was taken from @start until @end."""
+        pos = bisect_left(self.entries, (start,))
+        return pos < len(self.entries) and self.entries[pos][0] < end
+
+    def distinct(self, start, end, period):
+        """Return values of @period function (a *_period function) for
+        photos taken from @start until @end, a range scan per value."""
+        entries = self.entries
+        values = []
+        pos = bisect_left(entries, (start,))
+        while pos < len(entries) and entries[pos][0] < end:
+            value, next_start = period(entries[pos][0])
+            values.append(value)
+            pos = bisect_left(entries, (next_start,), pos)
+        return values
+
+    def years(self):
+        """Return years with photos."""
+        return self.distinct(timestamp(MIN_YEAR), timestamp(MAX_YEAR + 1),
+                             year_period)
+
+    def months(self, year):
+        """Return months of @year with photos."""
+        return self.distinct(*period(year) + (month_period,))
+
+    def days(self, year, month):
+        """Return days of @year @month with photos."""
+        return self.distinct(*period(year, month) + (day_period,))
+
+    def photos(self, year, month, day):
+        """Return ids of photos taken in a day sorted by time."""
+        return self.between(*period(year, month, day))
+
+    def taken(self, photo_id, start, end):
+        """Return True if @photo_id was taken from @start until @end."""
+        value = self.times.get(photo_id)
+        return value is not None and start <= value < end
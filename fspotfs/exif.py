@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from struct import unpack, error as StructError
+from datetime import datetime
+
+EXIF_DATEFORMAT = '%Y:%m:%d %H:%M:%S'
+DATETIME_TAG    = 0x0132 # IFD0 DateTime tag
+HEADER_LIMIT    = 256 * 1024 # bytes inspected looking for exif data
+
+# parse results
+NEED_MORE, FOUND, MISSING = range(3)
+
+
+def tiff_datetime(data, base=0):
+    """Look for DateTime tag in TIFF structure starting at @base in
+    @data. Returns (state, value)."""
+    order = data[base:base + 2]
+    if len(order) < 2:
+        return NEED_MORE, None
+    if order == 'II':
+        fmt = '<'
+    elif order == 'MM':
+        fmt = '>'
+    else:
+        return MISSING, None
+    try:
+        magic, ifd = unpack(fmt + 'HI', data[base + 2:base + 8])
+        if magic != 42:
+            return MISSING, None
+        count, = unpack(fmt + 'H', data[base + ifd:base + ifd + 2])
+        for pos in xrange(base + ifd + 2, base + ifd + 2 + count * 12, 12):
+            tag, kind, size = unpack(fmt + 'HHI', data[pos:pos + 8])
+            if tag != DATETIME_TAG:
+                continue
+            if size <= 4:
+                value = data[pos + 8:pos + 8 + size]
+            else:
+                start, = unpack(fmt + 'I', data[pos + 8:pos + 12])
+                value = data[base + start:base + start + size]
+                if len(value) < size:
+                    return NEED_MORE, None
+            return FOUND, value.rstrip('\0 ')
+    except StructError: # truncated header
+        return NEED_MORE, None
+    return MISSING, None
+
+
+def jpeg_datetime(data):
+    """Look for DateTime tag in JPEG APP1 exif segment in @data. Returns
+    (state, value)."""
+    pos = 2
+    while True:
+        if len(data) < pos + 4:
+            return NEED_MORE, None
+        if data[pos] != '\xff':
+            return MISSING, None
+        marker = ord(data[pos + 1])
+        if marker == 0xff: # fill byte
+            pos += 1
+            continue
+        if marker in (0xd9, 0xda): # end of image or start of scan
+            return MISSING, None
+        length, = unpack('>H', data[pos + 2:pos + 4])
+        if marker == 0xe1:
+            if len(data) < pos + 2 + length:
+                return NEED_MORE, None
+            segment = data[pos + 4:pos + 2 + length]
+            if segment.startswith('Exif\0\0'):
+                state, value = tiff_datetime(segment, 6)
+                # a complete segment can't need more data
+                return (MISSING, None) if state == NEED_MORE else \
+                       (state, value)
+        pos += 2 + length
+
+
+class HeaderParser(object):
+    """Incremental image header parser. Sequential chunks are fed while
+    a file is being written, JPEG and TIFF (and TIFF based raw formats)
+    headers are recognized and their exif DateTime extracted."""
+    def __init__(self, limit=HEADER_LIMIT):
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.kind = None    # 'jpeg', 'tiff' or None if unknown
+        self.value = None   # raw DateTime value
+
+    def feed(self, data, offset):
+        """Feed @data written at @offset, only sequential data from file
+        start is considered."""
+        if self.done:
+            return
+        if offset != self.size: # not sequential, give up
+            self.done = True
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        self.parse()
+
+    def parse(self):
+        """Try to find DateTime on fed data."""
+        data = ''.join(self.chunks)
+        self.chunks = [data]
+        if data.startswith('\xff\xd8'):
+            self.kind = 'jpeg'
+            state, value = jpeg_datetime(data)
+        elif data[:4] in ('II*\0', 'MM\0*'):
+            self.kind = 'tiff'
+            state, value = tiff_datetime(data)
+        elif len(data) < 4:
+            state, value = NEED_MORE, None
+        else:
+            state, value = MISSING, None
+        if state != NEED_MORE or self.size >= self.limit:
+            self.done = True
+            self.value = value
+            self.chunks = []
+
+    @property
+    def date(self):
+        """Return exif DateTime as datetime or None."""
+        try:
+            return datetime.strptime(self.value, EXIF_DATEFORMAT)
+        except (TypeError, ValueError):
+            pass
@@ -17,48 +17,97 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import os, sys, time, sqlite3, threading, traceback
 from os import path
+from contextlib import contextmanager
 from urllib import quote, unquote
-from sqlalchemy import Column, Integer, String, ForeignKey, create_engine
+from sqlalchemy import Column, Integer, String, ForeignKey, create_engine, \
+                       text, literal_column
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relation, backref, sessionmaker
+from sqlalchemy.orm import relation, backref, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, StaticPool
+
+try:
+    from sqlalchemy import event
+except ImportError: # SQLAlchemy < 0.7, no savepoints nor statements hooks
+    event = None
 
 
 # Declarative approach
 Base = declarative_base()
 
+# values bound per IN query, SQLite limit is 999 parameters
+QUERY_CHUNK = 500
+
+
+def chunks(values, size=QUERY_CHUNK):
+    """Split @values list in lists of @size items."""
+    for start in xrange(0, len(values), size):
+        yield values[start:start + size]
+
 
 class _Manager(object):
     """Simpler management methods."""
     def _operation(self, op_name):
-        """Calls session operation named @op_name if it exists and is
-        callable. Detaches from current object session if it's not
-        current session. Operations must accept instance as first argument.
+        """Calls write session operation named @op_name if it exists and
+        is callable. Instances loaded by another session (read sessions)
+        are merged into write session first. Operations must accept
+        instance as first argument.
         """
-        session = get_session()
-        op = getattr(session, op_name, None)
-        if not op or not hasattr(op, '__call__'):
-            raise AttributeError, \
+        with _write_lock:
+            session = _writer()
+            op = getattr(session, op_name, None)
+            if not op or not hasattr(op, '__call__'):
+                raise AttributeError, \
                     'Not callable object returned for operation %s.' % op_name
-        if self._sa_instance_state.session_id != session.hash_key:
-            # need to detach before some operations, why?
-            self._sa_instance_state.detach()
-        op(self)
-        session.commit()
-        session.flush()
-        return self
+            instance = self
+            if self._sa_instance_state.session_id not in (None,
+                                                          session.hash_key):
+                instance = session.merge(self)
+            _done(session, op, instance)
+        return instance
 
     def add(self):
-        """Registers item in session, transaction is commited inmediattly."""
+        """Registers item in session, transaction is commited inmediattly
+        (or with the pending group commit)."""
         self._operation('add')
 
     def delete(self):
-        """Delete item in session, transaction is commit inmediattly."""
+        """Delete item in session, transaction is commit inmediattly
+        (or with the pending group commit)."""
         self._operation('delete')
 
     def update(self):
-        """Delete item in session, transaction is commit inmediattly."""
-        self._operation('update')
+        """Update item in session, transaction is commit inmediattly
+        (or with the pending group commit)."""
+        self._operation('merge')
+
+    @classmethod
+    def delete_by(klass, **kwargs):
+        """Delete entries matching @kwargs without loading them,
+        transaction is commited as in delete()."""
+        with _write_lock:
+            session = _writer()
+            _done(session, lambda query: query.delete('evaluate'),
+                  session.query(klass).filter_by(**kwargs))
+
+    @classmethod
+    def find(klass, **kwargs):
+        """Return first entry matching @kwargs or None. Looked up by the
+        write session, uncommitted changes of a pending group commit are
+        seen (reads by other methods commit them first). The write
+        session is closed before the lock is released unless operations
+        are pending (its transaction would hold a lock on database
+        otherwise), the entry is returned detached then."""
+        with _write_lock:
+            session = _writer()
+            try:
+                return session.query(klass).filter_by(**kwargs).first()
+            finally:
+                if _group is None:
+                    _session.remove()
+                elif not _group.count:
+                    _group.session.close()
 
     @classmethod
     def all(klass):
@@ -83,10 +132,74 @@ class _Manager(object):
         return get_session().query(klass).order_by(*args)
 
 
+def encode(value):
+    """Return @value as utf-8 encoded string."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def decode(value):
+    """Return utf-8 encoded string @value as unicode (undecodable bytes
+    are replaced), it can be bound as query parameter then."""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def uri_path(base_uri, filename):
+    """Return path for @base_uri and @filename striping file:// prefix,
+    as an utf-8 encoded string (escaped bytes are decoded as such, not
+    as unicode characters)."""
+    return unquote(encode(path.join(base_uri.replace('file://', ''),
+                                    filename)))
+
+
 def photo_path(obj):
     """Return path striping file:// prefix."""
-    return unquote(path.join(obj.base_uri.replace('file://', ''),
-                             obj.filename))
+    return uri_path(obj.base_uri, obj.filename)
+
+
+# rows fetched per statement by streamed column queries
+STREAM_SIZE = 1000
+
+
+class PhotoRecord(object):
+    """Lightweight photo record returned by column queries, values are
+    taken from default version when defined. Not bound to any session."""
+    __slots__ = ('id', 'base_uri', 'filename')
+
+    def __init__(self, id, base_uri, filename):
+        self.id = id
+        self.base_uri = base_uri
+        self.filename = filename
+
+    @property
+    def path(self):
+        """Return file absolute path in collection."""
+        return photo_path(self)
+
+    def __repr__(self):
+        """repr string"""
+        return '<PhotoRecord %s>' % self.filename
+
+
+def records(query, after=0, size=STREAM_SIZE):
+    """Stream PhotoRecord instances from @query rows (as built by
+    Photo.columns) in photo id order, starting after photo id @after.
+    Rows are read in @size rows statements paginated by photo id (keyset),
+    no cursor is kept open between them and a listing can be resumed
+    from any photo id. Repeated rows for the same photo are skipped."""
+    while True:
+        rows = query.filter(Photo.id > after).order_by(Photo.id)\
+                    .limit(size).all()
+        for photo_id, base_uri, filename, vbase_uri, vfilename in rows:
+            if photo_id != after:
+                yield PhotoRecord(photo_id, vbase_uri or base_uri,
+                                  vfilename or filename)
+                after = photo_id
+        if len(rows) < size:
+            return
 
 
 class Photo(Base, _Manager):
@@ -104,11 +217,11 @@ class Photo(Base, _Manager):
     md5_sum = Column(String)
 
     def __init__(self, *args, **kwargs):
+        kwargs.setdefault('description', '')
+        kwargs.setdefault('roll_id', 1)
+        kwargs.setdefault('rating', 0)
+        kwargs.setdefault('md5_sum', '')
         super(Photo, self).__init__(*args, **kwargs)
-        self.description = ''
-        self.roll_id = 1
-        self.rating = 0
-        self.md5_sum = ''
 
     @property
     def path(self):
@@ -133,6 +246,100 @@ class Photo(Base, _Manager):
         return Photo.with_version().join((PhotoTag, (PhotoTag.tag_id == tagid) &
                                          (PhotoTag.photo_id == Photo.id)))
 
+    @classmethod
+    def columns(klass):
+        """Return query of photo (id, base_uri, filename) and default
+        version (base_uri, filename) columns, no mapped instances are
+        built."""
+        return get_session().query(Photo.id, Photo.base_uri, Photo.filename,
+                                   PhotoVersion.base_uri,
+                                   PhotoVersion.filename)\
+                            .join((PhotoVersion,
+                                  ((PhotoVersion.version_id == Photo.default_version_id) &
+                                   (PhotoVersion.photo_id == Photo.id))))
+
+    @classmethod
+    def all_records(klass, after=0):
+        """Return PhotoRecord for every photo with id greater than @after,
+        same photos as all_photos but in id order."""
+        return records(Photo.columns(), after)
+
+    @classmethod
+    def tag_records(klass, tag_id, after=0):
+        """Return PhotoRecord for photos tagged by @tag_id with id greater
+        than @after, same as by_tag."""
+        return records(Photo.columns()\
+                            .join((PhotoTag, (PhotoTag.tag_id == tag_id) &
+                                             (PhotoTag.photo_id == Photo.id))),
+                       after)
+
+    @classmethod
+    def index_rows(klass, names=None, after=None, photo_ids=None):
+        """Return (id, base_uri, filename) rows for every photo (or just
+        the ones with quoted file name in @names, id greater than @after
+        or id in @photo_ids), values are taken from default version when
+        defined. Only columns are loaded, no mapped instances are built.
+        Names are looked up on photos and versions by separate queries,
+        this way both can use a file name index (an OR across both tables
+        can't)."""
+        query = Photo.columns()
+        if after is not None:
+            query = query.filter(Photo.id > after)
+        if names is not None:
+            queries = (query.filter(column.in_(chunk))
+                            for chunk in chunks(list(names))
+                                for column in (Photo.filename,
+                                               PhotoVersion.filename))
+        elif photo_ids is not None:
+            queries = (query.filter(Photo.id.in_(chunk))
+                            for chunk in chunks(list(photo_ids)))
+        else:
+            queries = [query]
+        seen = set()
+        for rows in queries:
+            for photo_id, base_uri, filename, vbase_uri, vfilename in rows:
+                if photo_id not in seen:
+                    seen.add(photo_id)
+                    yield photo_id, vbase_uri or base_uri, vfilename or filename
+
+    @classmethod
+    def ids_by_path(klass, paths):
+        """Return dict mapping collection file @paths (utf-8 encoded
+        strings) to photo ids, paths not registered are missing. File
+        names are looked up as given and quoted, decoded to unicode
+        (sqlite3 rejects non-ASCII byte strings parameters)."""
+        names = set()
+        for name in set(path.basename(value) for value in paths):
+            names.update(decode(value) for value in
+                            (name, quote(name), quote(name, safe='()')))
+        wanted = set(paths)
+        result = {}
+        for photo_id, base_uri, filename in klass.index_rows(names):
+            value = uri_path(base_uri, filename)
+            if value in wanted:
+                result[value] = photo_id
+        return result
+
+    @classmethod
+    def time_rows(klass, after=None):
+        """Return (id, time) rows for every photo (or the ones with id
+        greater than @after)."""
+        query = get_session().query(Photo.id, Photo.time)
+        if after is not None:
+            query = query.filter(Photo.id > after)
+        return query
+
+    @classmethod
+    def hash_rows(klass, after=None):
+        """Return (id, md5_sum) rows for every photo with a content
+        hash (or the ones with id greater than @after)."""
+        query = get_session().query(Photo.id, Photo.md5_sum)\
+                             .filter((Photo.md5_sum != None) &
+                                     (Photo.md5_sum != ''))
+        if after is not None:
+            query = query.filter(Photo.id > after)
+        return query
+
     def update_from_version(self, version):
         """Update current photo base_uri and filename from @version."""
         self._base_uri = self.base_uri
@@ -157,6 +364,15 @@ class PhotoVersion(Base, _Manager):
 
     photo = relation(Photo, backref=backref('versions'))
 
+    @classmethod
+    def photo_ids(klass, after):
+        """Return ids of photos with versions stored after rowid
+        @after."""
+        return set(photo_id for photo_id, in
+                        get_session().query(PhotoVersion.photo_id)\
+                            .filter(literal_column('photo_versions.rowid') >
+                                    after))
+
     @property
     def path(self):
         """Return file absolute path in collection."""
@@ -198,6 +414,30 @@ class Tag(Base, _Manager):
                               (~pt_alias.c.tag_id.in_(subtag_ids)))
         return update_with_version(photos)
 
+    @classmethod
+    def untagged_records(klass, after=0):
+        """Return PhotoRecord for photos without tags with id greater
+        than @after, same as untagged_photos."""
+        return records(Photo.columns()\
+                            .outerjoin((PhotoTag, PhotoTag.photo_id == Photo.id))\
+                            .filter(PhotoTag.tag_id == None), after)
+
+    @classmethod
+    def own_records(klass, tag_id, subtag_ids, after=0):
+        """Return PhotoRecord for photos tagged by @tag_id but not by its
+        @subtag_ids only with id greater than @after, same as
+        own_photos."""
+        pt_alias = PhotoTag.__table__.alias()
+        query = Photo.columns()\
+                     .join((PhotoTag, PhotoTag.photo_id == Photo.id))\
+                     .filter(PhotoTag.tag_id == tag_id)\
+                     .outerjoin((pt_alias,
+                                (pt_alias.c.photo_id == PhotoTag.photo_id) &
+                                (pt_alias.c.tag_id != PhotoTag.tag_id)))\
+                     .filter((pt_alias.c.tag_id == None) |
+                             (~pt_alias.c.tag_id.in_(list(subtag_ids))))
+        return records(query, after)
+
     def get_file(self, name):
         """Returns photo and photo_version for file @name tagged by @tag."""
         result = Photo.by_tag(self.id)\
@@ -221,7 +461,46 @@ class PhotoTag(Base, _Manager):
     tag_id = Column(Integer, ForeignKey('tags.id'), primary_key=True)
 
     photo = relation(Photo, backref=backref('tags'))
-    tag = relation(Tag, backref=backref('photos'))
+    tag = relation(Tag, backref=backref('photos',
+                                        cascade='all, delete-orphan'))
+
+    @classmethod
+    def pairs(klass, after=None):
+        """Return (photo_id, tag_id) rows for every tagged photo (or the
+        ones stored after rowid @after)."""
+        query = get_session().query(PhotoTag.photo_id, PhotoTag.tag_id)
+        if after is not None:
+            query = query.filter(literal_column('photo_tags.rowid') > after)
+        return query
+
+    @classmethod
+    def tag_photos(klass, session, tag_id, photo_ids):
+        """Tag @photo_ids by @tag_id using write @session, photos
+        already tagged are skipped. Returns number of tagged photos."""
+        count = 0
+        for chunk in chunks(sorted(set(photo_ids))):
+            tagged = set(photo_id for photo_id, in
+                            session.query(PhotoTag.photo_id)\
+                                   .filter((PhotoTag.tag_id == tag_id) &
+                                           PhotoTag.photo_id.in_(chunk)))
+            rows = [{'photo_id': photo_id, 'tag_id': tag_id}
+                        for photo_id in chunk if photo_id not in tagged]
+            if rows:
+                session.execute(klass.__table__.insert(), rows)
+            count += len(rows)
+        return count
+
+    @classmethod
+    def untag_photos(klass, session, tag_id, photo_ids):
+        """Remove @tag_id from @photo_ids using write @session. Returns
+        number of untagged photos."""
+        count = 0
+        for chunk in chunks(sorted(set(photo_ids))):
+            count += session.query(PhotoTag)\
+                            .filter((PhotoTag.tag_id == tag_id) &
+                                    PhotoTag.photo_id.in_(chunk))\
+                            .delete(synchronize_session=False)
+        return count
 
     def __repr__(self):
         """repr string"""
@@ -241,29 +520,480 @@ class Meta(Base, _Manager):
         return '<Meta %s - %s>' % (self.name, self.data[:15])
 
 
-# global engine and session
+# Read connections pool size
+POOL_SIZE = 4
+
+# global engines and sessions, lookups are done through a pool of
+# read-only connections, changes through a single writer connection
 _engine, _session = None, None
+_reader, _read_session = None, None
+_write_lock = threading.RLock()
+
+# pending group commit (see group_commits), functions called before
+# and after own commits (see on_commit) and with the exception when a
+# group commit fails
+_group = None
+_before_commit_hooks = []
+_commit_hooks = []
+_commit_error_hooks = []
+
+# functions called after every SQL statement (see on_statement) and
+# engines with statement events attached
+_statement_hooks = []
+_listened = set()
+
+COMMIT_SIZE = 100 # write operations per group commit
+
+# own write operations done (committed, flushed in a group commit or
+# rolled back), see write_count
+_writes = 0
+
+
+def _read_only_connection(db_file):
+    """Return a read-only sqlite connection to @db_file."""
+    try:
+        conn = sqlite3.connect('file:%s?mode=ro' % quote(db_file),
+                               uri=True, check_same_thread=False)
+    except TypeError: # sqlite3 module without URI filenames support
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def init_session(db_path, echo=False, pool_size=POOL_SIZE):
+    """Initializes engines and scoped sessions. Read sessions use a pool
+    of @pool_size read-only connections, write session uses a single
+    connection."""
+    global _engine, _session, _reader, _read_session
+    _engine = create_engine(db_path, echo=echo, poolclass=StaticPool,
+                            connect_args={'check_same_thread': False})
+    db_file = _engine.url.database
+    _reader = create_engine('sqlite://', echo=echo, poolclass=QueuePool,
+                            pool_size=pool_size, max_overflow=pool_size,
+                            creator=lambda: _read_only_connection(db_file))
+    _session = scoped_session(sessionmaker(bind=_engine,
+                                           expire_on_commit=False))
+    _read_session = scoped_session(sessionmaker(bind=_reader,
+                                                expire_on_commit=False))
+    if event is not None: # group commits flush operations in savepoints
+        event.listen(_engine, 'connect', _no_implicit_begin)
+        event.listen(_engine, 'begin', _begin)
+    if _statement_hooks:
+        _listen()
+
+
+def _no_implicit_begin(dbapi_conn, connection_record):
+    """Write engine connect event, pysqlite implicit transactions are
+    disabled (they break SAVEPOINTs), _begin starts them instead."""
+    dbapi_conn.isolation_level = None
+
+
+def _begin(conn):
+    """Write engine begin event, starts database transaction."""
+    conn.execute('BEGIN')
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    """Engine event, statement start time is pushed on connection info."""
+    conn.info.setdefault('statement_start', []).append(time.time())
+
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    """Engine event, calls statement hooks."""
+    elapsed = time.time() - conn.info['statement_start'].pop()
+    for hook in _statement_hooks:
+        hook(statement, parameters, elapsed)
+
+
+def _listen():
+    """Attach statement events to current engines."""
+    for engine in (_engine, _reader):
+        if engine is not None and engine not in _listened:
+            event.listen(engine, 'before_cursor_execute', _before_execute)
+            event.listen(engine, 'after_cursor_execute', _after_execute)
+            _listened.add(engine)
+
+
+def on_statement(hook):
+    """Register @hook to be called with (statement, parameters, elapsed
+    seconds) after every SQL statement. Returns False if not supported
+    by SQLAlchemy version (events API, 0.7 or higher)."""
+    if event is None:
+        return False
+    if hook not in _statement_hooks:
+        _statement_hooks.append(hook)
+    _listen()
+    return True
 
 
-def init_session(db_path, echo=False):
-    """Initializes engine and sessionmaker."""
-    global _engine, _session
-    _engine = create_engine(db_path, echo=echo)
-    _session = sessionmaker(bind=_engine)
+def get_session():
+    """Returns current thread read session. Pending group commit is
+    committed first, this way reads see every change."""
+    global _read_session
+    assert _read_session != None
+    if _group is not None and _group.count:
+        commit_pending()
+    return _read_session()
 
 
-def get_session():
-    """Returns a new session."""
+def get_write_session():
+    """Returns current thread write session."""
     global _session
     assert _session != None
     return _session()
 
 
+@contextmanager
+def write_transaction():
+    """Context manager yielding current thread write session, changes
+    made in the block are committed in a single transaction at exit or
+    rolled back if an exception is raised."""
+    with _write_lock:
+        commit_pending()
+        session = get_write_session()
+        try:
+            yield session
+            _commit(session)
+        except:
+            session.rollback()
+            raise
+
+
+@contextmanager
+def write_locked():
+    """Context manager holding the write lock, own write operations and
+    commits wait until the block exits."""
+    with _write_lock:
+        yield
+
+
+class GroupCommit(object):
+    """Deferred commits for write operations. Operations are flushed to
+    a long lived session, each one in its own savepoint, and committed
+    together at most @window seconds after the first one or when @size
+    operations are pending. Must be used with _write_lock held."""
+    def __init__(self, window, size=COMMIT_SIZE):
+        self.window = window
+        self.size = size
+        self.session = sessionmaker(bind=_engine, expire_on_commit=False)()
+        self.count = 0
+        self.timer = None
+
+    def done(self):
+        """Account a flushed operation, commits if size limit reached or
+        schedules the commit otherwise."""
+        global _writes
+        _writes += 1
+        self.count += 1
+        if self.count >= self.size:
+            self.commit()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.window, _timed_commit)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def commit(self):
+        """Commit pending operations and call commit hooks. If commit
+        fails pending operations are rolled back, commit error hooks are
+        called with the exception (in-memory state built on those
+        operations must be reloaded) and it's raised. Without pending
+        operations the session is just closed, ending any transaction
+        begun by reads."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.count:
+            self.session.close()
+            return
+        for hook in _before_commit_hooks:
+            hook()
+        try:
+            self.session.commit()
+        except Exception, e:
+            exc_info = sys.exc_info()
+            self.rollback()
+            for hook in _commit_error_hooks:
+                hook(e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.count = 0
+        self.session.close()
+        for hook in _commit_hooks:
+            hook()
+
+    def rollback(self):
+        """Discard pending operations."""
+        global _writes
+        _writes += 1
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.count = 0
+        self.session.rollback()
+        self.session.close()
+
+
+def group_commits(window, size=COMMIT_SIZE):
+    """Defer write operations commits, operations done in a @window
+    seconds period (or up to @size of them) are committed in a single
+    transaction. A @window of 0 commits every operation inmediattly, as
+    does any window if SQLAlchemy doesn't support events (0.7 or higher,
+    needed for savepoints)."""
+    global _group
+    if event is None:
+        window = 0
+    with _write_lock:
+        if _group is not None:
+            _group.commit()
+        _group = GroupCommit(window, size) if window > 0 else None
+
+
+def commit_pending():
+    """Commit pending group commit operations, if any."""
+    with _write_lock:
+        if _group is not None:
+            _group.commit()
+
+
+def _timed_commit():
+    """Group commit timer target. A failure was already passed to
+    commit error hooks, it's printed since nobody waits for the timer."""
+    try:
+        commit_pending()
+    except Exception:
+        traceback.print_exc()
+
+
+def on_commit(hook, before=False):
+    """Register @hook to be called after every commit of write
+    operations, or right before it if @before (write lock is held and
+    changes are flushed, other processes can't commit meanwhile)."""
+    hooks = _before_commit_hooks if before else _commit_hooks
+    if hook not in hooks:
+        hooks.append(hook)
+
+
+def on_commit_error(hook):
+    """Register @hook to be called with the exception when a group
+    commit fails, its operations are lost by then."""
+    if hook not in _commit_error_hooks:
+        _commit_error_hooks.append(hook)
+
+
+def _commit(session):
+    """Commit write @session calling commit hooks. Must be called with
+    _write_lock held."""
+    global _writes
+    for hook in _before_commit_hooks:
+        hook()
+    session.commit()
+    _writes += 1
+    for hook in _commit_hooks:
+        hook()
+
+
+def write_count():
+    """Return number of own write operations done so far. If it didn't
+    change while database was read (checked with the write lock held),
+    own changes applied to in-memory state are seen in what was read."""
+    return _writes
+
+
+def _writer():
+    """Return session for write operations, must be called with
+    _write_lock held."""
+    if _group is not None:
+        return _group.session
+    return get_write_session()
+
+
+def _done(session, op, *args):
+    """Call @op with @args on write @session and commit it. If commits
+    are grouped it's flushed in a savepoint instead, a failure undoes
+    this operation only and pending ones are kept. Must be called with
+    _write_lock held."""
+    if _group is None:
+        try:
+            op(*args)
+            _commit(session)
+        except:
+            session.rollback()
+            raise
+        return
+    savepoint = session.begin_nested()
+    try:
+        op(*args)
+        session.flush()
+    except:
+        savepoint.rollback()
+        raise
+    savepoint.commit()
+    _group.done()
+
+
+def close_sessions():
+    """Closes current thread sessions, connections are returned to the
+    pool and loaded instances detached. Write session is closed with
+    _write_lock held, its rollback would undo other threads flushed
+    changes on the shared connection otherwise. The lock isn't taken if
+    current thread has no write session (read only operations)."""
+    if _read_session is not None:
+        _read_session.remove()
+    if _session is not None and _session.registry.has():
+        with _write_lock:
+            _session.remove()
+
+
+# tables PhotoIndex is built from, with the (numeric, text) columns it
+# keeps, see table_signature
+SYNCED_TABLES = {
+    'photos': (('id', 'time', 'default_version_id'),
+               ('base_uri', 'filename', 'md5_sum')),
+    'photo_versions': (('photo_id', 'version_id'), ('base_uri', 'filename')),
+    'photo_tags': (('photo_id', 'tag_id'), ()),
+}
+# checksum columns weights, values are swapped across columns otherwise
+_WEIGHTS = (1, 3, 5, 7, 11, 13)
+
+
+def table_signature(table, last=None):
+    """Return (rows count, last rowid, checksum) of SYNCED_TABLES @table
+    (or of its rows up to rowid @last). Checksum covers numeric columns
+    values and text columns lengths, it's computed by SQLite without
+    fetching rows, but changes keeping every text length are missed."""
+    numeric, texts = SYNCED_TABLES[table]
+    terms = ['coalesce(%s, 0)' % name for name in numeric] + \
+            ['coalesce(length(%s), 0)' % name for name in texts]
+    checksum = ' + '.join('%s * %d' % (term, weight)
+                                for term, weight in zip(terms, _WEIGHTS))
+    sql = 'SELECT count(*), coalesce(max(rowid), 0),' \
+          ' coalesce(sum(((%s) %% 1000003) * (rowid %% 997 + 1)), 0)' \
+          ' FROM %s' % (checksum, table)
+    if last is not None:
+        sql += ' WHERE rowid <= %d' % last
+    return tuple(get_session().execute(text(sql)).fetchone())
+
+
+# covering indexes for lookups paths F-Spot schema may not index, named
+# with fspotfs prefix to tell them apart from F-Spot ones
+INDEXES = (
+    ('fspotfs_photos_filename', 'photos', 'filename'),
+    ('fspotfs_photo_tags_tag', 'photo_tags', 'tag_id, photo_id'),
+    ('fspotfs_photo_versions_version', 'photo_versions',
+     'photo_id, version_id, base_uri, filename'),
+    ('fspotfs_photo_versions_filename', 'photo_versions', 'filename'),
+)
+
+
+def create_indexes():
+    """Create missing INDEXES in database, returns names of the created
+    ones. F-Spot ignores them."""
+    created = []
+    with write_transaction() as session:
+        existing = set(name for name, in session.execute(
+                            text("SELECT name FROM sqlite_master"
+                                 " WHERE type = 'index'")))
+        for name, table, columns in INDEXES:
+            if name not in existing:
+                session.execute(text('CREATE INDEX %s ON %s (%s)' %
+                                     (name, table, columns)))
+                created.append(name)
+    return created
+
+
+def drop_indexes():
+    """Drop INDEXES from database."""
+    with write_transaction() as session:
+        for name, table, columns in INDEXES:
+            session.execute(text('DROP INDEX IF EXISTS %s' % name))
+
+
 def get_db_version():
     """Return F-Spot database schema version."""
     return Meta.filter(name='F-Spot Database Version').first().data
         
 
+class ChangeDetector(object):
+    """Detects commits made to F-Spot database by other processes (like
+    F-Spot itself). Uses SQLite data_version pragma on a private
+    connection, or database file mtime and size if not supported by
+    SQLite library. Checks are throttled to one every @interval seconds,
+    0 disables detection. Own commits must call before_commit() and
+    after_commit() (see fspotdb.on_commit), they'd be taken as external
+    changes otherwise."""
+    def __init__(self, db_file, interval=1.0):
+        self.db_file = db_file
+        self.interval = interval
+        self.checked = 0
+        # external changes noticed before an own commit
+        self.external = False
+        self.conn = None
+        self.lock = threading.Lock()
+        if interval > 0:
+            self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.version = self.current()
+
+    def current(self):
+        """Return current database version marker."""
+        if self.conn is None:
+            return None
+        try:
+            row = self.conn.execute('PRAGMA data_version').fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        if row is not None:
+            return row[0]
+        # data_version not supported (SQLite < 3.8.8)
+        marker = []
+        for name in (self.db_file, self.db_file + '-wal'):
+            try:
+                st = os.stat(name)
+                marker.append((st.st_mtime, st.st_size))
+            except OSError:
+                marker.append(None)
+        return tuple(marker)
+
+    def changed(self):
+        """Return True if database changed since last check. Checked with
+        the write lock held, an own commit can't be seen before
+        after_commit() marks it."""
+        if self.conn is None or (not self.external and
+                                 time.time() - self.checked < self.interval):
+            return False
+        with _write_lock, self.lock:
+            if self.external:
+                self.external = False
+                return True
+            now = time.time()
+            if now - self.checked < self.interval:
+                return False
+            self.checked = now
+            current = self.current()
+            if current != self.version:
+                self.version = current
+                return True
+        return False
+
+    def before_commit(self):
+        """Own commit hook, changes committed by other processes since
+        last check are noticed now (unthrottled), after own commit they
+        can't be told apart."""
+        if self.conn is None:
+            return
+        with self.lock:
+            if self.current() != self.version:
+                self.external = True
+
+    def after_commit(self):
+        """Own commit hook, current database version is marked as seen
+        to avoid reloading our own changes."""
+        if self.conn is None:
+            return
+        with self.lock:
+            self.version = self.current()
+
+
 def update_with_version(photos):
     result = []
     for photo, pversion in photos:
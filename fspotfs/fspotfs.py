@@ -17,13 +17,30 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import os, sys, stat, errno, fuse, time, tempfile, Image, ExifTags, shutil
+import os, sys, stat, errno, fuse, time, tempfile, Image, shutil, threading
+import hashlib, glob
 from datetime import datetime
+from functools import wraps
+from bisect import bisect_left
+from inspect import isgeneratorfunction
 from urllib import unquote, quote
 from optparse import OptionParser, OptionError
 from os.path import basename, dirname, join, isfile, isabs, isdir, exists
 
 from .fspotdb import *
+from .index import PhotoIndex, encode
+from .cache import LRUCache, NegativeCache
+from .postings import Postings
+from .locking import RWLock
+from .handles import HandlePool, Handle
+from .exif import HeaderParser, EXIF_DATEFORMAT, DATETIME_TAG
+from .ingest import IngestQueue, PlacedFile
+from .thumbs import ThumbnailCache, CACHE_LIMIT
+from .dates import DateIndex, checked_period
+from .query import parse, evaluate
+from .stats import Stats, SignalDump
+from .trace import SlowQueryTracer
+from .snapshot import Snapshot
 
 # F-Spot gconf key that stores user collection path,
 # this should be on database IMO
@@ -32,10 +49,9 @@ FSPOT_SP_GCONF_KEY = '/apps/f-spot/import/storage_path'
 try:
     import gconf
     COLLECTION_ROOT = gconf.client_get_default().get_value(FSPOT_SP_GCONF_KEY)
-    # DateTime Exif Tag id
-    DATETIME_ID = dict((v, k) for k, v in ExifTags.TAGS.iteritems())['DateTime']
     DISABLE_IMPORT = False
 except (ImportError, KeyError, ValueError):
+    COLLECTION_ROOT = None
     DISABLE_IMPORT = True
 
 DESCRIPTION        = 'F-Spot FUSE Filesystem'
@@ -44,8 +60,34 @@ FSPOT_DB_VERSION   = '17' # database version supported
 DEFAULT_MOUNTPOINT = join(os.environ['HOME'], '.photos')
 ROOT_ID            = 0
 ROOT_NAME          = ''
-EXIF_DATEFORMAT    = '%Y:%m:%d %H:%M:%S'
+STAGING_DIR        = '.fspotfs-staging' # imports staging, in collection
 LINK_TYPE          = stat.S_IFREG | stat.S_IFLNK
+FILE_TYPE          = stat.S_IFREG
+HANDLES_SIZE       = 64  # idle open files kept in passthrough mode
+COMMIT_WINDOW      = 0.5 # seconds write operations are grouped in a commit
+BULK_COMMANDS      = ('tag', 'untag') # fsfs subcommands
+THUMBS_DIR         = '.thumbs' # thumbnails sub-directory in every directory
+THUMBS_CACHE_DIR   = 'fspotfs/thumbs' # thumbnails cache, in user cache dir
+DATES_DIR          = 'by-date' # photos by date view, in root directory
+DATE_FORMATS       = ('%d', '%02d', '%02d') # by-date directory names
+QUERY_DIR          = '+query' # tags query directories, in root directory
+QUERY_CACHE_SIZE   = 64  # cached query results
+DIRCACHE_SIZE      = 256 # cached directory listings
+NEGATIVE_SIZE      = 4096 # cached missing paths
+NEGATIVE_TTL       = 5.0 # seconds missing paths are cached
+ENTRY_TIMEOUT      = 5.0 # seconds kernel caches names lookups
+ATTR_TIMEOUT       = 5.0 # seconds kernel caches stats
+NEGATIVE_TIMEOUT   = 1.0 # seconds kernel caches missing names
+FILES_OFFSET       = 1 << 32 # readdir offset of photos, plus photo id
+REFRESH_INTERVAL   = 1.0 # seconds between database changes checks
+FULL_SYNC_INTERVAL = 600 # seconds between full index comparisons
+READ_ATTEMPTS      = 3   # database reads outside the write lock per refresh
+INGEST_BATCH       = 50  # imported files registered per transaction
+INGEST_STATUS      = '/.fspotfs-ingest' # imports status virtual file
+STATS_FILE         = '/.fspotfs-stats' # runtime counters virtual file
+STATS_DUMP         = 'fspotfs/stats.json' # SIGUSR1 dump, in user cache dir
+TRACE_FILE         = '/.fspotfs-slow' # slow SQL statements virtual file
+SNAPSHOTS_DIR      = 'fspotfs/snapshots' # index snapshots, in user cache dir
 
 # Current user UID and GID
 UID = os.getuid()
@@ -54,16 +96,86 @@ GID = os.getgid()
 # Startup time
 GLOBAL_TIME = long(time.time())
 
+###
+# FUSE handlers helpers
+
+def measured(func):
+    """FUSE handler decorator, calls latency is accounted in filesystem
+    stats (until the generator is exhausted in case of generator
+    handlers), negative results are accounted as errors. SQL statements
+    run by the call are traced if slow queries tracing is enabled."""
+    name = func.__name__
+    if isgeneratorfunction(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            traced = self.tracer is not None and \
+                     self.tracer.begin(name, args[0] if args else None)
+            start = time.time()
+            try:
+                for item in func(self, *args, **kwargs):
+                    yield item
+            finally:
+                self.stats.record(name, time.time() - start)
+                if traced:
+                    self.tracer.end()
+    else:
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            traced = self.tracer is not None and \
+                     self.tracer.begin(name, args[0] if args else None)
+            start = time.time()
+            failed = True # unless it returns
+            try:
+                result = func(self, *args, **kwargs)
+                failed = isinstance(result, int) and result < 0
+                return result
+            finally:
+                self.stats.record(name, time.time() - start, failed)
+                if traced:
+                    self.tracer.end()
+    return wrapper
+
+
+def operation(func):
+    """FUSE handler decorator, database sessions used by the handler are
+    closed when it's done (or when the generator is exhausted in case of
+    generator handlers). Calls are measured too."""
+    if isgeneratorfunction(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                for item in func(*args, **kwargs):
+                    yield item
+            finally:
+                close_sessions()
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                close_sessions()
+    return measured(wrapper)
+
+
+def positioned(entries):
+    """Generate directory @entries with their position as offset."""
+    for pos, entry in enumerate(entries):
+        entry.offset = pos + 1
+        yield entry
+
+
 ###
 # Stats for FUSE implementation
 
 class BaseStat(fuse.Stat):
-    """Base Stat class. Sets atime, mtime and ctime to a dummy
-    global value (time when application started running)."""
-    def __init__(self, *args, **kwargs):
+    """Base Stat class. Sets atime, mtime and ctime to @mtime or to a
+    dummy global value (time when application started running) if not
+    known."""
+    def __init__(self, mtime=None, *args, **kwargs):
         """Init atime, mtime and ctime."""
         super(BaseStat, self).__init__(*args, **kwargs)
-        self.st_atime = self.st_mtime = self.st_ctime = GLOBAL_TIME
+        self.st_atime = self.st_mtime = self.st_ctime = mtime or GLOBAL_TIME
         # set current user UID and GID to hierarchy nodes
         self.st_uid = UID
         self.st_gid = GID
@@ -78,54 +190,299 @@ class DirStat(BaseStat):
 
 
 class ImageLinkStat(BaseStat):
-    """Link to Image stat"""
-    def __init__(self, path, *args, **kwargs):
-        super(ImageLinkStat, self).__init__(*args, **kwargs)
+    """Link to Image stat, times are photo @mtime (image file modification
+    time if unknown), same source as directories times."""
+    def __init__(self, path, mtime=None, *args, **kwargs):
+        try:
+            file_stat = os.stat(path)
+        except OSError: # missing file in collection
+            file_stat = None
+        if file_stat is not None and not mtime:
+            mtime = long(file_stat.st_mtime)
+        super(ImageLinkStat, self).__init__(mtime, *args, **kwargs)
         self.st_mode = stat.S_IFREG | stat.S_IFLNK | 0644
         self.st_nlink = 0
-        os_stat = os.stat(path)
-        self.st_size = os_stat.st_size if os_stat else 0
+        self.st_size = file_stat.st_size if file_stat is not None else 0
+
+
+class ImageFileStat(ImageLinkStat):
+    """Regular file image stat (passthrough mode)"""
+    def __init__(self, path, *args, **kwargs):
+        super(ImageFileStat, self).__init__(path, *args, **kwargs)
+        self.st_mode = stat.S_IFREG | 0444
+        self.st_nlink = 1
+
+
+class ThumbnailStat(BaseStat):
+    """Thumbnail stat, size is taken from cached thumbnail file @path,
+    it's 0 if not built yet (thumbnails are opened direct_io, see
+    VirtualFile). Times are photo @mtime."""
+    def __init__(self, path, mtime=None, *args, **kwargs):
+        super(ThumbnailStat, self).__init__(mtime, *args, **kwargs)
+        self.st_mode = stat.S_IFREG | 0444
+        self.st_nlink = 1
+        self.st_size = 0
+        if path is not None:
+            try:
+                self.st_size = os.stat(path).st_size
+            except OSError: # evicted meanwhile
+                pass
 
 
 class NewFileState(BaseStat):
     """New file stat"""
-    def __init__(self, *args, **kwargs):
-        super(NewFileState, self).__init__(*args, **kwargs)
+    def __init__(self, size=0, *args, **kwargs):
+        super(NewFileState, self).__init__(None, *args, **kwargs)
         self.st_mode = stat.S_IFREG | 0644
         self.st_nlink = 0
-        self.st_size = 0
+        self.st_size = size
+
+
+class VirtualFileStat(BaseStat):
+    """Generated read-only file stat"""
+    def __init__(self, size, *args, **kwargs):
+        super(VirtualFileStat, self).__init__(None, *args, **kwargs)
+        self.st_mode = stat.S_IFREG | 0444
+        self.st_nlink = 1
+        self.st_size = size
 
 
 ###
 # FUSE F-Spot FS
 class FSpotFS(fuse.Fuse):
     """F-Spot FUSE filesystem implementation. Just readonly support
-    at the moment"""
-    def __init__(self, db_path, repeated, *args, **kwargs):
+    at the moment.
+
+    Safe for multithreaded dispatch, tags hierarchy is guarded by
+    tags_lock (readers-writer), index, listings cache and change
+    detector by their own locks."""
+    def __init__(self, db_path, repeated, cache_size=DIRCACHE_SIZE,
+                 refresh=REFRESH_INTERVAL, postings=False, passthrough=False,
+                 thumbs=None, dates=False, queries=False, trace_slow=None,
+                 snapshot=None, negative_ttl=NEGATIVE_TTL, *args, **kwargs):
         self.tags, self.reverse_tags = {}, {}
+        self.tags_lock = RWLock()
         self.db_path = db_path
         self.repeated = repeated
-        self.load_tags()
+        # serve photos as regular files instead of links
+        self.passthrough = passthrough
+        self.handles = HandlePool(HANDLES_SIZE)
+        # thumbnails.ThumbnailCache serving .thumbs directories
+        self.thumbs = thumbs
+        # query directories are evaluated over postings
+        self.index = PhotoIndex(repeated,
+                                Postings() if postings or queries else None,
+                                DateIndex() if dates else None)
+        self.listings = LRUCache(cache_size)
+        # missing paths, dropped along listings invalidations
+        self.negatives = NegativeCache(NEGATIVE_SIZE, negative_ttl)
+        # query results, expression -> (listings generation, photo ids)
+        self.queries = LRUCache(QUERY_CACHE_SIZE) if queries else None
+        self.changes = ChangeDetector(db_path, refresh)
+        # own commits must not be taken as external changes
+        on_commit(self.changes.before_commit, before=True)
+        on_commit(self.changes.after_commit)
+        # changes are applied by a thread started by fsinit, handlers
+        # serve loaded state meanwhile
+        self.refresher = None
+        self.stopping = threading.Event()
+        self.full_synced = time.time()
+        # a failed group commit leaves index and tags ahead of database
+        self.resync_pending = False
+        on_commit_error(self.commit_failed)
+        # hidden generated files, path -> callable returning contents
+        self.virtual_files = {}
+        self.stats = Stats()
+        self.stats.register('listings', self.listings)
+        self.stats.register('negatives', self.negatives)
+        self.stats.register('handles', self.handles)
+        if self.queries is not None:
+            self.stats.register('queries', self.queries)
+        if self.thumbs is not None:
+            self.stats.register('thumbs', self.thumbs)
+        on_statement(self.stats.statement)
+        self.virtual_files[STATS_FILE] = self.stats.as_json
+        # SQL statements slower than trace_slow seconds are traced
+        self.tracer = None
+        if trace_slow is not None:
+            self.tracer = SlowQueryTracer(db_path, trace_slow)
+            on_statement(self.tracer.statement)
+            self.virtual_files[TRACE_FILE] = self.tracer.as_json
+        # stats.SignalDump, started once FUSE went to background
+        self.stats_dump = None
+        # daemonize() pipe, mount is reported through it by fsinit
+        self.ready_fd = None
+        # tags and index are loaded from snapshot file if it's valid
+        self.snapshot = None
+        self.snapshot_key = None
+        if snapshot is not None:
+            features = [name for name, enabled in (('postings',
+                                                    self.index.postings),
+                                                   ('dates', self.index.dates))
+                            if enabled is not None]
+            self.snapshot = Snapshot(snapshot, db_path, features)
+        self.load()
+        close_sessions()
         super(FSpotFS, self).__init__(*args, **kwargs)
 
+    def load(self):
+        """Load tags and photos index, they're restored from snapshot
+        if it's valid, otherwise they're loaded from database and the
+        snapshot is saved."""
+        if self.snapshot is None:
+            self.load_tags()
+            self.index.load()
+            return
+        key = self.snapshot.key() # before loading, changes make it stale
+        state = self.snapshot.load(key)
+        if state is not None:
+            with self.tags_lock.writing():
+                self._load_tags(state['tags'])
+            self.index.restore(state['index'])
+            self.snapshot_key = key
+        else:
+            self.load_tags()
+            self.index.load()
+            self.save_snapshot(key)
+
+    def save_snapshot(self, key):
+        """Save tags and photos index snapshot valid for @key."""
+        with self.tags_lock.reading():
+            tags = dict((tag_id, (tag['name'], tag['parent']))
+                            for tag_id, tag in self.tags.iteritems()
+                                if tag_id != ROOT_ID)
+        try:
+            self.snapshot.save(key, {'tags': tags,
+                                     'index': self.index.state()})
+        except (IOError, OSError): # next start will load from database
+            return
+        self.snapshot_key = key
+
     def load_tags(self):
-        """Loads registered tags and internally cache them"""
-        self.tags[ROOT_ID] = {'children': {}, 'name': ROOT_NAME,
-                              'parent': None}
-        self.reverse_tags[ROOT_NAME] = ROOT_ID
-
-        tags = list(Tag.all())
-        # load tags
-        for tag in tags:
-            self.tags[tag.id] = {'children': {},
-                                 'name': tag.name,
-                                 'parent': tag.category_id}
-            self.reverse_tags[tag.name] = tag.id
+        """Loads registered tags and internally cache them. Only
+        differences with current cache are applied, returns ids of the
+        tags whose listings may have changed."""
+        return self.read_tags()()
+
+    def read_tags(self):
+        """Read registered tags, returns a function applying them to
+        tags cache (see load_tags)."""
+        rows = dict((tag.id, (tag.name, tag.category_id)) for tag in Tag.all())
+        def load():
+            with self.tags_lock.writing():
+                return self._load_tags(rows)
+        return load
+
+    def _load_tags(self, rows):
+        """Apply tags @rows (id -> (name, parent id)) to tags cache."""
+        if ROOT_ID not in self.tags:
+            self.tags[ROOT_ID] = {'children': {}, 'name': ROOT_NAME,
+                                  'parent': None}
+            self.reverse_tags[ROOT_NAME] = ROOT_ID
+
+        changed = set()
+
+        # drop removed tags
+        for tag_id in [i for i in self.tags if i != ROOT_ID and i not in rows]:
+            tag = self.tags.pop(tag_id)
+            self.reverse_tags.pop(encode(tag['name']), None)
+            if tag['parent'] in self.tags:
+                self.tags[tag['parent']]['children'].pop(tag_id, None)
+            changed.update((tag_id, tag['parent']))
+
+        # load new tags and update changed ones
+        for tag_id, (name, parent) in rows.iteritems():
+            tag = self.tags.get(tag_id)
+            if tag is None:
+                self.tags[tag_id] = {'children': {}, 'name': name,
+                                     'parent': parent}
+                self.reverse_tags[encode(name)] = tag_id
+                changed.update((tag_id, parent))
+                continue
+            if tag['name'] != name:
+                self.reverse_tags.pop(encode(tag['name']), None)
+                self.reverse_tags[encode(name)] = tag_id
+                tag['name'] = name
+            if tag['parent'] != parent:
+                if tag['parent'] in self.tags:
+                    self.tags[tag['parent']]['children'].pop(tag_id, None)
+                changed.update((tag_id, tag['parent'], parent))
+                tag['parent'] = parent
 
         # setup parent-child relations
-        for tag in tags:
-            if tag.category_id in self.tags:
-                self.tags[tag.category_id]['children'][tag.id] = self.tags[tag.id]
+        for tag_id, (name, parent) in rows.iteritems():
+            if parent in self.tags:
+                self.tags[parent]['children'][tag_id] = self.tags[tag_id]
+        return changed
+
+    def refresh(self):
+        """Reloads tags and photos if database was changed by another
+        process, only differences are applied and affected directory
+        listings invalidated. Index tables are compared in full once
+        every FULL_SYNC_INTERVAL seconds, changes missed by tables
+        signatures are caught then.
+
+        Differences are applied with the write lock held (see
+        read_applied), handlers hold it too from their commit until tags
+        and index are updated, this way no handler change is undone by
+        an older database state and no own commit is taken as
+        external."""
+        if self.resync_pending:
+            self.resync()
+        elif self.changes.changed():
+            full = time.time() - self.full_synced >= FULL_SYNC_INTERVAL
+            changed = set()
+            for value in self.read_applied(self.read_tags,
+                                           lambda: self.index.read_sync(full)):
+                changed.update(value)
+            if full:
+                self.full_synced = time.time()
+            self.listings.invalidate(*changed)
+            self.negatives.clear()
+
+    def read_applied(self, *readers):
+        """Call @readers (functions reading database and returning a
+        function that applies what was read) without the write lock, then
+        apply their results with the lock held, returns applied values.
+        Database is read again if any own write was done meanwhile (an
+        older state would undo it), it's read with the lock held after
+        READ_ATTEMPTS attempts. Handlers aren't blocked by long reads this
+        way, only while differences are applied."""
+        for attempt in xrange(READ_ATTEMPTS):
+            count = write_count()
+            appliers = [read() for read in readers]
+            with write_locked():
+                if write_count() == count:
+                    return [apply() for apply in appliers]
+        with write_locked():
+            return [read()() for read in readers]
+
+    def _refresh_loop(self):
+        """Refresher thread, calls refresh() every refresh interval
+        until unmounted."""
+        interval = self.changes.interval or REFRESH_INTERVAL
+        while not self.stopping.wait(interval):
+            try:
+                self.refresh()
+            except Exception, e: # database busy or gone, retried later
+                self.stats.failure('refresh', e)
+            finally:
+                close_sessions()
+
+    def commit_failed(self, error):
+        """Group commit failure hook (see fspotdb.on_commit_error), its
+        operations were already applied to tags and index, they are
+        reloaded by next refresh()."""
+        self.stats.failure('commit', error)
+        self.resync_pending = True
+
+    def resync(self):
+        """Reload tags and the whole photos index from database, every
+        listing is dropped."""
+        self.resync_pending = False
+        self.read_applied(self.read_tags, self.index.read_load)
+        self.listings.clear()
+        self.negatives.clear()
 
     def tag_names(self, parent=None, sorted=False):
         """Return tag names for parent or all tag names."""
@@ -135,7 +492,8 @@ class FSpotFS(fuse.Fuse):
                 tags = tags[parent]['children']
         except KeyError:
             return []
-        values = [tag['name'] for tag in tags.itervalues()]
+        with self.tags_lock.reading():
+            values = [tag['name'] for tag in tags.itervalues()]
         if sorted:
             values.sort()
         return values
@@ -148,130 +506,557 @@ class FSpotFS(fuse.Fuse):
             pass
 
     def file_names(self, tag_id=None):
-        """Return photo names tagged as @tag_id or all photos if not tag,
-        sub-tags are excluded if self.repeated is false."""
-        photos = []
-
+        """Return (photo id, name) pairs for photos tagged as @tag_id or
+        all photos if not tag, sub-tags are excluded if self.repeated is
+        false. Pairs are sorted by photo id. Results are cached until
+        invalidated by a change on the directory."""
+        names = self.listings.get(tag_id)
+        if names is None:
+            names = tuple(self.stream_names(tag_id))
+        return names
+
+    def stream_names(self, tag_id=None, after=0):
+        """Generate file_names pairs with photo id greater than @after.
+        Without cached listing, it's built (from postings or database)
+        and cached when read from the start, the kernel reads a
+        directory in several calls and following ones are served from
+        cache. Otherwise (listing evicted meanwhile) photos are read
+        from database in chunks while pairs are generated."""
+        names = self.listings.get(tag_id)
+        if names is None:
+            # discard result if invalidated while being computed
+            generation = self.listings.generation
+            if self.index.postings is not None:
+                names = self._postings_names(tag_id)
+            elif after == 0:
+                names = tuple((photo.id, photo.filename)
+                                for photo in self._file_records(tag_id))
+            if names is not None:
+                self.listings.put(tag_id, names, generation)
+        if names is not None:
+            for pos in xrange(bisect_left(names, (after + 1,)), len(names)):
+                yield names[pos]
+            return
+
+        for photo in self._file_records(tag_id, after):
+            yield photo.id, photo.filename
+
+    def _file_records(self, tag_id=None, after=0):
+        """Query photo records for stream_names."""
         if tag_id is not None:
             if tag_id == ROOT_ID:
-                photos = Tag.untagged_photos()
+                return Tag.untagged_records(after)
             elif not self.repeated:
-                tag = Tag.get(tag_id)
-                if tag:
-                    photos = tag.own_photos()
+                return Tag.own_records(tag_id, self.subtag_ids(tag_id), after)
+            else:
+                return Photo.tag_records(tag_id, after)
         else: # get all photos
-            photos = Photo.all_photos()
-
-        return [photo.filename for photo in photos]
+            return Photo.all_records(after)
+
+    def _postings_names(self, tag_id=None):
+        """Return file_names pairs from in-memory postings."""
+        postings = self.index.postings
+        subtags = self.subtag_ids(tag_id)
+        with self.index.lock.reading():
+            if tag_id is None:
+                ids = postings.all_photos()
+            elif tag_id == ROOT_ID:
+                ids = postings.untagged()
+            elif self.repeated:
+                ids = postings.by_tag(tag_id)
+            else:
+                ids = postings.own(tag_id, subtags)
+            photos = self.index.photos
+            return tuple((photo_id, photos[photo_id][0])
+                            for photo_id in ids if photo_id in photos)
+
+    def invalidate_photo(self, photo_id, *tag_ids):
+        """Invalidate cached listings where @photo_id visibility can change
+        after being tagged or untagged by @tag_ids, that's every tag on
+        the photo and the untagged photos directory."""
+        self.listings.invalidate(ROOT_ID, *(self.index.tags(photo_id) + tag_ids))
+
+    def dir_time(self, path):
+        """Return directory @path modification time, newest photo time on
+        tag directories, newest time of any photo for generated views
+        (by-date, queries) and directories without known times, None if
+        unknown."""
+        if self.thumbs is not None and basename(path) == THUMBS_DIR:
+            path = dirname(path)
+        if self.date_parts(path) is None and \
+           self.query_expression(path) is None:
+            tag_id = self.tag_to_id(basename(path))
+            if tag_id is not None and self.index.changed(tag_id):
+                return self.index.changed(tag_id)
+        return self.index.changed()
+
+    def subtag_ids(self, tag_id):
+        """Return sub-tags ids for @tag_id."""
+        try:
+            children = self.tags[tag_id]['children']
+        except KeyError:
+            return ()
+        with self.tags_lock.reading():
+            return tuple(children)
+
+    def photo_id(self, path):
+        """Return photo id for file @path or None."""
+        parts = self.date_parts(dirname(path))
+        if parts is not None:
+            return self.date_photo_id(parts, self.quote_name(basename(path)))
+        expression = self.query_expression(dirname(path))
+        if expression is not None:
+            return self.query_photo_id(expression,
+                                       self.quote_name(basename(path)))
+        tag_id = self.tag_to_id(basename(dirname(path)))
+        return self.index.find(tag_id, self.quote_name(basename(path)),
+                               self.subtag_ids(tag_id))
+
+    def listed_photos(self, path):
+        """Return (quoted file name, photo id) pairs for photos listed in
+        directory @path."""
+        parts = self.date_parts(path)
+        if parts is not None:
+            values = self.date_dir(parts)
+            if values is None or len(values) != 3: # not a day
+                return []
+            with self.index.lock.reading():
+                photos = self.index.photos
+                return [(photos[photo_id][0], photo_id)
+                            for photo_id in self.index.dates.photos(*values)
+                                if photo_id in photos]
+        expression = self.query_expression(path)
+        if expression is not None:
+            ids = self.query_photos(expression) if expression else ()
+            with self.index.lock.reading():
+                photos = self.index.photos
+                return sorted((photos[photo_id][0], photo_id)
+                                for photo_id in ids if photo_id in photos)
+        tag_id = self.tag_to_id(basename(path))
+        return [(name, photo_id)
+                    for photo_id, name in self.file_names(tag_id)]
+
+    def date_parts(self, path):
+        """Return by-date view @path components (after view directory)
+        or None if it's not in the view."""
+        if self.index.dates is None:
+            return None
+        elif path == '/' + DATES_DIR:
+            return []
+        elif path.startswith('/%s/' % DATES_DIR):
+            return path.split('/')[2:]
+
+    def date_dir(self, parts):
+        """Return (year[, month[, day]]) values for by-date view directory
+        @parts or None if there's no such directory (no photos taken that
+        date)."""
+        if len(parts) > len(DATE_FORMATS):
+            return None
+        values = []
+        for part, fmt in zip(parts, DATE_FORMATS):
+            if not part.isdigit() or fmt % int(part) != part:
+                return None
+            values.append(int(part))
+        values = tuple(values)
+        if not values: # view root
+            return values
+        period = checked_period(*values)
+        if period is None:
+            return None
+        with self.index.lock.reading():
+            return values if self.index.dates.exists(*period) else None
+
+    def date_photo_id(self, parts, name):
+        """Return id of photo with quoted file @name taken in by-date
+        view day directory @parts or None."""
+        values = self.date_dir(parts)
+        if values is None or len(values) != 3:
+            return None
+        start, end = checked_period(*values)
+        with self.index.lock.reading():
+            for photo_id in self.index.names.get(name, ()):
+                if self.index.dates.taken(photo_id, start, end):
+                    return photo_id
+
+    def query_expression(self, path):
+        """Return query directory @path expression, an empty string for
+        the query view directory or None if it's not in the view."""
+        if self.queries is None:
+            return None
+        elif path == '/' + QUERY_DIR:
+            return ''
+        elif path.startswith('/%s/' % QUERY_DIR) and path.count('/') == 2:
+            return basename(path)
+
+    def query_terms(self, expression):
+        """Return parsed query @expression with tag ids instead of names
+        or None if it's invalid or names an unknown tag."""
+        terms = parse(expression)
+        if terms is None:
+            return None
+        ids = tuple(tuple(self.tag_to_id(name) for name in names)
+                        for names in terms)
+        if any(tag_id is None for tag_ids in ids for tag_id in tag_ids):
+            return None
+        return ids
+
+    def query_photos(self, expression):
+        """Return ids of photos matching query @expression. Results are
+        cached by parsed expression until any directory listing is
+        invalidated."""
+        terms = self.query_terms(expression)
+        if terms is None:
+            return ()
+        generation = self.listings.generation
+        cached = self.queries.get(terms)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        with self.index.lock.reading():
+            ids = evaluate(terms, self.index.postings)
+        self.queries.put(terms, (generation, ids))
+        return ids
+
+    def query_photo_id(self, expression, name):
+        """Return id of photo with quoted file @name matching query
+        @expression or None."""
+        if not expression:
+            return None
+        ids = self.query_photos(expression)
+        for photo_id in self.index.names.get(name, ()):
+            pos = bisect_left(ids, photo_id)
+            if pos < len(ids) and ids[pos] == photo_id:
+                return photo_id
+
+    def read_only(self, *paths):
+        """Return True if any of @paths is in a read-only view (by-date
+        view, query directories or thumbnails directories)."""
+        for path in paths:
+            if self.date_parts(path) is not None or \
+               self.query_expression(path) is not None or \
+               self.query_expression(dirname(path)) is not None or \
+               (self.thumbs is not None and THUMBS_DIR in path.split('/')):
+                return True
+        return False
 
     def real_path(self, tag_id, name):
         """Return real file path in collection."""
-        photo = None
-
-        if tag_id == ROOT_ID:
-            result = Photo.with_version().filter(Photo.filename == name).first()
-            if result:
-                photo, version = result
-                photo.update_from_version(version)
-        else:
-            tag = Tag.get(tag_id)
-            if tag:
-                photo = tag.get_file(name)
-        return photo.path.encode('utf-8') if photo else None
+        return self.index.path(self.index.find(tag_id, self.quote_name(name),
+                                               self.subtag_ids(tag_id)))
 
     def is_dir(self, path):
         """Check if path is a directory in f-spot."""
+        if self.thumbs is not None and THUMBS_DIR in path.split('/'):
+            # thumbnails directories have no sub-directories
+            parent = dirname(path)
+            return basename(path) == THUMBS_DIR and \
+                   THUMBS_DIR not in parent.split('/') and \
+                   self.is_dir(parent)
+        parts = self.date_parts(path)
+        if parts is not None:
+            return self.date_dir(parts) is not None
+        expression = self.query_expression(path)
+        if expression is not None:
+            return not expression or \
+                   self.query_terms(expression) is not None
         return path in ('.', '..', '/') or \
-               basename(path) in [i.encode('utf-8') for i in self.tag_names()]
+               self.tag_to_id(basename(path)) is not None
+
+    def thumb_photo_id(self, path):
+        """Return id of the photo whose thumbnail is @path (a file in a
+        thumbnails directory) or None."""
+        parent = dirname(path)
+        if self.thumbs is None or basename(parent) != THUMBS_DIR:
+            return None
+        return self.photo_id(join(dirname(parent), basename(path)))
+
+    def thumb_source(self, path):
+        """Return real path of the photo whose thumbnail is @path (a file
+        in a thumbnails directory) or None."""
+        return self.index.path(self.thumb_photo_id(path))
 
     def quote_name(self, name):
         return quote(name, safe='()')
 
+    @operation
     def getattr(self, path):
-        """Getattr handler."""
-        return self._getattr(path) or -errno.ENOENT
+        """Getattr handler. Missing paths are remembered for a while,
+        probes for names that don't exist are answered right away."""
+        generation = self.listings.generation
+        if self.negatives.missing(path, generation):
+            return -errno.ENOENT
+        result = self._getattr(path)
+        if result is None:
+            self.negatives.add(path, generation)
+            return -errno.ENOENT
+        return result
 
     def _getattr(self, path):
         """Hierarchy stats builder, will return None if path is invalid."""
+        if path in self.virtual_files:
+            return VirtualFileStat(len(self.virtual_files[path]()))
         if self.is_dir(path):
-            return DirStat()
-        elif Photo.filter(filename=self.quote_name(basename(path))).first():
-            fname = basename(path)
-            tag = basename(dirname(path))
-            tag_id = self.tag_to_id(tag)
-            if self.quote_name(fname) in self.file_names(tag_id):
-                return ImageLinkStat(self.real_path(tag_id, fname))
+            return DirStat(self.dir_time(path))
+        photo_id = self.thumb_photo_id(path)
+        source = self.index.path(photo_id)
+        if source is not None: # not built here, it'd hold other operations
+            if self.thumbs.unbuildable(source):
+                return None
+            return ThumbnailStat(self.thumbs.cached(source),
+                                 self.index.time(photo_id))
+        photo_id = self.photo_id(path)
+        photo_path = self.index.path(photo_id)
+        if photo_path:
+            if self.passthrough:
+                return ImageFileStat(photo_path, self.index.time(photo_id))
+            return ImageLinkStat(photo_path, self.index.time(photo_id))
         return None
 
+    @operation
     def readlink(self, path):
         """Readlink handler."""
-        return self.real_path(self.tag_to_id(basename(dirname(path))),
-                              basename(path))
+        if self.thumb_source(path) is not None: # thumbnails aren't links
+            return -errno.EINVAL
+        photo_path = self.index.path(self.photo_id(path))
+        if photo_path is None:
+            return -errno.ENOENT
+        elif self.passthrough: # photos aren't links
+            return -errno.EINVAL
+        return photo_path
+
+    @operation
+    def open(self, path, flags):
+        """Open handler, photos in passthrough mode, thumbnails and
+        virtual files are opened read-only and served by read().
+        Otherwise nothing is done, same as FUSE default behavior."""
+        content = self.virtual_files.get(path)
+        source = self.thumb_source(path)
+        if not self.passthrough and content is None and source is None:
+            return 0
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return -errno.EACCES
+        if content is not None:
+            return VirtualFile(content())
+        if source is not None:
+            # built now if needed, size reported by getattr may be wrong
+            thumb = self.thumbs.get(source)
+            try:
+                with open(thumb or '', 'rb') as thumb_file:
+                    return VirtualFile(thumb_file.read())
+            except IOError:
+                return -errno.ENOENT
+        photo_path = self.index.path(self.photo_id(path))
+        if photo_path is None:
+            return -errno.ENOENT
+        try:
+            return self.handles.acquire(photo_path)
+        except OSError, e:
+            return -e.errno
+
+    @measured
+    def read(self, path, size, offset, fh=None):
+        """Read handler, bytes are read from collection file."""
+        if fh is None:
+            return -errno.EBADF
+        try:
+            return fh.read(size, offset)
+        except (OSError, ValueError), e:
+            return -getattr(e, 'errno', errno.EIO)
+
+    @measured
+    def release(self, path, flags, fh=None):
+        """Release handler, returns file handle to the pool."""
+        return self.release_handle(fh)
+
+    def release_handle(self, fh):
+        """Return read file handle @fh to the pool."""
+        if isinstance(fh, Handle):
+            self.handles.release(fh)
+        return 0
 
+    @operation
     def access(self, path, offset):
         """Check file access."""
         # Access granted by default at the moment, unless the file does
         # not exists
         return -errno.EINVAL if self._getattr(path) is None else 0
 
+    @operation
     def readdir(self, path, offset):
-        """Readdier handler."""
+        """Readdier handler. Entries carry their offset, a listing resumed
+        at @offset continues after the entry it belongs to. Photos in tag
+        directories are streamed in photo id order and their offset is
+        FILES_OFFSET plus the photo id, this way resuming doesn't go over
+        the previous photos again."""
+        parts = self.date_parts(path)
+        if self.thumbs is not None and basename(path) == THUMBS_DIR:
+            entries = positioned(self.thumbs_entries(dirname(path)))
+        elif parts is not None:
+            entries = positioned(self.date_entries(parts))
+        elif self.query_expression(path) is not None:
+            entries = positioned(self.query_entries(path))
+        else:
+            entries = self.tag_entries(path, offset)
+        for entry in entries:
+            if entry.offset > offset:
+                yield entry
+
+    def tag_entries(self, path, offset):
+        """Tag directory entries, sub-tags are positioned, photos are
+        generated from the one following @offset."""
         parent = self.tag_to_id(basename(path))
 
-        yield fuse.Direntry('.')
-        yield fuse.Direntry('..')
+        if offset < FILES_OFFSET:
+            dirs = ['.', '..']
+            if self.thumbs is not None:
+                dirs.append(THUMBS_DIR)
+            if self.index.dates is not None and path == '/':
+                dirs.append(DATES_DIR)
+            if self.queries is not None and path == '/':
+                dirs.append(QUERY_DIR)
+            dirs.extend(unquote(encode(name))
+                            for name in self.tag_names(parent, sorted=True))
+            for entry in positioned(fuse.Direntry(name) for name in dirs):
+                yield entry
+            after = 0
+        else:
+            after = offset - FILES_OFFSET
 
-        for name in self.tag_names(parent, sorted=True):
-            yield fuse.Direntry(unquote(name.encode('utf-8')))
+        file_type = FILE_TYPE if self.passthrough else LINK_TYPE
+        for photo_id, name in self.stream_names(parent, after):
+            yield fuse.Direntry(unquote(encode(name)), type=file_type,
+                                offset=FILES_OFFSET + photo_id)
 
-        for name in self.file_names(parent):
-            yield fuse.Direntry(unquote(name.encode('utf-8')), type=LINK_TYPE)
+    def thumbs_entries(self, path):
+        """Thumbnails directory entries for photos in directory @path,
+        thumbnails are built in background for them. Photos whose
+        thumbnail can't be built aren't listed."""
+        photos = self.listed_photos(path)
+        self.thumbs.warm(self.index.path(photo_id) for name, photo_id in photos)
+
+        yield fuse.Direntry('.')
+        yield fuse.Direntry('..')
+        for name, photo_id in photos:
+            if not self.thumbs.unbuildable(self.index.path(photo_id)):
+                yield fuse.Direntry(unquote(encode(name)), type=FILE_TYPE)
+
+    def date_entries(self, parts):
+        """By-date view directory entries, years, months and days with
+        photos are listed as directories, photos taken that day in days
+        directories."""
+        values = self.date_dir(parts)
+        if values is None:
+            return
+        dates = self.index.dates
+        with self.index.lock.reading():
+            if len(values) == 0:
+                children = dates.years()
+            elif len(values) == 1:
+                children = dates.months(*values)
+            elif len(values) == 2:
+                children = dates.days(*values)
+            else:
+                children = []
+        fmt = DATE_FORMATS[min(len(values), len(DATE_FORMATS) - 1)]
 
+        yield fuse.Direntry('.')
+        yield fuse.Direntry('..')
+        for value in children:
+            yield fuse.Direntry(fmt % value)
+        if len(values) == 3: # day, list photos
+            if self.thumbs is not None:
+                yield fuse.Direntry(THUMBS_DIR)
+            file_type = FILE_TYPE if self.passthrough else LINK_TYPE
+            for name, photo_id in self.listed_photos(
+                    '/'.join(['', DATES_DIR] + parts)):
+                yield fuse.Direntry(unquote(encode(name)), type=file_type)
+
+    def query_entries(self, path):
+        """Query directory entries, photos matching the expression. The
+        query view directory itself is empty, expressions are parsed on
+        lookup."""
+        yield fuse.Direntry('.')
+        yield fuse.Direntry('..')
+        if self.query_expression(path):
+            if self.thumbs is not None:
+                yield fuse.Direntry(THUMBS_DIR)
+            file_type = FILE_TYPE if self.passthrough else LINK_TYPE
+            for name, photo_id in self.listed_photos(path):
+                yield fuse.Direntry(unquote(encode(name)), type=file_type)
+
+    @operation
     def mkdir(self, path, mode):
         """Register new tag or sub-tag and display it as a new directory."""
+        if self.read_only(path):
+            return -errno.EROFS
         name = basename(path)
         parent_id = self.tag_to_id(basename(dirname(path)))
         if parent_id is not None:
-            # register in database
-            tag = Tag(id=None, name=name.encode('utf-8'), category_id=parent_id)
-            tag.add()
-            # register in cache
-            self.tags[tag.id] = {'children': {}, 'name': tag.name,
-                                 'parent': tag.category_id}
-            self.reverse_tags[tag.name] = tag.id
-            self.tags[parent_id]['children'][tag.id] = self.tags[tag.id]
+            with write_locked(): # see refresh()
+                # register in database
+                tag = Tag(id=None, name=name.encode('utf-8'),
+                          category_id=parent_id)
+                tag.add()
+                # register in cache
+                with self.tags_lock.writing():
+                    self.tags[tag.id] = {'children': {}, 'name': tag.name,
+                                         'parent': tag.category_id}
+                    self.reverse_tags[tag.name] = tag.id
+                    self.tags[parent_id]['children'][tag.id] = \
+                        self.tags[tag.id]
+            self.listings.invalidate(tag.id)
+            self.negatives.clear()
             return 0
         else:
             return -errno.EINVAL
 
+    @operation
     def unlink(self, path):
         """Unlink files. It's interpreted as unttagging, not remove."""
+        if self.read_only(path):
+            return -errno.EROFS
         tag_id = self.tag_to_id(basename(dirname(path)))
         if tag_id is None:
             return -errno.EINVAL
-        photo = Photo.filter(filename=basename(path)).first()
-        if photo is None:
+        photo_id = self.photo_id(path)
+        if photo_id is None:
             return -errno.ENOENT
-        PhotoTag.filter(tag_id=tag_id, photo_id=photo.id).first().delete()
+        with write_locked(): # see refresh()
+            PhotoTag.delete_by(tag_id=tag_id, photo_id=photo_id)
+            self.index.untag(photo_id, tag_id)
+        self.invalidate_photo(photo_id, tag_id)
         return 0
 
+    @operation
     def rmdir(self, path):
         """Removes a directory, unregister the tags and the photos tagged
         by it. Only subdirectories without sub-directories (tags without
         sub-tags).
         """
-        tag = Tag.get(self.tag_to_id(basename(path)))
+        if self.read_only(path):
+            return -errno.EROFS
+        tag_id = self.tag_to_id(basename(path))
+        tag = Tag.find(id=tag_id) if tag_id else None
         if tag:
-            # update cache
-            self.tags[self.tags[tag.id]['parent']]['children'].pop(tag.id, None)
-            self.tags.pop(tag.id)
-            self.reverse_tags.pop(tag.name)
-            # delete from db
-            tag.delete()
+            if self.tags[tag.id]['children']:
+                return -errno.ENOTEMPTY
+            with write_locked(): # see refresh()
+                # delete from db
+                tag.delete()
+                # update cache
+                with self.tags_lock.writing():
+                    parent = self.tags[self.tags[tag.id]['parent']]
+                    parent['children'].pop(tag.id, None)
+                    self.tags.pop(tag.id)
+                    self.reverse_tags.pop(encode(tag.name))
+                photo_ids = self.index.drop_tag(tag.id)
+            for photo_id in photo_ids:
+                self.invalidate_photo(photo_id)
+            self.listings.invalidate(tag.id, tag.category_id, ROOT_ID)
             return 0
         else:
             return -errno.ENOENT
 
+    @operation
     def rename(self, old_path, new_path):
         """Renaming handler.
 
@@ -279,18 +1064,25 @@ class FSpotFS(fuse.Fuse):
             * Rename photos
             * Rename into other directory (move)
         """
+        if self.read_only(old_path, new_path):
+            return -errno.EROFS
         old_tag, new_tag = basename(old_path), basename(new_path)
         if new_tag in self.reverse_tags: # new name already exists
             return -errno.EINVAL
 
-        tag = Tag.get(self.tag_to_id(old_tag))
+        tag_id = self.tag_to_id(old_tag)
+        tag = Tag.find(id=tag_id) if tag_id else None
         if tag:
-            tag.name = new_tag
-            tag.update()
-            # update cache
-            self.reverse_tags.pop(old_tag)
-            self.tags[tag.id]['name'] = new_tag
-            self.reverse_tags[new_tag] = tag.id
+            with write_locked(): # see refresh()
+                tag.name = new_tag
+                tag.update()
+                # update cache
+                with self.tags_lock.writing():
+                    self.reverse_tags.pop(old_tag)
+                    self.tags[tag.id]['name'] = new_tag
+                    self.reverse_tags[new_tag] = tag.id
+            self.negatives.clear()
+            return 0
         else: # original tag does not exist
             return -errno.ENOENT
 
@@ -302,6 +1094,7 @@ class FSpotFS(fuse.Fuse):
         """Chown support (called when moving images)"""
         return 0
 
+    @operation
     def symlink(self, source, target):
         """Linking or symbolic link copying handler.
 
@@ -310,17 +1103,55 @@ class FSpotFS(fuse.Fuse):
 
         Linking from outside is not supported.
         """
-        name = basename(source)
-        photo = Photo.filter(filename=name).first()
-        if photo is not None:
+        if self.read_only(target):
+            return -errno.EROFS
+        photo_id = self.index.find_by_name(self.quote_name(basename(source)))
+        if photo_id is not None:
             tag_id = self.tag_to_id(basename(dirname(target)))
-            pt = PhotoTag.filter(tag_id=tag_id, photo_id=photo.id).first()
-            if pt is None:
-                PhotoTag(tag_id=tag_id, photo_id=photo.id).add()
+            with write_locked(): # see refresh()
+                if PhotoTag.find(tag_id=tag_id, photo_id=photo_id) is None:
+                    PhotoTag(tag_id=tag_id, photo_id=photo_id).add()
+                self.index.tag(photo_id, tag_id)
+            self.invalidate_photo(photo_id, tag_id)
+            self.negatives.clear()
             return 0
         else:
             return -errno.ENOSYS
 
+    def fsinit(self):
+        """Mount handler, FUSE is already in background."""
+        if self.ready_fd is not None:
+            detach(self.ready_fd)
+            self.ready_fd = None
+        if self.stats_dump is not None:
+            self.stats_dump.start()
+        self.refresher = threading.Thread(target=self._refresh_loop)
+        self.refresher.daemon = True
+        self.refresher.start()
+
+    def fsdestroy(self):
+        """Unmount handler, commits pending changes. Snapshot is updated
+        if database changed since it was saved."""
+        if self.refresher is not None:
+            self.stopping.set()
+            self.refresher.join()
+        try:
+            commit_pending()
+        except Exception: # reported to commit_failed, resynced below
+            pass
+        if self.snapshot is not None:
+            key = self.snapshot.key()
+            if key != self.snapshot_key:
+                if self.resync_pending:
+                    self.resync()
+                else:
+                    self.load_tags()
+                    self.index.sync()
+                self.save_snapshot(key)
+            close_sessions()
+        if self.thumbs is not None:
+            self.thumbs.close()
+
     def base_uri(self, path):
         """Builds baseuri for path.
 
@@ -337,146 +1168,434 @@ class FSpotFSWrite(FSpotFS):
     """FSpotFS with write support (alows adding new images to collection)"""
     def __init__(self, *args, **kwargs):
         self.creation_pool = {}
+        self.pool_lock = threading.Lock()
+        self.collection_root = kwargs.pop('collection_root', None) or \
+                               COLLECTION_ROOT
+        # written files are staged in collection filesystem, this way
+        # they are moved to final location with a rename
+        self.staging = join(self.collection_root, STAGING_DIR)
+        # serializes destination checks and moves between import workers
+        self.place_lock = threading.Lock()
+        workers = kwargs.pop('ingest', 0)
+        batch = kwargs.pop('ingest_batch', INGEST_BATCH)
         super(FSpotFSWrite, self).__init__(*args, **kwargs)
+        # imports are done in background by a workers pool if enabled
+        self.ingest = None
+        if workers > 0:
+            self.ingest = IngestQueue(self, workers, batch)
+            self.virtual_files[INGEST_STATUS] = self.ingest.report
+
+    def fsdestroy(self):
+        """Unmount handler, waits for pending imports."""
+        if self.ingest is not None:
+            self.ingest.stop()
+        super(FSpotFSWrite, self).fsdestroy()
 
     def _getattr(self, path):
-        """Hierarchy stats builder, will return None if path is invalid."""
+        """Hierarchy stats builder, will return None if path is invalid.
+        Files being written or waiting to be imported are shown as new
+        files."""
         result = super(FSpotFSWrite, self)._getattr(path)
-        if result is None and path in self.creation_pool:
-            result = NewFileState()
+        if result is None:
+            file = self.creation_pool.get(path)
+            if file is not None:
+                result = NewFileState(file.size)
         return result
 
+    @measured
     def create(self, path, flags, mode):
         """Create file handler."""
-        if path not in self.creation_pool:
-            # Register path in our creation pool, this way avoid
-            # failures to OS on getattr
-            self.creation_pool[path] = PhotoFile(self, path, flags, mode)
-        return self.creation_pool[path]
-
+        if self.read_only(path):
+            return -errno.EROFS
+        with self.pool_lock:
+            file = self.creation_pool.get(path)
+            if file is not None and file.released: # import in progress
+                return -errno.EBUSY
+            if file is None:
+                if not isdir(self.staging):
+                    try:
+                        os.makedirs(self.staging)
+                    except OSError, e:
+                        return -e.errno
+                # Register path in our creation pool, this way avoid
+                # failures to OS on getattr
+                self.creation_pool[path] = PhotoFile(self, path, flags, mode,
+                                                     self.staging)
+                self.negatives.clear()
+            return self.creation_pool[path]
+
+    @measured
     def write(self, path, buff, offs, data=None):
         """Write file handler."""
-        if path not in self.creation_pool: # file was not created
+        photo = data or self.creation_pool.get(path)
+        if photo is None: # file was not created
             return -errno.ENOENT
-        photo = data or self.creation_pool[path]
         return photo.write(buff, offs)
 
+    @measured
     def flush(self, path, data):
         """Flush buffers contents."""
         return data.flush()
 
+    @operation
     def release(self, path, flags, data=None):
         """Release file handler.
 
         Will move temporary written file to collection structure and tag
-        properly.
+        properly. When an ingest queue is enabled it's done in background
+        and the file is shown as a new file until it's registered in
+        database.
         """
-        if path not in self.creation_pool: # file was not created
-            return -errno.ENOENT
+        if data is not None and not isinstance(data, PhotoFile):
+            # passthrough or virtual file read handle
+            return self.release_handle(data)
+
+        with self.pool_lock:
+            if path not in self.creation_pool: # file was not created
+                return -errno.ENOENT
+            file = data or self.creation_pool[path]
+            if file.released:
+                return -errno.EINVAL
+            file.released = True
+        self.negatives.clear()
+
+        if self.ingest is not None:
+            self.ingest.put(file)
+            return 0
 
-        file = data or self.creation_pool.pop(path, None)
-        if not file:
-            return -errno.EINVAL
+        item = self.place_import(file)
+        if not isinstance(item, PlacedFile):
+            self.discard_import(file)
+            return item
+        try:
+            self.register_imports([item])
+        except:
+            self.discard_import(file)
+            raise
+        return 0
 
+    def place_import(self, file):
+        """Move released @file to collection structure, returns a
+        PlacedFile instance or an error number if file can't be imported.
+        Files with the same contents of a registered photo aren't moved,
+        the photo is just tagged. Database is not modified."""
         tag_id = self.tag_to_id(basename(dirname(file.path)))
         if tag_id is None: # destination tag does not exists
-            file.clean()
             return -errno.EINVAL
 
-        try: # open image on temporary location
-            img = Image.open(file.tmp_path)
-        except IOError:
-            file.clean()
-            return -errno.EINVAL
+        file.close()
+        md5_sum = file.digest()
+        photo_id = self.index.find_by_hash(md5_sum)
+        if photo_id is not None: # duplicated contents
+            return PlacedFile(file, tag_id, photo_id=photo_id)
 
-        try: # try to get date from exif
-            exif_date = img._getexif()[DATETIME_ID]
-            date = datetime.strptime(exif_date, EXIF_DATEFORMAT)
-        except (AttributeError, KeyError, TypeError, ValueError): # use today date in error
-            date = datetime.now()
+        try:
+            date = self.image_date(file) or datetime.now()
+        except IOError: # not an image
+            return -errno.EINVAL
 
         # build base path /collection-root/<year>/<month>/<day>/
-        base = join(COLLECTION_ROOT, str(date.year),
+        base = join(self.collection_root, str(date.year),
                     '%02d' % date.month, '%02d' % date.day)
         if not isdir(base): # build collection directory
             try:
                 os.makedirs(base)
             except OSError:
-                file.clean()
-                return -error.EINVAL
+                if not isdir(base): # not created by another worker
+                    return -errno.EINVAL
 
         name = basename(file.path)
-        base_uri = self.base_uri(base)
-
         # ovewrite is not supported, lets assume they are the same
         # files and retag it
         dest = join(base, name)
-        if not isfile(dest):
-            try:
-                shutil.move(file.tmp_path, dest)
-            except OSError:
-                file.clean()
-                return -error.EINVAL
-
-            # register on database
-            photo = Photo(id=None, time=int(time.time()), base_uri=base_uri,
-                          default_version_id=1, filename=name)
-            photo.add()
-            # TODO: 'Original' string has i18n ?
-            pv = PhotoVersion(photo_id=photo.id, version_id=1, name='Original',
-                              filename=photo.filename, base_uri=photo.base_uri)
-            pv.add()
-        else:
-            photo = Photo.filter(base_uri=base_uri, filename=name).first()
-
-        if photo and tag_id != ROOT_ID and \
-           not PhotoTag.filter(tag_id=tag_id, photo_id=photo.id).first():
-            PhotoTag(tag_id=tag_id, photo_id=photo.id).add()
-
+        with self.place_lock:
+            new = not isfile(dest)
+            if new:
+                try: # same filesystem, just a rename
+                    os.rename(file.tmp_path, dest)
+                except OSError:
+                    try:
+                        shutil.move(file.tmp_path, dest)
+                    except (IOError, OSError):
+                        return -errno.EINVAL
+        return PlacedFile(file, tag_id, self.base_uri(base),
+                          self.quote_name(name), new, md5_sum,
+                          time=int(time.mktime(date.timetuple())))
+
+    def register_imports(self, items):
+        """Register placed files @items in database in a single
+        transaction, then update index and caches and forget them."""
+        with write_locked(): # see refresh()
+            with write_transaction() as session:
+                for item in items:
+                    if item.photo_id is not None: # duplicate, just tag it
+                        photo = session.query(Photo).get(item.photo_id)
+                    elif item.new:
+                        photo = Photo(id=None, time=item.time,
+                                      base_uri=item.base_uri,
+                                      default_version_id=1,
+                                      filename=item.filename,
+                                      md5_sum=item.md5_sum)
+                        session.add(photo)
+                        session.flush() # get photo id
+                        # TODO: 'Original' string has i18n ?
+                        session.add(PhotoVersion(photo_id=photo.id,
+                                                 version_id=1,
+                                                 name='Original',
+                                                 filename=photo.filename,
+                                                 base_uri=photo.base_uri))
+                    else:
+                        photo = session.query(Photo)\
+                                       .filter_by(base_uri=item.base_uri,
+                                                  filename=item.filename)\
+                                       .first()
+                    item.photo_id = photo.id if photo else None
+                    if photo is None:
+                        continue
+                    if item.tag_id != ROOT_ID and \
+                       not session.query(PhotoTag)\
+                                  .filter_by(tag_id=item.tag_id,
+                                             photo_id=photo.id).first():
+                        session.add(PhotoTag(tag_id=item.tag_id,
+                                             photo_id=photo.id))
+
+            for item in items:
+                if item.photo_id is None:
+                    continue
+                if item.new:
+                    self.index.add_photo(item.photo_id, item.base_uri,
+                                         item.filename, item.md5_sum,
+                                         item.time)
+                if item.tag_id != ROOT_ID:
+                    self.index.tag(item.photo_id, item.tag_id)
+        for item in items:
+            if item.photo_id is not None:
+                self.invalidate_photo(item.photo_id, item.tag_id)
+        if any(item.new for item in items):
+            self.listings.invalidate(None)
+
+        for item in items:
+            self.discard_import(item.file)
+
+    def discard_import(self, file):
+        """Remove @file from creation pool and its staging file."""
+        with self.pool_lock:
+            if self.creation_pool.get(file.path) is file:
+                del self.creation_pool[file.path]
         file.clean()
-        return 0
+
+    def image_date(self, file):
+        """Return exif date for written @file or None. Header parsed while
+        writing is used if it's a JPEG or TIFF file, otherwise file is
+        opened with PIL, IOError is raised if it's not an image."""
+        if file.header.kind:
+            return file.header.date
+        img = Image.open(file.tmp_path)
+        try:
+            return datetime.strptime(img._getexif()[DATETIME_TAG],
+                                     EXIF_DATEFORMAT)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
 
 
 class PhotoFile(object):
     """New Photo file object"""
-    def __init__(self, fspotfs, path, flags, mode):
+    def __init__(self, fspotfs, path, flags, mode, staging=None):
         """Init method
 
             @fspotfs: fspotfs instance
             @path: destination path
             @flags: file flags
             @mode: opening mode
+            @staging: directory where file is written
         """
         self.fspotfs = fspotfs
         self.path = path
-        self.tmp_path = tempfile.mktemp()
-        self.file = open(self.tmp_path, 'w+')
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.import-', dir=staging)
+        self.file = os.fdopen(fd, 'w+b')
+        self.position = 0
+        self.size = 0
+        self.released = False # release() was called, import pending
+        # contents hash, updated while data is written sequentially
+        self.md5 = hashlib.md5()
+        self.hashed = 0
+        self.header = HeaderParser()
+        self.lock = threading.Lock()
 
     def write(self, buff, offset):
         """Write method"""
-        self.file.seek(offset)
-        self.file.write(buff) # write to temp file
+        with self.lock:
+            if offset != self.position: # seek only on non sequential writes
+                self.file.seek(offset)
+            self.file.write(buff) # write to staging file
+            self.position = offset + len(buff)
+            self.size = max(self.size, self.position)
+            self.header.feed(buff, offset)
+            if self.md5 is not None:
+                if offset == self.hashed:
+                    self.md5.update(buff)
+                    self.hashed += len(buff)
+                else: # rewrite or gap, hashed again by digest()
+                    self.md5 = None
         return len(buff)
 
+    def digest(self):
+        """Return contents md5 sum as an hex string. Staging file is read
+        only if data wasn't written sequentially."""
+        with self.lock:
+            if self.md5 is None or self.hashed != self.size:
+                self.md5 = hashlib.md5()
+                with open(self.tmp_path, 'rb') as file:
+                    for chunk in iter(lambda: file.read(64 * 1024), ''):
+                        self.md5.update(chunk)
+                self.hashed = self.size
+            return self.md5.hexdigest()
+
+    def close(self):
+        """Close staging file"""
+        self.file.close()
+
     def clean(self):
         """Clean, will close and remove temporary files"""
         self.file.close()
-        return os.remove(self.tmp_path)
+        if exists(self.tmp_path):
+            os.remove(self.tmp_path)
 
     def flush(self):
         """Flush file buffer"""
         return self.file.flush()
 
 
+class VirtualFile(object):
+    """Open generated file, contents are fixed at open() time."""
+    # contents size can differ from the one reported by getattr
+    direct_io = True
+
+    def __init__(self, content):
+        self.content = content
+
+    def read(self, size, offset):
+        """Return up to @size bytes from @offset."""
+        return self.content[offset:offset + size]
+
+
+def param_error(msg, parser):
+    """Print message followed by options usage and exit."""
+    print >>sys.stderr, msg, '\n'
+    parser.print_help()
+    sys.exit(1)
+
+
+def daemonize():
+    """Fork to background the way FUSE would, but from Python, this way
+    the interpreter knows about the new process (FUSE C fork leaves
+    Python signal handlers ignoring signals). Parent exits once child
+    reports it's mounted (see detach), or with error status if it exits
+    before. Returns child end of the report pipe."""
+    read_fd, write_fd = os.pipe()
+    if os.fork():
+        os.close(write_fd)
+        os._exit(0 if os.read(read_fd, 1) else 1)
+    os.close(read_fd)
+    os.setsid()
+    os.chdir('/')
+    return write_fd
+
+
+def detach(ready_fd):
+    """Report mount through daemonize() @ready_fd, standard streams are
+    redirected to /dev/null since nobody reads them from now on."""
+    os.write(ready_fd, '1')
+    os.close(ready_fd)
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    os.close(null)
+
+
+def database_file(fsdb=None):
+    """Return F-Spot database path, @fsdb overrides default location
+    (relative to user HOME if not absolute)."""
+    if fsdb:
+        if not isabs(fsdb):
+            fsdb = join(os.environ['HOME'], fsdb)
+        return fsdb
+    elif 'XDG_CONFIG_HOME' in os.environ:
+        # build F-Spot database path with XDG enviroment values
+        return join(os.environ['XDG_CONFIG_HOME'], FSPOT_DB_FILE)
+    else:
+        # build F-Spot database HOME enviroment value
+        return join(os.environ['HOME'], '.config', FSPOT_DB_FILE)
+
+
+def read_paths(stream):
+    """Return real paths listed in @stream, one per line. Glob patterns
+    are expanded, links (like photos in a mounted F-Spot FS) resolved."""
+    paths = []
+    for line in stream:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        names = glob.glob(line) if glob.has_magic(line) else [line]
+        paths.extend(os.path.realpath(name) for name in names)
+    return paths
+
+
+def bulk(command, argv):
+    """Tag (or untag) photos listed on standard input, without going
+    through a mounted filesystem. Photos are resolved and (un)tagged
+    in bulk, in a single transaction."""
+    parser = OptionParser(usage='%%prog %s [options] TAG < paths' % command,
+                          description='%s photos listed (paths or glob' \
+                                      ' patterns) on standard input' \
+                                      % command.capitalize())
+    parser.add_option('-d', '--fsdb', action='store', type='string',
+                      dest='fsdb', default='',
+                      help='Path to F-Spot sqlite database.')
+    try:
+        opts, args = parser.parse_args(argv)
+    except OptionError, e: # Invalid option
+        param_error(str(e), parser)
+    if len(args) != 1:
+        param_error('A tag name is required', parser)
+
+    fspot_db = database_file(opts.fsdb)
+    if not isfile(fspot_db):
+        param_error('File "%s" not found' % fspot_db, parser)
+    init_session('sqlite:///' + fspot_db)
+
+    name = args[0].decode('utf-8')
+    tag = Tag.filter(name=name).first()
+    if tag is None:
+        param_error('Tag "%s" not found' % args[0], parser)
+
+    start = time.time()
+    paths = read_paths(sys.stdin)
+    ids = Photo.ids_by_path(paths)
+    with write_transaction() as session:
+        if command == 'tag':
+            count = PhotoTag.tag_photos(session, tag.id, ids.values())
+        else:
+            count = PhotoTag.untag_photos(session, tag.id, ids.values())
+    elapsed = time.time() - start
+
+    for path in paths:
+        if path not in ids:
+            print >>sys.stderr, 'Not in collection: %s' % path
+    print '%s %d photos (%d paths, %d not found) in %.2fs, %.0f paths/s' % \
+          ('Tagged' if command == 'tag' else 'Untagged', count, len(paths),
+           len(paths) - len(ids), elapsed, len(paths) / max(elapsed, 1e-6))
+
+
 def run():
-    """Parse commandline options and run server"""
-    def param_error(msg, parser):
-        """Print message followed by options usage and exit."""
-        print >>sys.stderr, msg, '\n'
-        parser.print_help()
-        sys.exit(1)
-
-    parser = OptionParser(usage='%prog [options]', description=DESCRIPTION)
+    """Parse commandline options and run server (or run a tag/untag
+    subcommand)"""
+    if len(sys.argv) > 1 and sys.argv[1] in BULK_COMMANDS:
+        return bulk(sys.argv[1], sys.argv[2:])
+
+    parser = OptionParser(usage='%prog [options]\n' \
+                                '       %prog tag|untag [options] TAG < paths',
+                          description=DESCRIPTION)
     parser.add_option('-d', '--fsdb', action='store', type='string',
                       dest='fsdb', default='',
                       help='Path to F-Spot sqlite database.')
@@ -490,6 +1609,96 @@ def run():
                       dest='dbversion', default=FSPOT_DB_VERSION,
                       help='F-Spot database schema version to use' \
                            ' (default v%s)' % FSPOT_DB_VERSION)
+    parser.add_option('--postings', action='store_true', dest='postings',
+                      help='Keep tag membership in memory and list' \
+                           ' directories from it instead of querying' \
+                           ' database (default False)')
+    parser.add_option('-p', '--passthrough', action='store_true',
+                      dest='passthrough',
+                      help='Show photos as regular files instead of links' \
+                           ' to collection files (default False)')
+    parser.add_option('--refresh', action='store', type='float',
+                      dest='refresh', default=REFRESH_INTERVAL,
+                      help='Seconds between checks for changes made to' \
+                           ' database by F-Spot, 0 disables them' \
+                           ' (default %s)' % REFRESH_INTERVAL)
+    parser.add_option('--negative-ttl', action='store', type='float',
+                      dest='negative_ttl', default=NEGATIVE_TTL,
+                      help='Seconds missing paths are remembered, 0' \
+                           ' disables it (default %s)' % NEGATIVE_TTL)
+    parser.add_option('--entry-timeout', action='store', type='float',
+                      dest='entry_timeout', default=ENTRY_TIMEOUT,
+                      help='Seconds the kernel caches names lookups' \
+                           ' (default %s)' % ENTRY_TIMEOUT)
+    parser.add_option('--attr-timeout', action='store', type='float',
+                      dest='attr_timeout', default=ATTR_TIMEOUT,
+                      help='Seconds the kernel caches files and' \
+                           ' directories attributes (default %s)' % \
+                           ATTR_TIMEOUT)
+    parser.add_option('--negative-timeout', action='store', type='float',
+                      dest='negative_timeout', default=NEGATIVE_TIMEOUT,
+                      help='Seconds the kernel caches names that were not' \
+                           ' found (default %s)' % NEGATIVE_TIMEOUT)
+    parser.add_option('--kernel-cache', action='store_true',
+                      dest='kernel_cache',
+                      help='Keep photos contents in kernel' \
+                           ' page cache between opens, collection files' \
+                           ' must not be modified while mounted' \
+                           ' (default False)')
+    parser.add_option('-t', '--threads', action='store', type='int',
+                      dest='threads', default=1,
+                      help='Database connections for concurrent FUSE' \
+                           ' operations, 1 serves them in a single thread' \
+                           ' (default 1)')
+    parser.add_option('-c', '--commit-window', action='store', type='float',
+                      dest='commit_window', default=COMMIT_WINDOW,
+                      help='Seconds changes are grouped in a single database' \
+                           ' commit, 0 commits every change' \
+                           ' (default %s)' % COMMIT_WINDOW)
+    parser.add_option('-i', '--ingest', action='store', type='int',
+                      dest='ingest', default=0,
+                      help='Import written files in background with this' \
+                           ' many workers, 0 imports them on close' \
+                           ' (default 0)')
+    parser.add_option('--batch', action='store', type='int',
+                      dest='batch', default=INGEST_BATCH,
+                      help='Background imports registered per database' \
+                           ' transaction (default %s)' % INGEST_BATCH)
+    parser.add_option('--by-date', action='store_true', dest='dates',
+                      help='Show photos by date in a %s directory' \
+                           ' (default False)' % DATES_DIR)
+    parser.add_option('--query', action='store_true', dest='queries',
+                      help='Evaluate tags queries like %s/A&B or %s/A|B' \
+                           ' as directories, implies --postings' \
+                           ' (default False)' % (QUERY_DIR, QUERY_DIR))
+    parser.add_option('--thumbs', action='store_true', dest='thumbs',
+                      help='Show photos thumbnails in %s sub-directories' \
+                           ' (default False)' % THUMBS_DIR)
+    parser.add_option('--thumbs-cache', action='store', type='int',
+                      dest='thumbs_cache', default=CACHE_LIMIT / 1024 / 1024,
+                      help='Megabytes used by cached thumbnails' \
+                           ' (default %s)' % (CACHE_LIMIT / 1024 / 1024))
+    parser.add_option('--snapshot', action='store_true',
+                      dest='snapshot',
+                      help='Keep a snapshot of tags and photos index in' \
+                           ' $XDG_CACHE_HOME/%s for faster startup' \
+                           ' (default False)' % SNAPSHOTS_DIR)
+    parser.add_option('--stats-dump', action='store', type='string',
+                      dest='stats_dump',
+                      help='File where stats are written on SIGUSR1' \
+                           ' (default $XDG_CACHE_HOME/%s)' % STATS_DUMP)
+    parser.add_option('--trace-slow', action='store', type='float',
+                      dest='trace_slow',
+                      help='Record SQL statements slower than given' \
+                           ' milliseconds, with query plan and handler that' \
+                           ' run them, in %s file (default disabled)' % \
+                           TRACE_FILE)
+    parser.add_option('--indexes', action='store_true', dest='indexes',
+                      help='Add indexes for file name and tag lookups to' \
+                           ' database if missing (default False)')
+    parser.add_option('--drop-indexes', action='store_true',
+                      dest='drop_indexes',
+                      help='Remove indexes added by --indexes and exit')
     parser.add_option('-l', '--log', action='store_true', dest='log',
                       help='Shows FUSE log (default False)')
     try:
@@ -497,23 +1706,13 @@ def run():
     except OptionError, e: # Invalid option
         param_error(str(e), parser)
 
-    # override F-Spot database path
-    if opts.fsdb:
-        fspot_db = opts.fsdb
-        if not isabs(fspot_db):
-            fspot_db = join(os.environ['HOME'], fspot_db)
-    elif 'XDG_CONFIG_HOME' in os.environ:
-        # build F-Spot database path with XDG enviroment values
-        fspot_db = join(os.environ['XDG_CONFIG_HOME'], FSPOT_DB_FILE)
-    else:
-        # build F-Spot database HOME enviroment value
-        fspot_db = join(os.environ['HOME'], '.config', FSPOT_DB_FILE)
-
+    fspot_db = database_file(opts.fsdb)
     if not isfile(fspot_db):
         param_error('File "%s" not found' % fspot_db, parser)
 
     # initializes database session
-    init_session('sqlite:///' + fspot_db, opts.log)
+    init_session('sqlite:///' + fspot_db, opts.log, max(opts.threads, 1))
+    group_commits(opts.commit_window)
 
     # check database schema compatibility
     try:
@@ -527,19 +1726,71 @@ def run():
                                                 opts.dbversion),
                     parser)
 
-    mountpoint = opts.mountpoint
+    if opts.drop_indexes:
+        drop_indexes()
+        return
+    elif opts.indexes:
+        create_indexes()
+
+    mountpoint = os.path.abspath(opts.mountpoint) # see daemonize
     if not exists(mountpoint) or not isdir(mountpoint):
         param_error('Invalid mountpoint "%s"' % mountpoint, parser)
 
     fuse.fuse_python_api = (0, 2)
     args = fuse.FuseArgs()
     args.mountpoint = mountpoint
+    # run() goes to background itself, see daemonize
+    args.setmod('foreground')
     if opts.log:
         args.add('debug')
+    # lookups and stats cached by the kernel, changes made through the
+    # mount are applied by the kernel to the paths it passes, other
+    # directories catch up when timeouts expire
+    args.add('entry_timeout', '%g' % opts.entry_timeout)
+    args.add('attr_timeout', '%g' % opts.attr_timeout)
+    args.add('negative_timeout', '%g' % opts.negative_timeout)
+    if opts.kernel_cache: # virtual files and thumbnails are direct_io
+        args.add('kernel_cache')
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+                 join(os.environ['HOME'], '.cache')
+    thumbs = None
+    if opts.thumbs:
+        thumbs = ThumbnailCache(join(cache_home, THUMBS_CACHE_DIR),
+                                opts.thumbs_cache * 1024 * 1024)
+
+    snapshot = None
+    if opts.snapshot:
+        snapshot = join(cache_home, SNAPSHOTS_DIR,
+                        hashlib.md5(fspot_db).hexdigest() + '.snap')
+    trace_slow = None
+    if opts.trace_slow is not None:
+        trace_slow = opts.trace_slow / 1000.0
 
     # run server
-    Klass = FSpotFS if DISABLE_IMPORT else FSpotFSWrite
-    Klass(fspot_db, opts.repeated, fuse_args=args).main()
+    if DISABLE_IMPORT:
+        server = FSpotFS(fspot_db, opts.repeated, refresh=opts.refresh,
+                         postings=opts.postings, passthrough=opts.passthrough,
+                         thumbs=thumbs, dates=opts.dates,
+                         queries=opts.queries, trace_slow=trace_slow,
+                         snapshot=snapshot, negative_ttl=opts.negative_ttl,
+                         fuse_args=args)
+    else:
+        server = FSpotFSWrite(fspot_db, opts.repeated, refresh=opts.refresh,
+                              postings=opts.postings,
+                              passthrough=opts.passthrough, thumbs=thumbs,
+                              dates=opts.dates, queries=opts.queries,
+                              trace_slow=trace_slow, snapshot=snapshot,
+                              negative_ttl=opts.negative_ttl,
+                              ingest=opts.ingest, ingest_batch=opts.batch,
+                              fuse_args=args)
+    server.multithreaded = opts.threads > 1
+    if not opts.log: # FUSE log is shown in foreground
+        server.ready_fd = daemonize()
+    # signal handler is installed by the process that will receive it
+    server.stats_dump = SignalDump(server.stats, opts.stats_dump or
+                                                 join(cache_home, STATS_DUMP))
+    server.main()
 
 if __name__ == '__main__':
     run()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os, mmap, threading
+from collections import OrderedDict
+
+# Files of this size or bigger are mapped in memory when os.pread is
+# not available
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+pread = getattr(os, 'pread', None)
+
+
+class Handle(object):
+    """Read-only descriptor to a collection file. Reads are positional,
+    so a handle is shared by every open() of the same file."""
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.refs = 0
+        self.map = None
+        self.lock = threading.Lock()
+        if pread is None and self.size >= MMAP_THRESHOLD:
+            self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+
+    def read(self, size, offset):
+        """Return up to @size bytes from @offset."""
+        if pread is not None:
+            return pread(self.fd, size, offset)
+        elif self.map is not None:
+            return self.map[offset:offset + size]
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def close(self):
+        """Close descriptor and memory map."""
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+
+class HandlePool(object):
+    """Pool of open handles keyed by path. Handles not in use are kept
+    open (up to @size) to be reused by next open() of the same file,
+    least recently used ones are closed first."""
+    def __init__(self, size=64):
+        self.size = size
+        self.handles = {}           # path -> handle
+        self.idle = OrderedDict()   # path -> handle not in use
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, path):
+        """Return handle for @path, raises OSError if file can't be
+        opened."""
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is None:
+                handle = self.handles[path] = Handle(path)
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.idle.pop(path, None)
+            handle.refs += 1
+            return handle
+
+    def release(self, handle):
+        """Release @handle, it's kept idle for later reuse."""
+        with self.lock:
+            handle.refs -= 1
+            if handle.refs > 0:
+                return
+            self.idle[handle.path] = handle
+            while len(self.idle) > self.size:
+                path, old = self.idle.popitem(last=False)
+                self.handles.pop(path, None)
+                old.close()
+
+    def stats(self):
+        """Return pool counters as a dict."""
+        with self.lock:
+            return {'open': len(self.handles), 'idle': len(self.idle),
+                    'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        """Close idle handles."""
+        with self.lock:
+            while self.idle:
+                path, handle = self.idle.popitem()
+                self.handles.pop(path, None)
+                handle.close()
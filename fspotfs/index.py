@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from array import array
+
+from .fspotdb import Photo, PhotoVersion, PhotoTag, SYNCED_TABLES, \
+                     table_signature, uri_path, encode
+from .locking import RWLock
+
+# Same value as fspotfs.ROOT_ID, the virtual tag that holds
+# untagged photos
+ROOT_ID = 0
+
+# changed photos times above which dates index is sorted again instead
+# of updated one by one
+DATES_RELOAD = 1000
+
+
+class PhotoIndex(object):
+    """In-memory photo lookup index.
+
+    Keeps photos file names (quoted, as stored in database), resolved
+    paths, content hashes and tags, this way a (tag, file name) pair is resolved without
+    querying the database. Visibility rules are the same used to list
+    directories, photos tagged by a sub-tag are hidden in parent tag
+    unless @repeated is set.
+
+    If @postings (a postings.Postings instance) or @dates (a
+    dates.DateIndex instance) are given, they're kept up to date with
+    index changes.
+
+    Photos times are kept too, along with the newest photo time on every
+    tag directory (ROOT_ID for untagged photos and None for any photo).
+    It only depends on database contents, this way it's the same on every
+    mount. It's raised as photos are tagged or retimed, directories that
+    may have lost their newest photo are recomputed on next changed()
+    call.
+
+    Tables signatures (see fspotdb.table_signature) taken on load tell
+    sync() which tables changed since then.
+
+    Changes are serialized by a readers-writer lock. Lookups (find,
+    visible, path) don't take it, mappings values are immutable tuples
+    replaced in a single assignment, postings and dates readers must
+    hold it for reading.
+    """
+    def __init__(self, repeated=False, postings=None, dates=None):
+        self.repeated = repeated
+        self.postings = postings
+        self.dates = dates
+        self.photos = {}     # photo id -> (quoted file name, real path)
+        self.names = {}      # quoted file name -> tuple of photo ids
+        self.photo_tags = {} # photo id -> tuple of tag ids
+        self.hashes = {}     # md5 sum -> photo id
+        self.times = array('l') # photo id -> time, 0 if unknown
+        self.newest = {}     # tag id -> newest photo time
+        self.stale = set()   # tag ids whose newest time must be recomputed
+        self.signatures = {} # table name -> signature when last read
+        self.lock = RWLock()
+
+    def load(self):
+        """Loads photos and photo tags from database."""
+        self.read_load()()
+
+    def read_load(self):
+        """Read photos and photo tags from database, returns a function
+        loading them in index (database isn't read by it, see
+        read_sync)."""
+        # taken first, changes done while loading are seen by next sync
+        signatures = self._signatures()
+        rows = list(Photo.index_rows())
+        pairs = [(photo_id, tag_id) for photo_id, tag_id in PhotoTag.pairs()]
+        hashes = dict((encode(md5_sum), photo_id)
+                            for photo_id, md5_sum in Photo.hash_rows())
+        times = list(Photo.time_rows())
+
+        def load():
+            with self.lock.writing():
+                self._load(signatures, rows, pairs, hashes, times)
+        return load
+
+    def _load(self, signatures, rows, pairs, hashes, times):
+        """Replace index contents by database @rows, @pairs, @hashes and
+        @times read when tables had @signatures."""
+        self.photos, self.names, self.photo_tags = {}, {}, {}
+        self.hashes = hashes
+        for photo_id, base_uri, filename in rows:
+            self.add_photo(photo_id, base_uri, filename)
+        times = [(photo_id, value) for photo_id, value in times
+                    if photo_id in self.photos]
+        self.times = array('l')
+        for photo_id, value in times:
+            self._set_time(photo_id, value)
+        if self.dates is not None:
+            self.dates.load(times)
+        for photo_id, tag_id in pairs:
+            self.tag(photo_id, tag_id)
+        if self.postings is not None:
+            self.postings.load(self.photos.keys(), pairs)
+        self._load_newest()
+        self.signatures = signatures
+
+    def state(self):
+        """Return index state (and postings and dates ones) as a dict of
+        builtin types, it can be stored with marshal. See restore()."""
+        self.changed()
+        with self.lock.reading():
+            return {'photos': self.photos,
+                    'names': self.names,
+                    'photo_tags': self.photo_tags,
+                    'hashes': self.hashes,
+                    'times': self.times.tostring(),
+                    'newest': self.newest,
+                    'signatures': self.signatures,
+                    'postings': self.postings.state()
+                                    if self.postings is not None else None,
+                    'dates': self.dates.state()
+                                    if self.dates is not None else None}
+
+    def restore(self, state):
+        """Restore index from @state returned by state(), postings and
+        dates must be enabled the same way they were."""
+        with self.lock.writing():
+            self.photos = state['photos']
+            self.names = state['names']
+            self.photo_tags = state['photo_tags']
+            self.hashes = state['hashes']
+            self.times = array('l')
+            self.times.fromstring(state['times'])
+            self.newest = state['newest']
+            self.stale = set()
+            self.signatures = state['signatures']
+            if self.postings is not None:
+                self.postings.restore(state['postings'])
+            if self.dates is not None:
+                self.dates.restore(state['dates'])
+
+    def _signatures(self):
+        """Return current signature of every synced table."""
+        return dict((table, table_signature(table))
+                        for table in SYNCED_TABLES)
+
+    def _appended(self, table):
+        """Return last rowid read from @table if rows were only added to
+        it since then, None otherwise."""
+        signature = self.signatures.get(table)
+        if signature is not None and \
+           table_signature(table, signature[1]) == signature:
+            return signature[1]
+
+    def sync(self, full=False):
+        """Applies database changes to index. Tables whose signature
+        didn't change are skipped, only new rows are read from tables
+        that were just added to, other ones are read again and compared
+        with current state (every table with @full or if signatures are
+        unknown). Returns ids of tags whose listings changed (ROOT_ID for
+        untagged photos and None for all photos)."""
+        return self.read_sync(full)()
+
+    def read_sync(self, full=False):
+        """Read database changes as sync() does without holding the
+        index lock, returns a function applying them to index (with the
+        lock held) and returning sync() result. Index changes made
+        between both calls are overwritten by the state read."""
+        full = full or not self.signatures
+        signatures = self._signatures()
+        changed = set(table for table in SYNCED_TABLES
+                        if full or signatures[table] != self.signatures[table])
+        appliers = []
+
+        if changed & set(('photos', 'photo_versions')):
+            after = vafter = None
+            if not full:
+                after = self._appended('photos') \
+                            if 'photos' in changed else \
+                                self.signatures['photos'][1]
+                vafter = self._appended('photo_versions') \
+                            if 'photo_versions' in changed else \
+                                self.signatures['photo_versions'][1]
+            if after is None or vafter is None:
+                appliers.append(self._sync_photos())
+            else:
+                appliers.append(self._sync_new_photos(after, vafter))
+
+        if 'photo_tags' in changed:
+            after = None if full else self._appended('photo_tags')
+            if after is None:
+                appliers.append(self._sync_pairs())
+            else:
+                appliers.append(self._sync_new_pairs(after))
+
+        def apply():
+            affected = set()
+            for applier in appliers:
+                affected.update(applier())
+            self.signatures = signatures
+            return affected
+        return apply
+
+    def _sync_photos(self):
+        """Read every photo again, returns a function applying the
+        differences."""
+        rows = {}
+        for photo_id, base_uri, filename in Photo.index_rows():
+            rows[photo_id] = (encode(filename),
+                              encode(uri_path(base_uri, filename)))
+        hashes = dict((encode(md5_sum), photo_id)
+                            for photo_id, md5_sum in Photo.hash_rows())
+        times = [(photo_id, value) for photo_id, value in Photo.time_rows()
+                        if photo_id in rows]
+
+        def apply():
+            affected = set()
+            with self.lock.writing():
+                self.hashes = hashes
+                for photo_id in [i for i in self.photos if i not in rows]:
+                    affected.update(self.tags(photo_id) + (ROOT_ID, None))
+                    self.remove_photo(photo_id)
+                for photo_id, entry in rows.iteritems():
+                    if self.photos.get(photo_id) != entry:
+                        affected.update(self.tags(photo_id) + (ROOT_ID, None))
+                        self._set_name(photo_id, *entry)
+                retimed = [(photo_id, value) for photo_id, value in times
+                                if self.time(photo_id) != (value or None)]
+                for photo_id, value in retimed:
+                    self._set_time(photo_id, value)
+                if self.dates is not None:
+                    if len(retimed) > DATES_RELOAD:
+                        self.dates.load(times)
+                    else:
+                        for photo_id, value in retimed:
+                            self.dates.add(photo_id, value)
+            return affected
+        return apply
+
+    def _sync_new_photos(self, after, vafter):
+        """Read photos with id greater than @after and photos with
+        versions stored after rowid @vafter, returns a function applying
+        them."""
+        rows = list(Photo.index_rows(after=after))
+        photo_ids = PhotoVersion.photo_ids(vafter) - \
+                        set(row[0] for row in rows)
+        if photo_ids:
+            rows.extend(Photo.index_rows(photo_ids=photo_ids))
+        hashes = list(Photo.hash_rows(after))
+        times = list(Photo.time_rows(after))
+
+        def apply():
+            affected = set()
+            with self.lock.writing():
+                for photo_id, base_uri, filename in rows:
+                    entry = (encode(filename),
+                             encode(uri_path(base_uri, filename)))
+                    if self.photos.get(photo_id) != entry:
+                        affected.update(self.tags(photo_id) + (ROOT_ID, None))
+                        self._set_name(photo_id, *entry)
+                for photo_id, md5_sum in hashes:
+                    self.hashes[encode(md5_sum)] = photo_id
+                for photo_id, value in times:
+                    if photo_id in self.photos:
+                        self._set_time(photo_id, value)
+                        if self.dates is not None:
+                            self.dates.add(photo_id, value)
+            return affected
+        return apply
+
+    def _sync_pairs(self):
+        """Read every photo tag again, returns a function applying the
+        differences."""
+        pairs = set((photo_id, tag_id) for photo_id, tag_id in PhotoTag.pairs())
+
+        def apply():
+            affected = set()
+            with self.lock.writing():
+                current = set((photo_id, tag_id)
+                                for photo_id, tags in self.photo_tags.iteritems()
+                                    for tag_id in tags)
+                for photo_id, tag_id in current - pairs:
+                    affected.update(self.tags(photo_id) + (ROOT_ID,))
+                    self.untag(photo_id, tag_id)
+                for photo_id, tag_id in pairs - current:
+                    affected.update(self.tags(photo_id) + (ROOT_ID, tag_id))
+                    self.tag(photo_id, tag_id)
+            return affected
+        return apply
+
+    def _sync_new_pairs(self, after):
+        """Read photo tags stored after rowid @after, returns a function
+        applying them."""
+        pairs = list(PhotoTag.pairs(after))
+
+        def apply():
+            affected = set()
+            with self.lock.writing():
+                for photo_id, tag_id in pairs:
+                    if tag_id not in self.tags(photo_id):
+                        affected.update(self.tags(photo_id) + (ROOT_ID, tag_id))
+                        self.tag(photo_id, tag_id)
+            return affected
+        return apply
+
+    def add_photo(self, photo_id, base_uri, filename, md5_sum=None,
+                  time=None):
+        """Register photo @photo_id located at @base_uri and @filename,
+        with content hash @md5_sum and taken at @time if known."""
+        self._set_name(photo_id, encode(filename),
+                       encode(uri_path(base_uri, filename)))
+        with self.lock.writing():
+            if md5_sum:
+                self.hashes[encode(md5_sum)] = photo_id
+            if time is not None:
+                self._set_time(photo_id, time)
+                if self.dates is not None:
+                    self.dates.add(photo_id, time)
+
+    def remove_photo(self, photo_id):
+        """Unregister photo @photo_id."""
+        with self.lock.writing():
+            name, _ = self.photos.pop(photo_id, (None, None))
+            self._unname(photo_id, name)
+            self._outdate(self.photo_tags.pop(photo_id, (ROOT_ID,)),
+                          self.time(photo_id))
+            for md5_sum in [key for key, value in self.hashes.iteritems()
+                                if value == photo_id]:
+                del self.hashes[md5_sum]
+            if self.postings is not None:
+                self.postings.remove_photo(photo_id)
+            if self.dates is not None:
+                self.dates.remove(photo_id)
+
+    def _set_name(self, photo_id, name, path):
+        """Set @photo_id quoted file @name and real @path."""
+        with self.lock.writing():
+            old_name, _ = self.photos.get(photo_id, (None, None))
+            self.photos[photo_id] = (name, path)
+            if old_name != name:
+                self._unname(photo_id, old_name)
+                self.names[name] = self.names.get(name, ()) + (photo_id,)
+            if self.postings is not None:
+                self.postings.add_photo(photo_id)
+
+    def _set_time(self, photo_id, value):
+        """Set @photo_id time to @value."""
+        times = self.times
+        if photo_id >= len(times):
+            times.extend([0] * (photo_id + 1 - len(times)))
+        tag_ids = self.photo_tags.get(photo_id, (ROOT_ID,))
+        if photo_id in self.photos:
+            self._outdate(tag_ids, times[photo_id])
+        times[photo_id] = value or 0
+        if photo_id in self.photos:
+            self._raise(tag_ids, value or 0)
+
+    def _raise(self, tag_ids, value):
+        """Raise @tag_ids (and any photo) directories newest time to
+        @value, a photo with that time was listed in them."""
+        newest = self.newest
+        for tag_id in tuple(tag_ids) + (None,):
+            if value > newest.get(tag_id, 0):
+                newest[tag_id] = value
+
+    def _outdate(self, tag_ids, value):
+        """A photo with time @value was removed from @tag_ids (and any
+        photo) directories, their newest time is recomputed later if it
+        was that one."""
+        for tag_id in tuple(tag_ids) + (None,):
+            if value and value >= self.newest.get(tag_id, 0):
+                self.stale.add(tag_id)
+
+    def _load_newest(self, tag_ids=None):
+        """Set directories newest times from photos times, only @tag_ids
+        ones if given."""
+        times, newest = self.times, {}
+        for photo_id in self.photos:
+            value = times[photo_id] if photo_id < len(times) else 0
+            for tag_id in self.photo_tags.get(photo_id, (ROOT_ID,)) + (None,):
+                if value > newest.get(tag_id, 0) and \
+                   (tag_ids is None or tag_id in tag_ids):
+                    newest[tag_id] = value
+        if tag_ids is None:
+            self.newest = newest
+        else:
+            for tag_id in tag_ids:
+                self.newest.pop(tag_id, None)
+            self.newest.update(newest)
+        self.stale = set()
+
+    def changed(self, tag_id=None):
+        """Return newest photo time on @tag_id directory (any photo if
+        None) or None if unknown."""
+        if self.stale:
+            with self.lock.writing():
+                if self.stale:
+                    self._load_newest(self.stale)
+        return self.newest.get(tag_id)
+
+    def time(self, photo_id):
+        """Return @photo_id time or None if unknown."""
+        try:
+            return self.times[photo_id] or None
+        except (IndexError, TypeError):
+            pass
+
+    def _unname(self, photo_id, name):
+        """Remove @photo_id from @name entry in names mapping."""
+        ids = tuple(i for i in self.names.get(name, ()) if i != photo_id)
+        if ids:
+            self.names[name] = ids
+        else:
+            self.names.pop(name, None)
+
+    def tag(self, photo_id, tag_id):
+        """Register @photo_id as tagged by @tag_id."""
+        with self.lock.writing():
+            tags = self.photo_tags.get(photo_id, ())
+            if tag_id not in tags:
+                self.photo_tags[photo_id] = tags + (tag_id,)
+                if photo_id in self.photos:
+                    if not tags:
+                        self._outdate((ROOT_ID,), self.time(photo_id))
+                    self._raise((tag_id,), self.time(photo_id) or 0)
+                if self.postings is not None:
+                    self.postings.tag(photo_id, tag_id)
+
+    def untag(self, photo_id, tag_id):
+        """Unregister @tag_id from @photo_id tags."""
+        with self.lock.writing():
+            old_tags = self.photo_tags.get(photo_id, ())
+            tags = tuple(i for i in old_tags if i != tag_id)
+            if tags:
+                self.photo_tags[photo_id] = tags
+            else:
+                self.photo_tags.pop(photo_id, None)
+            if tag_id in old_tags and photo_id in self.photos:
+                self._outdate((tag_id,), self.time(photo_id))
+                if not tags:
+                    self._raise((ROOT_ID,), self.time(photo_id) or 0)
+            if self.postings is not None:
+                self.postings.untag(photo_id, tag_id)
+
+    def drop_tag(self, tag_id):
+        """Unregister @tag_id from every photo, returns affected photos
+        ids."""
+        with self.lock.writing():
+            photo_ids = [photo_id for photo_id, tags in self.photo_tags.iteritems()
+                            if tag_id in tags]
+            for photo_id in photo_ids:
+                self.untag(photo_id, tag_id)
+        return photo_ids
+
+    def tags(self, photo_id):
+        """Return tag ids for @photo_id."""
+        return self.photo_tags.get(photo_id, ())
+
+    def visible(self, photo_id, tag_id, subtags=()):
+        """Return True if @photo_id is listed in @tag_id directory.
+        @subtags are @tag_id sub-tag ids, photos tagged by them are
+        hidden if not in repeated mode (unless tagged by another tag
+        too, same as Tag.own_photos)."""
+        tags = self.photo_tags.get(photo_id, ())
+        if tag_id is None: # all photos
+            return True
+        elif tag_id == ROOT_ID: # untagged photos
+            return not tags
+        elif tag_id not in tags:
+            return False
+        elif self.repeated:
+            return True
+        others = [i for i in tags if i != tag_id]
+        return not others or any(i not in subtags for i in others)
+
+    def find(self, tag_id, name, subtags=()):
+        """Return photo id for quoted file @name listed in @tag_id
+        directory or None."""
+        for photo_id in self.names.get(name, ()):
+            if self.visible(photo_id, tag_id, subtags):
+                return photo_id
+
+    def find_by_name(self, name):
+        """Return any photo id for quoted file @name or None."""
+        ids = self.names.get(name)
+        if ids:
+            return ids[0]
+
+    def find_by_hash(self, md5_sum):
+        """Return photo id with content hash @md5_sum or None."""
+        return self.hashes.get(md5_sum)
+
+    def path(self, photo_id):
+        """Return real path for @photo_id or None."""
+        try:
+            return self.photos[photo_id][1]
+        except KeyError:
+            pass
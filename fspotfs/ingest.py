@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os, sys, time, threading, Queue
+
+from .fspotdb import close_sessions
+
+
+class PlacedFile(object):
+    """Written file already placed in collection, waiting to be
+    registered in database. Duplicates of registered photos aren't
+    moved, @photo_id is the photo to tag."""
+    def __init__(self, file, tag_id, base_uri=None, filename=None, new=False,
+                 md5_sum=None, photo_id=None, time=None):
+        self.file = file            # PhotoFile instance
+        self.tag_id = tag_id        # destination tag
+        self.base_uri = base_uri
+        self.filename = filename    # quoted file name
+        self.new = new              # False if file was already in collection
+        self.md5_sum = md5_sum      # content hash
+        self.photo_id = photo_id    # set once registered
+        self.time = time            # photo date as unix time
+
+
+class IngestQueue(object):
+    """Background imports pipeline.
+
+    Released files are placed in collection by a pool of @workers
+    threads (fs.place_import), placed files are registered in database
+    by a single committer thread (fs.register_imports), up to @batch
+    files per transaction or whatever is ready @delay seconds after the
+    first one arrived.
+
+    Threads are started by first put(), that's after FUSE went to
+    background (threads don't survive the fork).
+    """
+    def __init__(self, fs, workers=2, batch=50, delay=1.0):
+        self.fs = fs
+        self.workers = workers
+        self.batch = batch
+        self.delay = delay
+        self.files = Queue.Queue()
+        self.ready = Queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.queued = self.placed = self.committed = self.failed = 0
+        self.batches = 0
+        self.last_error = None
+        self.placers, self.committer = [], None
+
+    def start(self):
+        """Start workers if not running."""
+        with self.lock:
+            if self.committer is not None:
+                return
+            self.placers = [threading.Thread(target=self._place)
+                                for i in range(self.workers)]
+            self.committer = threading.Thread(target=self._commit)
+            for thread in self.placers + [self.committer]:
+                thread.daemon = True
+                thread.start()
+
+    def put(self, file):
+        """Queue released @file (a PhotoFile instance) for import."""
+        self.start()
+        with self.lock:
+            self.queued += 1
+        self.files.put(file)
+
+    def stop(self):
+        """Stop workers once every queued file was processed."""
+        if self.committer is None:
+            return
+        for thread in self.placers:
+            self.files.put(None)
+        for thread in self.placers:
+            thread.join()
+        self.ready.put(None)
+        self.committer.join()
+        self.placers, self.committer = [], None
+
+    def _fail(self, files, error):
+        """Account failed @files import."""
+        with self.lock:
+            self.failed += len(files)
+            self.last_error = str(error)
+        for file in files:
+            self.fs.discard_import(file)
+        print >>sys.stderr, 'Import failed (%s): %s' % \
+                            (', '.join(file.path for file in files), error)
+
+    def _place(self):
+        """Placer worker loop."""
+        while True:
+            file = self.files.get()
+            if file is None:
+                break
+            try:
+                item = self.fs.place_import(file)
+            except Exception, e:
+                item = e
+            finally:
+                close_sessions()
+            if isinstance(item, PlacedFile):
+                with self.lock:
+                    self.placed += 1
+                self.ready.put(item)
+            elif isinstance(item, int): # error number
+                self._fail([file], os.strerror(-item))
+            else:
+                self._fail([file], item)
+
+    def _commit(self):
+        """Committer worker loop."""
+        stop = False
+        while not stop:
+            item = self.ready.get()
+            if item is None:
+                break
+            items = [item]
+            deadline = time.time() + self.delay
+            while len(items) < self.batch:
+                try:
+                    item = self.ready.get(timeout=max(deadline - time.time(),
+                                                      0))
+                except Queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                items.append(item)
+            try:
+                self.fs.register_imports(items)
+            except Exception, e:
+                self._fail([queued.file for queued in items], e)
+            else:
+                with self.lock:
+                    self.committed += len(items)
+                    self.batches += 1
+            finally:
+                close_sessions()
+
+    def status(self):
+        """Return pipeline status as a dict."""
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            return {'queue_depth': self.files.qsize(),
+                    'waiting_commit': self.ready.qsize(),
+                    'in_flight': self.queued - self.committed - self.failed,
+                    'queued': self.queued,
+                    'placed': self.placed,
+                    'committed': self.committed,
+                    'failed': self.failed,
+                    'batches': self.batches,
+                    'files_per_second': round(self.committed / elapsed, 2),
+                    'last_error': self.last_error}
+
+    def report(self):
+        """Return status as text, one "name: value" per line."""
+        return ''.join('%s: %s\n' % item
+                            for item in sorted(self.status().iteritems()))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+from thread import get_ident
+from contextlib import contextmanager
+
+
+class RWLock(object):
+    """Readers-writer lock for read-mostly structures. Many threads can
+    hold it for reading, or a single thread for writing. The writer
+    thread can re-acquire it (for reading or writing), a reader must
+    not try to acquire it for writing."""
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+
+    def acquire_read(self):
+        """Acquire lock for reading."""
+        me = get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.depth += 1
+                return
+            while self.writer is not None:
+                self.cond.wait()
+            self.readers += 1
+
+    def acquire_write(self):
+        """Acquire lock for writing."""
+        me = get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.depth += 1
+                return
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.writer = me
+            self.depth = 1
+
+    def release(self):
+        """Release lock acquired by current thread."""
+        with self.cond:
+            if self.writer == get_ident():
+                self.depth -= 1
+                if not self.depth:
+                    self.writer = None
+                    self.cond.notify_all()
+            else:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        """Context manager holding lock for reading."""
+        self.acquire_read()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    @contextmanager
+    def writing(self):
+        """Context manager holding lock for writing."""
+        self.acquire_write()
+        try:
+            yield self
+        finally:
+            self.release()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from array import array
+from bisect import bisect_left
+
+
+def insort(postings, value):
+    """Insert @value in sorted @postings array if not present."""
+    pos = bisect_left(postings, value)
+    if pos == len(postings) or postings[pos] != value:
+        postings.insert(pos, value)
+        return True
+    return False
+
+
+def remove(postings, value):
+    """Remove @value from sorted @postings array if present."""
+    pos = bisect_left(postings, value)
+    if pos < len(postings) and postings[pos] == value:
+        postings.pop(pos)
+        return True
+    return False
+
+
+def contains(postings, value):
+    """Return True if @value is in sorted @postings array."""
+    pos = bisect_left(postings, value)
+    return pos < len(postings) and postings[pos] == value
+
+
+class Postings(object):
+    """Tag membership postings.
+
+    Keeps a sorted array of photo ids per tag, the sorted array of every
+    photo id and the number of tags on each photo (indexed by photo id).
+    Directory contents (own photos, untagged photos, repeated mode) are
+    computed as set operations over them, results are the same returned
+    by Tag.own_photos, Tag.untagged_photos and Photo.by_tag queries.
+    """
+    def __init__(self):
+        self.tags = {}              # tag id -> array of photo ids
+        self.photos = array('i')    # every photo id
+        self.counts = array('H')    # photo id -> number of tags
+
+    def load(self, photo_ids, pairs):
+        """Loads postings from @photo_ids and (photo_id, tag_id) @pairs."""
+        tags = {}
+        for photo_id, tag_id in pairs:
+            tags.setdefault(tag_id, []).append(photo_id)
+        self.tags = dict((tag_id, array('i', sorted(set(ids))))
+                            for tag_id, ids in tags.iteritems())
+        self.photos = array('i', sorted(photo_ids))
+        size = max(self.photos[-1] if self.photos else 0,
+                   max(max(ids) for ids in self.tags.itervalues())
+                        if self.tags else 0) + 1
+        self.counts = array('H', [0]) * size
+        for ids in self.tags.itervalues():
+            for photo_id in ids:
+                self.counts[photo_id] += 1
+
+    def state(self):
+        """Return postings as a dict of strings (arrays machine values),
+        see restore()."""
+        return {'tags': dict((tag_id, ids.tostring())
+                                for tag_id, ids in self.tags.iteritems()),
+                'photos': self.photos.tostring(),
+                'counts': self.counts.tostring()}
+
+    def restore(self, state):
+        """Restore postings from @state returned by state()."""
+        def load(typecode, value):
+            values = array(typecode)
+            values.fromstring(value)
+            return values
+        self.tags = dict((tag_id, load('i', value))
+                            for tag_id, value in state['tags'].iteritems())
+        self.photos = load('i', state['photos'])
+        self.counts = load('H', state['counts'])
+
+    def _grow(self, photo_id):
+        """Make room in counts array for @photo_id."""
+        if photo_id >= len(self.counts):
+            self.counts.extend([0] * (photo_id + 1 - len(self.counts)))
+
+    def add_photo(self, photo_id):
+        """Register photo @photo_id."""
+        self._grow(photo_id)
+        insort(self.photos, photo_id)
+
+    def remove_photo(self, photo_id):
+        """Unregister photo @photo_id and its tags."""
+        remove(self.photos, photo_id)
+        for tag_id, ids in self.tags.iteritems():
+            if remove(ids, photo_id):
+                self.counts[photo_id] -= 1
+
+    def tag(self, photo_id, tag_id):
+        """Register @photo_id as tagged by @tag_id."""
+        self._grow(photo_id)
+        if insort(self.tags.setdefault(tag_id, array('i')), photo_id):
+            self.counts[photo_id] += 1
+
+    def untag(self, photo_id, tag_id):
+        """Unregister @tag_id from @photo_id tags."""
+        if remove(self.tags.get(tag_id, array('i')), photo_id):
+            self.counts[photo_id] -= 1
+
+    def all_photos(self):
+        """Return every photo id."""
+        return self.photos
+
+    def untagged(self):
+        """Return ids of photos without tags."""
+        counts = self.counts
+        return array('i', (i for i in self.photos if not counts[i]))
+
+    def by_tag(self, tag_id):
+        """Return ids of photos tagged by @tag_id."""
+        return self.tags.get(tag_id, array('i'))
+
+    def own(self, tag_id, subtags=()):
+        """Return ids of photos tagged by @tag_id but not by its
+        @subtags. Same as Tag.own_photos query, photos tagged by a
+        sub-tag are still listed if they have a third tag that isn't a
+        sub-tag."""
+        members = self.by_tag(tag_id)
+        if not subtags or not members:
+            return members
+        lookup = frozenset(members)
+        hits = {}
+        for subtag in subtags:
+            for photo_id in self.tags.get(subtag, ()):
+                if photo_id in lookup:
+                    hits[photo_id] = hits.get(photo_id, 0) + 1
+        counts = self.counts
+        # hidden when every other tag on the photo is a sub-tag
+        hidden = frozenset(photo_id for photo_id, count in hits.iteritems()
+                                if count == counts[photo_id] - 1)
+        if not hidden:
+            return members
+        return array('i', (i for i in members if i not in hidden))
+
+    def intersection(self, tag_ids):
+        """Return ids of photos tagged by every tag in @tag_ids. Starts
+        from the smallest postings, bigger ones are probed by bisection
+        when much bigger than the partial result."""
+        members = sorted((self.by_tag(tag_id) for tag_id in tag_ids), key=len)
+        if not members:
+            return array('i')
+        result = array('i', members[0]) # not the live postings
+        for ids in members[1:]:
+            if not result:
+                break
+            if len(result) * 8 < len(ids):
+                result = array('i', (i for i in result if contains(ids, i)))
+            else:
+                lookup = frozenset(result)
+                result = array('i', (i for i in ids if i in lookup))
+        return result
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from array import array
+
+AND, OR = '&', '|'
+
+
+def parse(expression):
+    """Parse query @expression, tag names joined by AND (intersection)
+    and OR (union) operators, AND binds tighter. Returns a tuple of
+    alternatives, each a tuple of tag names to intersect ('A&B|C' is
+    ((A, B), (C,))), or None if an operand is empty."""
+    terms = []
+    for alternative in expression.split(OR):
+        names = tuple(alternative.split(AND))
+        if not all(names):
+            return None
+        terms.append(names)
+    return tuple(terms)
+
+
+def evaluate(terms, postings):
+    """Return sorted ids of photos matching parsed query @terms, with
+    tag ids instead of names, over @postings (a postings.Postings
+    instance)."""
+    results = [postings.intersection(tag_ids) for tag_ids in terms]
+    if len(results) == 1:
+        return results[0]
+    ids = set()
+    for result in results:
+        ids.update(result)
+    return array('i', sorted(ids))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os, marshal
+from os.path import dirname, isdir
+
+from .fspotdb import get_db_version
+
+MAGIC = 'FSPOTFS-SNAPSHOT'
+FORMAT = 2 # bumped when stored state changes
+
+
+def file_marker(name):
+    """Return (mtime, size) of file @name or None if missing."""
+    try:
+        st = os.stat(name)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+class Snapshot(object):
+    """On-disk snapshot of tags and photo index state, written with
+    marshal. It's valid while F-Spot database @db_file (and its WAL file)
+    keeps the same mtime and size, schema version is the same and the
+    filesystem is built with the same @features (in-memory structures
+    enabled). The key is stored before the state, this way a stale
+    snapshot is discarded without loading it."""
+    def __init__(self, path, db_file, features=()):
+        self.path = path
+        self.db_file = db_file
+        self.features = tuple(features)
+
+    def key(self):
+        """Return current validation key."""
+        return (FORMAT, get_db_version(), self.features,
+                file_marker(self.db_file), file_marker(self.db_file + '-wal'))
+
+    def load(self, key):
+        """Return stored state if it was saved with @key, or None."""
+        try:
+            with open(self.path, 'rb') as snap:
+                if snap.read(len(MAGIC)) != MAGIC or marshal.load(snap) != key:
+                    return None
+                return marshal.load(snap)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def save(self, key, state):
+        """Store @state with validation @key, replaced atomically."""
+        if not isdir(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as snap:
+            snap.write(MAGIC)
+            marshal.dump(key, snap, 2)
+            marshal.dump(state, snap, 2)
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os, time, json, fcntl, signal, threading
+from bisect import bisect_left
+from os.path import dirname, isdir
+
+# latency histogram buckets upper bounds, in seconds
+BUCKETS = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002,
+           0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+def bucket_label(bound):
+    """Return histogram label for bucket with upper @bound seconds."""
+    if bound is None:
+        return '>%gms' % (BUCKETS[-1] * 1000)
+    return '<=%gms' % (bound * 1000)
+
+
+class Histogram(object):
+    """Latency histogram, counts calls in BUCKETS, total and maximum
+    time. Not locked, Stats serializes access."""
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, elapsed, error=False):
+        """Account a call that took @elapsed seconds."""
+        self.calls += 1
+        self.errors += error
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[bisect_left(BUCKETS, elapsed)] += 1
+
+    def report(self):
+        """Return histogram as a dict, times in milliseconds, empty
+        buckets are omitted."""
+        bounds = BUCKETS + (None,)
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'total_ms': round(self.total * 1000, 3),
+                'avg_ms': round(self.total * 1000 / max(self.calls, 1), 3),
+                'max_ms': round(self.max * 1000, 3),
+                'histogram': dict((bucket_label(bound), count)
+                                    for bound, count in zip(bounds,
+                                                            self.buckets)
+                                        if count)}
+
+
+class Stats(object):
+    """Runtime counters: per handler latency histograms, SQL statements
+    count and time, background failures (count and last message) and
+    counters of registered caches (any object with a stats() method
+    returning a dict, hit rate is added when it has hits and misses
+    counters)."""
+    def __init__(self):
+        self.started = time.time()
+        self.operations = {} # handler name -> Histogram
+        self.statements = 0
+        self.sql_time = 0.0
+        self.failures = {}   # name -> [count, last message]
+        self.caches = {}     # name -> cache
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed, error=False):
+        """Account a @name handler call that took @elapsed seconds."""
+        with self.lock:
+            histogram = self.operations.get(name)
+            if histogram is None:
+                histogram = self.operations[name] = Histogram()
+            histogram.add(elapsed, error)
+
+    def statement(self, statement, parameters, elapsed):
+        """Account an SQL statement (fspotdb.on_statement hook)."""
+        with self.lock:
+            self.statements += 1
+            self.sql_time += elapsed
+
+    def failure(self, name, error):
+        """Account a @name failure with @error (exception or message)
+        not reported by any handler."""
+        with self.lock:
+            entry = self.failures.setdefault(name, [0, None])
+            entry[0] += 1
+            entry[1] = str(error)
+
+    def register(self, name, cache):
+        """Report @cache counters as @name."""
+        self.caches[name] = cache
+
+    def report(self):
+        """Return counters as a dict."""
+        caches = {}
+        for name, cache in self.caches.iteritems():
+            values = cache.stats()
+            lookups = values.get('hits', 0) + values.get('misses', 0)
+            if lookups:
+                values['hit_rate'] = round(float(values['hits']) / lookups, 4)
+            caches[name] = values
+        with self.lock:
+            return {'uptime': round(time.time() - self.started, 3),
+                    'operations': dict((name, histogram.report())
+                                for name, histogram in
+                                    self.operations.iteritems()),
+                    'sql': {'statements': self.statements,
+                            'time_ms': round(self.sql_time * 1000, 3)},
+                    'failures': dict((name, {'count': count, 'last': last})
+                                for name, (count, last) in
+                                    self.failures.iteritems()),
+                    'caches': caches}
+
+    def as_json(self):
+        """Return counters as JSON text."""
+        return json.dumps(self.report(), indent=2, sort_keys=True) + '\n'
+
+
+class SignalDump(object):
+    """Writes @stats JSON report to @path when @signum is received. The
+    signal is noticed through a wakeup pipe read by a thread, this way
+    it's handled while main thread is blocked in FUSE loop. Must be
+    created in main thread of the process serving the mount (after going
+    to background, signals are ignored by Python in processes forked by
+    C code), the thread is started by start()."""
+    def __init__(self, stats, path, signum=signal.SIGUSR1):
+        self.stats = stats
+        self.path = path
+        self.thread = None
+        self.read_fd, write_fd = os.pipe()
+        flags = fcntl.fcntl(write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # python handler does nothing, wakeup byte does the work
+        signal.signal(signum, lambda signum, frame: None)
+        signal.set_wakeup_fd(write_fd)
+
+    def start(self):
+        """Start dumper thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while os.read(self.read_fd, 1):
+            try:
+                self.dump()
+            except (IOError, OSError):
+                pass
+
+    def dump(self):
+        """Write report to path, replaced atomically."""
+        if not isdir(dirname(self.path)):
+            os.makedirs(dirname(self.path))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write(self.stats.as_json())
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os, threading, Queue, Image
+from hashlib import md5
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from os.path import join, isdir
+
+THUMB_SIZE  = (256, 256)        # thumbnails bounding box
+CACHE_LIMIT = 256 * 1024 * 1024 # bytes used by cached thumbnails
+
+
+def make_thumbnail(source, dest, size):
+    """Write @source image thumbnail fitting in @size to @dest as JPEG.
+    Runs in a worker process, returns written bytes or None if
+    thumbnail can't be built (any error, waiters are woken up by the
+    result callback, see ThumbnailCache._built)."""
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        img = Image.open(source)
+        img.draft('RGB', size) # JPEG files are decoded scaled down
+        img.thumbnail(size, Image.ANTIALIAS)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.save(tmp, 'JPEG', quality=85)
+        os.rename(tmp, dest)
+        return os.path.getsize(dest)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ThumbnailCache(object):
+    """Thumbnails of collection photos stored in @root directory.
+
+    Thumbnails are keyed by photo path and mtime (so they're rebuilt
+    when the photo changes), built by a pool of @workers processes (to
+    not hold other FUSE operations) and evicted least recently used
+    first when cache grows over @limit bytes.
+
+    Pool and warmer thread are started on first use, after FUSE went
+    to background.
+    """
+    def __init__(self, root, limit=CACHE_LIMIT, size=THUMB_SIZE,
+                 workers=None):
+        self.root = root
+        self.limit = limit
+        self.size = size
+        self.workers = workers or cpu_count()
+        self.files = OrderedDict() # file name -> bytes, LRU first
+        self.total = 0
+        self.pending = {}          # file name -> build done Event
+        self.failed = set()        # file names that can't be built
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        self.pool = None
+        self.warmer = None
+        self.warm_queue = Queue.Queue()
+        self.load()
+
+    def load(self):
+        """Load cached thumbnails, last accessed are kept longer."""
+        if not isdir(self.root):
+            os.makedirs(self.root)
+        entries = []
+        for name in os.listdir(self.root):
+            path = join(self.root, name)
+            if name.endswith('.tmp'): # interrupted build
+                os.remove(path)
+            elif name.endswith('.jpg'):
+                st = os.stat(path)
+                entries.append((st.st_atime, name, st.st_size))
+        for atime, name, size in sorted(entries):
+            self.files[name] = size
+            self.total += size
+        with self.lock:
+            self._evict()
+
+    def name(self, path):
+        """Return cache file name for image @path or None if missing."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = '%s\0%d\0%d\0%dx%d' % ((path, st.st_mtime, st.st_size) +
+                                     tuple(self.size))
+        return md5(key).hexdigest() + '.jpg'
+
+    def get(self, path):
+        """Return thumbnail file path for image @path, it's built if not
+        cached (current thread waits for it). None is returned if it
+        can't be built."""
+        name = self.name(path)
+        if name is None:
+            return None
+        with self.lock:
+            if name in self.files:
+                self.files[name] = self.files.pop(name)
+                self.hits += 1
+                return join(self.root, name)
+            self.misses += 1
+            if name in self.failed:
+                return None
+            done = self._submit(path, name)
+        done.wait()
+        with self.lock:
+            if name in self.files:
+                return join(self.root, name)
+
+    def cached(self, path):
+        """Return thumbnail file path for image @path if it's cached, None
+        otherwise. It isn't built."""
+        name = self.name(path)
+        with self.lock:
+            if name is not None and name in self.files:
+                return join(self.root, name)
+
+    def unbuildable(self, path):
+        """Return True if image @path thumbnail was tried and can't be
+        built (not a readable image)."""
+        if not self.failed or path is None:
+            return False
+        name = self.name(path)
+        with self.lock:
+            return name in self.failed
+
+    def warm(self, paths):
+        """Build thumbnails for images @paths in background, one at a
+        time to not delay get() calls."""
+        with self.lock:
+            if self.warmer is None:
+                self.warmer = threading.Thread(target=self._warm)
+                self.warmer.daemon = True
+                self.warmer.start()
+        for path in paths:
+            if path is not None:
+                self.warm_queue.put(path)
+
+    def _warm(self):
+        """Warmer thread loop."""
+        while True:
+            path = self.warm_queue.get()
+            if path is None:
+                break
+            name = self.name(path)
+            if name is None:
+                continue
+            with self.lock:
+                if name in self.files or name in self.failed:
+                    continue
+                done = self._submit(path, name)
+            done.wait()
+
+    def _submit(self, path, name):
+        """Queue thumbnail build, returns an Event set once it's done
+        (AsyncResult wakes up a single waiter on Python 2, get() callers
+        and the warmer may wait for the same build). Lock must be
+        held."""
+        done = self.pending.get(name)
+        if done is None:
+            if self.pool is None:
+                self.pool = Pool(self.workers)
+            done = self.pending[name] = threading.Event()
+            self.pool.apply_async(make_thumbnail,
+                                  (path, join(self.root, name), self.size),
+                                  callback=lambda size: self._built(name, size))
+        return done
+
+    def _built(self, name, size):
+        """Register built thumbnail (called by pool results thread)."""
+        with self.lock:
+            done = self.pending.pop(name, None)
+            if size is None:
+                self.failed.add(name)
+            else:
+                self.files[name] = size
+                self.total += size
+                self._evict()
+        if done is not None:
+            done.set()
+
+    def _evict(self):
+        """Remove least recently used thumbnails until cache size is
+        under limit, lock must be held."""
+        while self.total > self.limit and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(join(self.root, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        """Return cache counters as a dict."""
+        with self.lock:
+            return {'files': len(self.files), 'bytes': self.total,
+                    'pending': len(self.pending), 'failed': len(self.failed),
+                    'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        """Stop warmer and workers pool. Queued warm up paths are dropped
+        and the thumbnail being built by the warmer is waited for, the
+        pool is terminated once warmer is done submitting builds."""
+        if self.warmer is not None:
+            try:
+                while True:
+                    self.warm_queue.get_nowait()
+            except Queue.Empty:
+                pass
+            self.warm_queue.put(None)
+            self.warmer.join()
+            self.warmer = None
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        with self.lock: # builds were dropped, wake up their waiters
+            for done in self.pending.itervalues():
+                done.set()
+            self.pending.clear()
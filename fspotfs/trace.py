@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010  Matias Aguirre <matiasaguirre@gmail.com>
+
+This file is part of F-SpotFS.
+
+F-SpotFS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import time, json, sqlite3, threading
+from collections import deque
+
+from .cache import LRUCache
+
+TRACE_SIZE = 100 # slow statements records kept
+PLANS_SIZE = 256 # cached query plans
+
+
+class Operation(object):
+    """FUSE handler call being traced."""
+    def __init__(self, handler, path):
+        self.handler = handler
+        self.path = path
+        self.started = time.time()
+        self.counts = {} # statement -> times executed
+        self.slow = {}   # statement -> [parameters, max elapsed, slow runs]
+
+
+class SlowQueryTracer(object):
+    """Records SQL statements slower than @threshold seconds with the
+    FUSE handler and path that triggered them, how many times the
+    statement ran in that handler call (N+1 patterns show up as big
+    counts) and its query plan. Plans are taken by a private read-only
+    connection to @db_file once the handler is done.
+
+    Statements are received from fspotdb.on_statement hook, handlers
+    calls are delimited by begin() and end() in the calling thread."""
+    def __init__(self, db_file, threshold, size=TRACE_SIZE):
+        self.db_file = db_file
+        self.threshold = threshold
+        self.records = deque(maxlen=size)
+        self.plans = LRUCache(PLANS_SIZE)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def begin(self, handler, path=None):
+        """Start tracing @handler call on @path in current thread,
+        returns False if a call is already traced (nested handlers)."""
+        if getattr(self.local, 'operation', None) is not None:
+            return False
+        self.local.operation = Operation(handler, path)
+        return True
+
+    def end(self):
+        """Finish current thread handler call, its slow statements are
+        recorded."""
+        operation, self.local.operation = self.local.operation, None
+        for statement, (parameters, elapsed, slow) in \
+                operation.slow.iteritems():
+            self._record(operation, statement, parameters, elapsed,
+                         operation.counts[statement], slow)
+
+    def statement(self, statement, parameters, elapsed):
+        """Account an SQL statement (fspotdb.on_statement hook)."""
+        operation = getattr(self.local, 'operation', None)
+        if operation is None: # not run by a handler (ingest, startup)
+            if elapsed >= self.threshold:
+                self._record(Operation(None, None), statement, parameters,
+                             elapsed, 1, 1)
+            return
+        operation.counts[statement] = operation.counts.get(statement, 0) + 1
+        if elapsed >= self.threshold:
+            slow = operation.slow.get(statement)
+            if slow is None:
+                operation.slow[statement] = [parameters, elapsed, 1]
+            else:
+                slow[1] = max(slow[1], elapsed)
+                slow[2] += 1
+
+    def _record(self, operation, statement, parameters, elapsed, runs,
+                slow):
+        """Store record of @statement run @runs times by @operation,
+        @slow times over threshold (@elapsed is the slowest run)."""
+        record = {'time': round(operation.started, 3),
+                  'handler': operation.handler,
+                  'path': operation.path,
+                  'statement': statement,
+                  'parameters': repr(parameters)[:200],
+                  'elapsed_ms': round(elapsed * 1000, 3),
+                  'runs_in_operation': runs,
+                  'slow_runs': slow,
+                  'plan': self.plan(statement, parameters)}
+        with self.lock:
+            self.records.append(record)
+
+    def plan(self, statement, parameters):
+        """Return EXPLAIN QUERY PLAN rows details for @statement, cached
+        by statement text."""
+        plan = self.plans.get(statement)
+        if plan is not None:
+            return plan
+        if isinstance(parameters, list): # executemany
+            parameters = parameters[0] if parameters else ()
+        try:
+            with self.lock:
+                if self.conn is None:
+                    self.conn = sqlite3.connect(self.db_file,
+                                                check_same_thread=False)
+                    self.conn.execute('PRAGMA query_only = ON')
+                rows = self.conn.execute('EXPLAIN QUERY PLAN ' + statement,
+                                         parameters or ()).fetchall()
+        except sqlite3.Error, e:
+            return ['unavailable: %s' % e]
+        plan = [row[-1] for row in rows]
+        self.plans.put(statement, plan)
+        return plan
+
+    def as_json(self):
+        """Return records as JSON text, oldest first."""
+        with self.lock:
+            records = list(self.records)
+        return json.dumps(records, indent=2, sort_keys=True) + '\n'